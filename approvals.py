@@ -0,0 +1,242 @@
+import hashlib
+import logging
+import threading
+import time
+
+import log_setup
+from db import add_columns
+
+# Очередь одобрений.
+# Обработчик кнопки «Одобрить» только подтверждает бронь и записывает задание
+# в таблицу approval_jobs в той же транзакции, поэтому отвечает за миллисекунды.
+# Событие в календаре, уведомление клиента и статус в Sheets выполняют фоновые
+# воркеры, задания разных заявок — параллельно. Задание переживает перезапуск.
+# Ключ идемпотентности задаёт и id события в Calendar, поэтому повтор после
+# сбоя не создаёт второе событие: ответ 409 значит, что событие уже есть.
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS approval_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id INTEGER,
+    idempotency_key TEXT UNIQUE,
+    resource_id TEXT,
+    status TEXT,
+    event_id TEXT,
+    notified INTEGER DEFAULT 0,
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    admin_chat_id INTEGER,
+    admin_message_id INTEGER,
+    created_at REAL,
+    updated_at REAL,
+    next_attempt_at REAL
+);
+CREATE INDEX IF NOT EXISTS approval_jobs_due ON approval_jobs (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS approval_jobs_request_id ON approval_jobs (request_id);
+'''
+
+# batch — задание пакетного одобрения из /queue: сообщение администратора
+# показывает статусы всех заданий пакета
+ADDED_COLUMNS = [
+    ('approval_jobs', 'batch', 'INTEGER DEFAULT 0'),
+]
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS approval_jobs_message ON approval_jobs (admin_chat_id, admin_message_id);
+'''
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+COLUMNS = ('id', 'request_id', 'idempotency_key', 'resource_id', 'status', 'event_id', 'notified', 'attempts',
+           'error', 'admin_chat_id', 'admin_message_id', 'created_at', 'updated_at', 'next_attempt_at', 'batch')
+# Поля, которые воркер меняет по ходу выполнения задания
+UPDATABLE = ('status', 'event_id', 'notified', 'error', 'next_attempt_at')
+
+INSERT_JOB = '''
+INSERT OR IGNORE INTO approval_jobs
+    (request_id, idempotency_key, resource_id, status, admin_chat_id, admin_message_id,
+     created_at, updated_at, next_attempt_at, batch)
+VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?)
+'''
+SELECT_JOB_ID = 'SELECT id FROM approval_jobs WHERE idempotency_key = ?'
+SELECT_JOB = f"SELECT {', '.join(COLUMNS)} FROM approval_jobs WHERE id = ?"
+SELECT_DUE_JOB = f'''
+SELECT {', '.join(COLUMNS)} FROM approval_jobs
+WHERE status = 'queued' AND next_attempt_at <= ?
+ORDER BY next_attempt_at, id LIMIT 1
+'''
+# Готовые задания, которым ещё нужно событие: их события создаются одним batch-запросом
+SELECT_DUE_EVENT_JOBS = '''
+SELECT id FROM approval_jobs
+WHERE status = 'queued' AND next_attempt_at <= ? AND event_id IS NULL AND id != ?
+ORDER BY next_attempt_at, id LIMIT ?
+'''
+CLAIM_JOB = "UPDATE approval_jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?"
+SELECT_RECENT = f"SELECT {', '.join(COLUMNS)} FROM approval_jobs ORDER BY id DESC LIMIT ?"
+SELECT_MESSAGE_JOBS = f'''
+SELECT {', '.join(COLUMNS)} FROM approval_jobs WHERE admin_chat_id = ? AND admin_message_id = ? ORDER BY id
+'''
+# Сообщение снова показывает очередь — статусы заданий в него больше не пишутся
+DETACH_MESSAGE = 'UPDATE approval_jobs SET admin_message_id = NULL WHERE admin_chat_id = ? AND admin_message_id = ?'
+# Неудавшиеся задания администратор возвращает в очередь командой /retry; попытки считаются заново
+RETRY_FAILED = """
+UPDATE approval_jobs SET status = 'queued', attempts = 0, next_attempt_at = ?, updated_at = ?
+WHERE status = 'failed' AND (? IS NULL OR id = ?)
+RETURNING id
+"""
+# Задания, которые выполнялись в момент остановки процесса, выполняются заново
+RESET_RUNNING = "UPDATE approval_jobs SET status = 'queued' WHERE status = 'running'"
+
+
+def idempotency_key(request_id):
+    return f'approve-{request_id}'
+
+
+def event_id(key):
+    # id события в Calendar: символы 0-9 и a-v, от 5 до 1024 символов
+    return 'stobot' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ApprovalJob(object):
+    __slots__ = COLUMNS
+
+    def __init__(self, row):
+        for column, value in zip(COLUMNS, row):
+            setattr(self, column, value)
+
+
+class ApprovalJobs(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.wakeup = threading.Event()
+        def migrate(conn):
+            conn.executescript(SCHEMA)
+            add_columns(conn, ADDED_COLUMNS)
+            conn.executescript(INDEXES)
+            conn.execute(RESET_RUNNING)
+        self.db.migrate(migrate)
+
+    def enqueue(self, conn, request_id, resource_id, admin_chat_id=None, admin_message_id=None, batch=False):
+        # Выполняется внутри транзакции записи одобрения. Повторное одобрение той же
+        # заявки возвращает уже существующее задание
+        key = idempotency_key(request_id)
+        now = time.time()
+        conn.execute(INSERT_JOB, (request_id, key, resource_id, admin_chat_id, admin_message_id, now, now, now,
+                                  int(batch)))
+        return conn.execute(SELECT_JOB_ID, (key,)).fetchone()[0]
+
+    def wake(self):
+        self.wakeup.set()
+
+    def claim(self, limit=1):
+        # Берёт самое старое готовое задание и помечает его выполняемым. Если заданию
+        # нужно событие, вместе с ним берутся другие такие же, всего до limit:
+        # их события создаются одним batch-запросом. Пустой список — заданий нет
+        def claim(conn):
+            now = time.time()
+            row = conn.execute(SELECT_DUE_JOB, (now,)).fetchone()
+            if row is None:
+                return []
+            job_ids = [row[0]]
+            if row[COLUMNS.index('event_id')] is None and limit > 1:
+                job_ids += [due[0] for due in conn.execute(SELECT_DUE_EVENT_JOBS, (now, row[0], limit - 1))]
+            jobs = []
+            for job_id in job_ids:
+                conn.execute(CLAIM_JOB, (now, job_id))
+                jobs.append(ApprovalJob(conn.execute(SELECT_JOB, (job_id,)).fetchone()))
+            return jobs
+        return self.db.submit(claim).result()
+
+    def update(self, job_id, **fields):
+        assert set(fields) <= set(UPDATABLE), fields
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        params = list(fields.values()) + [time.time(), job_id]
+        self.db.write(f'UPDATE approval_jobs SET {columns}, updated_at = ? WHERE id = ?', params)
+
+    def retry(self, job_id=None):
+        # Без job_id — все неудавшиеся задания. Возвращает id возвращённых в очередь
+        now = time.time()
+        job_ids = [row[0] for row in self.db.write(RETRY_FAILED, (now, now, job_id, job_id))]
+        if job_ids:
+            self.wake()
+        return job_ids
+
+    def get(self, job_id):
+        row = self.db.read_one(SELECT_JOB, (job_id,))
+        return ApprovalJob(row) if row else None
+
+    def for_message(self, chat_id, message_id):
+        return [ApprovalJob(row) for row in self.db.read(SELECT_MESSAGE_JOBS, (chat_id, message_id))]
+
+    def detach(self, chat_id, message_id):
+        self.db.write(DETACH_MESSAGE, (chat_id, message_id))
+
+    def recent(self, limit=20):
+        return [ApprovalJob(row) for row in self.db.read(SELECT_RECENT, (limit,))]
+
+
+class ApprovalWorker(threading.Thread):
+    # process(job) выполняет шаги задания и отмечает сделанные, поэтому повтор
+    # продолжает с первого невыполненного шага. prepare(jobs) — общий шаг для заданий,
+    # взятых вместе (события одним batch-запросом); возвращает {id задания: ошибка}.
+    # on_change(job) — после каждой попытки
+
+    def __init__(self, jobs, process, max_attempts, max_backoff, poll_interval, on_change=None, name='approvals',
+                 prepare=None, batch_size=1):
+        super().__init__(name=name, daemon=True)
+        self.jobs = jobs
+        self.process = process
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        self.prepare = prepare
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            try:
+                jobs = self.jobs.claim(self.batch_size)
+            except Exception as e:
+                logger.error("Ошибка очереди одобрений: %s", e)
+                jobs = []
+            if not jobs:
+                self.jobs.wakeup.wait(self.poll_interval)
+                self.jobs.wakeup.clear()
+                continue
+            errors = {}
+            if self.prepare is not None:
+                try:
+                    errors = self.prepare(jobs)
+                except Exception as e:
+                    errors = {job.id: e for job in jobs}
+            for job in jobs:
+                self.execute(job, errors.get(job.id))
+
+    def execute(self, job, error=None):
+        # Записи о задании, в том числе из process и on_change, получают request_id заявки
+        with log_setup.context(request_id=job.request_id):
+            try:
+                if error is not None:
+                    raise error
+                self.process(job)
+                self.jobs.update(job.id, status=DONE, error=None)
+                logger.info("Задание %s по заявке %s выполнено", job.id, job.request_id)
+            except Exception as e:
+                if job.attempts >= self.max_attempts:
+                    self.jobs.update(job.id, status=FAILED, error=str(e))
+                    logger.error("Задание %s по заявке %s не выполнено: %s", job.id, job.request_id, e)
+                else:
+                    delay = min(2 ** job.attempts, self.max_backoff)
+                    self.jobs.update(job.id, status=QUEUED, error=str(e), next_attempt_at=time.time() + delay)
+                    logger.warning("Задание %s по заявке %s, повтор через %s с: %s", job.id, job.request_id, delay, e)
+            if self.on_change is not None:
+                try:
+                    self.on_change(self.jobs.get(job.id))
+                except Exception as e:
+                    logger.error("Ошибка при обновлении статуса задания %s: %s", job.id, e)
@@ -0,0 +1,471 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import datetime
+import functools
+import logging
+import re
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_filters import SimpleCustomFilter
+
+import config
+import keyboards
+import log_setup
+import metrics
+import services
+from db import STATUS_PENDING, RequestNotPending
+from google_calendar import CalendarUnavailable
+from holds import SlotTaken
+from slots import UTC_PLUS_4
+
+# Асинхронный режим (BOT_MODE = 'async').
+# Тот же сценарий записи и те же клавиатуры, что в main.py, но обработчики —
+# корутины на AsyncTeleBot. Блокирующие вызовы Calendar, Sheets и SQLite
+# уходят в ограниченный пул потоков, поэтому число одновременных диалогов
+# не ограничено числом потоков.
+
+logger = logging.getLogger(__name__)
+
+bot = AsyncTeleBot(config.BOT_TOKEN)
+admin_id = config.ADMIN_ID
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.ASYNC_IO_WORKERS, thread_name_prefix='async-io')
+
+# Состояние диалогов общее с синхронным режимом. AsyncTeleBot не поддерживает
+# register_next_step_handler, поэтому следующий шаг тоже хранится в нём
+states = services.states
+# Исходящие сообщения ставятся в очередь с ограничением скорости (sender.py),
+# поэтому обработчики их не ждут
+sender = services.sender
+
+
+async def offload(func, *args, **kwargs):
+    # Контекст логирования (chat_id, шаг) переносится в поток пула
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def register_next_step_handler(message, handler, *args):
+    await offload(states.set_step, message.chat.id, handler.__name__, *args)
+
+
+class HasStepFilter(SimpleCustomFilter):
+    # Без кэша состояний проверка идёт в базу, поэтому тоже в пуле потоков, а не в цикле событий
+    key = 'has_step'
+
+    async def check(self, message):
+        return await offload(states.has_step, message.chat.id)
+
+
+bot.add_custom_filter(HasStepFilter())
+
+
+@bot.message_handler(has_step=True, content_types=['text', 'contact'])
+async def next_step(message):
+    step, args = await offload(states.pop_step, message.chat.id)
+    if step in STEPS:
+        try:
+            await STEPS[step](message, *args)
+        except CalendarUnavailable:
+            # Шаг не меняется: тот же ответ можно отправить ещё раз
+            sender.send_message(message.chat.id, keyboards.CALENDAR_UNAVAILABLE)
+            await offload(states.set_step, message.chat.id, step, *args)
+
+
+@metrics.step
+@log_setup.step
+async def create_event(message):
+    sender.send_message(message.chat.id, "Выберите тип услуги:", reply_markup=keyboards.service_type_markup())
+    await register_next_step_handler(message, get_service_type)
+
+
+@metrics.step
+@log_setup.step
+async def get_service_type(message):
+    if message.text == "Назад":
+        await start(message)
+        return
+
+    service_type = message.text
+    duration_hours = keyboards.SERVICE_TYPES.get(service_type)
+    if duration_hours is None:
+        sender.send_message(message.chat.id, "Пожалуйста, выберите один из предложенных вариантов.")
+        await register_next_step_handler(message, get_service_type)
+        return
+
+    await offload(states.create, message.chat.id, service_type=service_type, duration_hours=duration_hours)
+    sender.send_message(message.chat.id, "Введите модель машины:", reply_markup=keyboards.back_markup())
+    await register_next_step_handler(message, get_summary)
+
+
+@metrics.step
+@log_setup.step
+async def get_summary(message):
+    if message.text == "Назад":
+        await create_event(message)
+        return
+
+    await offload(states.update, message.chat.id, summary=message.text)
+    sender.send_message(message.chat.id, "Введите номер телефона или отправьте его через контакт:",
+                        reply_markup=keyboards.phone_markup())
+    await register_next_step_handler(message, get_description)
+
+
+@metrics.step
+@log_setup.step
+async def get_description(message):
+    if message.text == "Назад":
+        await get_service_type(message)
+        return
+
+    if message.contact:
+        description = message.contact.phone_number
+    else:
+        description = message.text
+
+    if not re.match(r'^(\+7|8)\d{10}$', description) and not re.match(r'^\+?\d{11,15}$', description):
+        sender.send_message(message.chat.id, "Неверный формат номера телефона. Пожалуйста, введите номер в формате +7XXXXXXXXXX, 8XXXXXXXXXX или международном формате.")
+        await register_next_step_handler(message, get_description)
+        return
+
+    state = await offload(states.update, message.chat.id, description=description,
+                          username=message.from_user.username)  # Сохраняем username
+    sender.send_message(message.chat.id, "Выберите дату:", reply_markup=await create_date_markup(state.duration_hours))
+    await register_next_step_handler(message, get_date)
+
+
+async def create_date_markup(duration_hours):
+    return keyboards.date_markup(await offload(services.get_available_dates, duration_hours))
+
+
+def parse_date(text):
+    # Убираем день недели
+    date_str = re.sub(r'^[А-Яа-я]+\s+', '', text.strip())
+    return datetime.datetime.strptime(date_str, "%d.%m.%y").replace(tzinfo=UTC_PLUS_4)
+
+
+@metrics.step
+@log_setup.step
+async def get_date(message):
+    if message.text == "Назад":
+        await get_summary(message)
+        return
+
+    try:
+        date = parse_date(message.text)
+    except ValueError:
+        sender.send_message(message.chat.id, "Неверный формат даты. Пожалуйста, выберите дату из предложенных вариантов.")
+        await register_next_step_handler(message, get_date)
+        return
+
+    state = await offload(states.update, message.chat.id, date=date)
+    available_slots = await offload(services.get_available_slots, date, state.duration_hours)
+    if available_slots:
+        sender.send_message(message.chat.id, "Выберите время:", reply_markup=keyboards.time_markup(available_slots))
+        await register_next_step_handler(message, get_time)
+    else:
+        sender.send_message(message.chat.id, "На выбранную дату нет свободных слотов. Пожалуйста, выберите другую дату.")
+        await register_next_step_handler(message, get_date)
+
+
+@metrics.step
+@log_setup.step
+async def get_time(message):
+    if message.text == "Назад":
+        await get_date(message)
+        return
+
+    time_str = message.text
+    try:
+        datetime.datetime.strptime(time_str, "%H:%M")
+    except ValueError:
+        sender.send_message(message.chat.id, "Неверный формат времени. Пожалуйста, выберите время из предложенных вариантов.")
+        await register_next_step_handler(message, get_time)
+        return
+
+    state = await offload(states.update, message.chat.id, time=time_str)
+    try:
+        # Слот бронируется вместе с заявкой, пока администратор её не рассмотрит
+        request_id = await offload(services.create_request, message.chat.id, state.username,
+                                   state.duration_hours, state.summary, state.description,
+                                   state.service_type, state.date.strftime('%Y-%m-%d'), time_str)
+    except SlotTaken:
+        available_slots = await offload(services.get_available_slots, state.date, state.duration_hours)
+        sender.send_message(message.chat.id, "Это время уже занято. Пожалуйста, выберите другое время.",
+                            reply_markup=keyboards.time_markup(available_slots))
+        await register_next_step_handler(message, get_time)
+        return
+    log_setup.bind(request_id=request_id)
+
+    # Сохраняем лид в Google Sheets
+    await offload(services.leads.save_lead, state.summary, state.description, state.username, request_id)
+
+    if config.ADMIN_NOTIFY_EACH:
+        await send_admin_notification(request_id, is_new=True)
+    sender.send_message(message.chat.id, "Ваша заявка отправлена на рассмотрение администратору.")
+    # Заявка сохранена — состояние диалога больше не нужно
+    await offload(states.delete, message.chat.id)
+
+
+async def send_admin_notification(request_id, is_new=False):
+    request = await offload(services.requests_repo.get, request_id)
+    # Неотправленное уведомление по той же заявке заменяется новым
+    sender.send_message(admin_id, keyboards.admin_request_text(request, is_new),
+                        reply_markup=keyboards.admin_request_markup(request_id), key=('request', request_id))
+
+
+def is_admin(chat_id):
+    return str(chat_id) == str(admin_id)
+
+
+def queue_view(page, selected):
+    requests, page, pages, total = services.pending_page(page)
+    return (keyboards.queue_text(requests, page, pages, total, selected),
+            keyboards.queue_markup(requests, page, pages, selected))
+
+
+def leads_statuses(requests, status):
+    return [(request[4], request[5], status, request[0]) for request in requests]
+
+
+# Регистрируется раньше общего обработчика кнопок заявок
+@bot.callback_query_handler(func=lambda call: call.data.startswith('queue_') and is_admin(call.message.chat.id))
+@metrics.step
+@log_setup.step
+async def handle_queue_callback(call):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    data = call.data.split('_')
+    action, page = data[1], int(data[-1])
+    state = await offload(states.get, chat_id)
+    selected = set(state.selected or []) if state else set()
+
+    if action == "toggle":
+        selected ^= {int(data[2])}
+    elif action == "page":
+        # Возврат к очереди из статусов пакета
+        await offload(services.approval_jobs.detach, chat_id, message_id)
+    elif action == "approve":
+        # Выбранные заявки одобряются одним пакетом; события, уведомления клиентов и
+        # статусы в таблице — в заданиях одобрения, их ход показывается в этом сообщении
+        approved, taken = await offload(services.approve_requests, sorted(selected), chat_id, message_id)
+        for request, _ in approved:
+            sender.discard(('request', request[0]))
+        if taken:
+            sender.send_message(admin_id, f"Время уже занято по заявкам: {', '.join(f'#{i}' for i in taken)}. Измените дату или время заявок.")
+        logger.info("Заявки одобрены: %s", [request[0] for request, _ in approved])
+        await offload(states.update, chat_id, selected=[])
+        if approved:
+            return
+        selected = set()
+    elif action == "reject":
+        rejected = await offload(services.reject_requests, sorted(selected))
+        for request in rejected:
+            sender.discard(('request', request[0]))
+            sender.send_message(request[1], "Ваша заявка отклонена.")
+        await offload(services.leads.update_statuses, leads_statuses(rejected, "Отклонено"))
+        logger.info("Заявки отклонены: %s", [request[0] for request in rejected])
+        selected = set()
+
+    await offload(states.update, chat_id, selected=sorted(selected))
+    text, markup = await offload(queue_view, page, selected)
+    # Быстрые нажатия подряд сливаются в одно редактирование сообщения
+    sender.edit_message_text(chat_id, message_id, text, reply_markup=markup, key=('queue', message_id))
+
+
+@bot.callback_query_handler(func=lambda call: True)
+@metrics.step
+@log_setup.step
+async def handle_callback_query(call):
+    action, request_id = call.data.split('_')[:2]
+    request_id = int(request_id)
+    log_setup.bind(request_id=request_id)
+
+    request = await offload(services.requests_repo.get, request_id)
+    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:9]
+    # Уведомления по заявке, которые ещё ждут отправки, устарели
+    sender.discard(('request', request_id))
+
+    if action in ("approve", "reject", "change") and request[11] != STATUS_PENDING:
+        # Заявку уже рассмотрели, например пакетом из /queue
+        sender.delete_message(chat_id=admin_id, message_id=call.message.message_id)
+        sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена.")
+        return
+
+    if action == "approve":
+        # Событие, уведомление клиента и статус в таблице — в задании одобрения;
+        # ход задания показывается в этом же сообщении администратора
+        try:
+            await offload(services.approve_request, request_id, admin_id, call.message.message_id)
+        except RequestNotPending:
+            sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена.")
+            return
+        except SlotTaken:
+            sender.send_message(admin_id, f"Время по заявке {request_id} уже занято. Измените дату или время заявки.")
+            return
+        logger.info("Заявка %s одобрена", request_id)
+    elif action == "reject":
+        rejected = await offload(services.reject_request, request_id)
+        sender.delete_message(chat_id=admin_id, message_id=call.message.message_id)
+        if not rejected:
+            sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена.")
+            return
+        sender.send_message(user_id, "Ваша заявка отклонена.")
+        logger.info("Заявка %s отклонена", request_id)
+        await offload(services.leads.update_status, summary, description, "Отклонено", request_id)
+    elif action == "change":
+        try:
+            markup = await create_date_markup(duration_hours)
+        except CalendarUnavailable:
+            sender.send_message(admin_id, keyboards.CALENDAR_UNAVAILABLE)
+            return
+        sender.delete_message(chat_id=admin_id, message_id=call.message.message_id)
+        sender.send_message(admin_id, "Выберите новую дату:", reply_markup=markup)
+        await register_next_step_handler(call.message, get_admin_date, request_id, duration_hours)
+        logger.info("Заявка %s изменена", request_id)
+
+
+@metrics.step
+@log_setup.step
+async def get_admin_date(message, request_id, duration_hours):
+    if message.text == "Назад":
+        await send_admin_notification(request_id, is_new=False)
+        return
+
+    try:
+        date = parse_date(message.text)
+    except ValueError:
+        sender.send_message(admin_id, "Неверный формат даты. Пожалуйста, выберите дату из предложенных вариантов.")
+        await register_next_step_handler(message, get_admin_date, request_id, duration_hours)
+        return
+
+    available_slots = await offload(services.get_available_slots, date, duration_hours)
+    if available_slots:
+        sender.send_message(admin_id, "Выберите новое время:", reply_markup=keyboards.time_markup(available_slots))
+        await register_next_step_handler(message, get_admin_time, request_id, duration_hours, date)
+    else:
+        sender.send_message(admin_id, "На выбранную дату нет свободных слотов. Пожалуйста, выберите другую дату.")
+        await register_next_step_handler(message, get_admin_date, request_id, duration_hours)
+
+
+@metrics.step
+@log_setup.step
+async def get_admin_time(message, request_id, duration_hours, date):
+    if message.text == "Назад":
+        sender.send_message(admin_id, "Выберите новую дату:", reply_markup=await create_date_markup(duration_hours))
+        await register_next_step_handler(message, get_admin_date, request_id, duration_hours)
+        return
+
+    time_str = message.text
+    try:
+        datetime.datetime.strptime(time_str, "%H:%M")
+    except ValueError:
+        sender.send_message(admin_id, "Неверный формат времени. Пожалуйста, выберите время из предложенных вариантов.")
+        await register_next_step_handler(message, get_admin_time, request_id, duration_hours, date)
+        return
+
+    try:
+        await offload(services.move_request, request_id, duration_hours, date.strftime('%Y-%m-%d'), time_str)
+    except RequestNotPending:
+        sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена, перенос отменён.")
+        return
+    except SlotTaken:
+        available_slots = await offload(services.get_available_slots, date, duration_hours)
+        sender.send_message(admin_id, "Это время уже занято. Пожалуйста, выберите другое время.",
+                            reply_markup=keyboards.time_markup(available_slots))
+        await register_next_step_handler(message, get_admin_time, request_id, duration_hours, date)
+        return
+    sender.delete_message(chat_id=admin_id, message_id=message.message_id)
+
+    # Отправляем заявку на повторное рассмотрение администратору
+    await send_admin_notification(request_id, is_new=False)
+
+
+@bot.message_handler(commands=['start'])
+async def start(message):
+    sender.send_message(message.chat.id, "Приветственное сообщение", reply_markup=keyboards.start_markup())
+
+
+@bot.message_handler(commands=['queue'], func=lambda message: is_admin(message.chat.id))
+async def show_queue(message):
+    # Очередь заявок на рассмотрении с выбором нескольких заявок
+    await offload(states.update, message.chat.id, selected=[])
+    text, markup = await offload(queue_view, 0, set())
+    sender.send_message(message.chat.id, text, reply_markup=markup)
+
+
+@bot.message_handler(commands=['jobs'], func=lambda message: is_admin(message.chat.id))
+async def show_jobs(message):
+    jobs = await offload(services.approval_jobs.recent)
+    sender.send_message(message.chat.id, keyboards.jobs_text(jobs))
+
+
+@bot.message_handler(commands=['retry'], func=lambda message: is_admin(message.chat.id))
+async def retry_jobs(message):
+    # /retry 12 — вернуть в очередь неудавшееся задание одобрения, /retry — все неудавшиеся
+    parts = message.text.split()
+    if len(parts) > 1 and not parts[1].isdigit():
+        sender.send_message(message.chat.id, "Укажите номер задания, например: /retry 12")
+        return
+    job_id = int(parts[1]) if len(parts) > 1 else None
+    job_ids = await offload(services.retry_approvals, job_id)
+    sender.send_message(message.chat.id, keyboards.retry_text(job_ids, job_id))
+
+
+@bot.message_handler(commands=['stats'], func=lambda message: is_admin(message.chat.id))
+@metrics.step
+@log_setup.step
+async def show_stats(message):
+    try:
+        days = keyboards.period_days(message.text, config.STATS_DEFAULT_DAYS)
+    except ValueError:
+        sender.send_message(message.chat.id, keyboards.period_help("stats"))
+        return
+    sender.send_message(message.chat.id, await offload(services.stats, days))
+
+
+@bot.message_handler(commands=['export'], func=lambda message: is_admin(message.chat.id))
+@metrics.step
+@log_setup.step
+async def export_requests(message):
+    try:
+        days = keyboards.period_days(message.text, None)
+    except ValueError:
+        sender.send_message(message.chat.id, keyboards.period_help("export"))
+        return
+    document, name, count = await offload(services.export, days)
+    sender.send_document(message.chat.id, document, visible_file_name=name, caption=f"Заявок: {count}")
+    logger.info("Выгружено заявок: %s", count)
+
+
+@bot.message_handler(commands=['noshow'], func=lambda message: is_admin(message.chat.id))
+async def mark_no_show(message):
+    # /noshow 123 — клиент по одобренной заявке не приехал
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        sender.send_message(message.chat.id, "Укажите номер заявки, например: /noshow 123")
+        return
+    if await offload(services.mark_no_show, int(parts[1])):
+        sender.send_message(message.chat.id, f"Заявка {parts[1]} отмечена: клиент не приехал.")
+    else:
+        sender.send_message(message.chat.id, f"Заявка {parts[1]} не найдена среди одобренных.")
+
+
+@bot.message_handler(content_types=['text'])
+async def func(message):
+    if message.text == "Записаться":
+        await create_event(message)
+    elif message.text == "Контакты":
+        sender.send_message(message.chat.id, "123")
+
+
+# Шаги сценария, на которые может указывать сохранённое состояние. Таблица состояний
+# общая с main.py, поэтому имена и аргументы шагов в обоих режимах одинаковые
+STEPS = {handler.__name__: handler for handler in (
+    get_service_type, get_summary, get_description, get_date, get_time, get_admin_date, get_admin_time)}
+
+
+def run():
+    logger.info("Асинхронный режим")
+    asyncio.run(bot.infinity_polling())
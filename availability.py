@@ -0,0 +1,214 @@
+import datetime
+import threading
+import time
+
+import metrics
+import slots
+
+# Кэш доступности по (дата, длительность).
+# Для каждого дня хранятся слитые занятые интервалы каждого поста и битовая
+# маска слотов по сетке от полуночи: бит k — слот в 00:00 + k * 30 минут.
+# Маска дня — OR масок постов, то есть слот есть, если свободен хотя бы один пост.
+# Кэш сбрасывается только для дней, затронутых изменениями календаря или броней,
+# а день с неподтверждёнными бронями — ещё и когда истекает первая из них.
+
+DURATIONS = (0.5, 1.0, 1.5)
+
+
+def to_bitmap(starts, origin, step=slots.SLOT_STEP_MINUTES):
+    bitmap = 0
+    for minute in starts:
+        bitmap |= 1 << ((minute - origin) // step)
+    return bitmap
+
+
+def from_bitmap(bitmap, origin, step=slots.SLOT_STEP_MINUTES):
+    starts = []
+    k = 0
+    while bitmap:
+        if bitmap & 1:
+            starts.append(origin + k * step)
+        bitmap >>= 1
+        k += 1
+    return starts
+
+
+def holds_by_day(holds, tz):
+    # [(resource_id, start_ts, end_ts, expires_at)] -> {день: брони}
+    days = {}
+    for hold in holds:
+        days.setdefault(datetime.datetime.fromtimestamp(hold[1], tz).date(), []).append(hold)
+    return days
+
+
+class DayAvailability(object):
+    # windows — {resource_id: (first, close)} полного дня, busy — {resource_id: слитые интервалы}
+    __slots__ = ('origin', 'windows', 'busy', 'bitmaps', 'expires')
+
+    def __init__(self, origin, windows, busy, expires=None):
+        self.origin = origin
+        self.windows = windows
+        self.busy = busy
+        self.bitmaps = {}
+        self.expires = expires
+
+    def is_fresh(self, now):
+        return self.expires is None or now < self.expires
+
+    def bitmap(self, duration_hours):
+        bitmap = self.bitmaps.get(duration_hours)
+        if bitmap is None:
+            duration = round(duration_hours * 60)
+            bitmap = 0
+            for resource_id, (first, close) in self.windows.items():
+                bitmap |= to_bitmap(slots.free_starts(self.busy[resource_id], first, close, duration), self.origin)
+            self.bitmaps[duration_hours] = bitmap
+        return bitmap
+
+    def sweep(self, windows, duration_hours):
+        # Начала для произвольных окон: сегодня сетка идёт от текущего времени
+        duration = round(duration_hours * 60)
+        return slots.union_starts([slots.free_starts(self.busy[resource_id], first, close, duration)
+                                   for resource_id, (first, close) in windows.items()])
+
+
+class AvailabilityCache(object):
+
+    def __init__(self, resources, load_range, tz, durations=DURATIONS, load_holds=None):
+        # load_range(calendar_ids, time_min, time_max) возвращает {calendar_id: события за окно},
+        # load_holds(first_day, last_day) — действующие брони [(resource_id, start_ts, end_ts, expires_at)]
+        self.resources = list(resources)
+        self.calendar_ids = list(dict.fromkeys(resource.calendar_id for resource in self.resources))
+        self.load_range = load_range
+        self.load_holds = load_holds
+        self.tz = tz
+        self.durations = durations
+        self.lock = threading.Lock()
+        self.days = {}
+        self.versions = {}
+        self.generation = 0
+
+    def invalidate(self, dates=None):
+        # dates=None — сбросить весь кэш (например, после полной синхронизации)
+        with self.lock:
+            if dates is None:
+                self.days.clear()
+                self.versions.clear()
+                self.generation += 1
+                return
+            for day in dates:
+                self.days.pop(day, None)
+                self.versions[day] = self.versions.get(day, 0) + 1
+
+    def _version(self, day):
+        return self.generation, self.versions.get(day, 0)
+
+    def _holds(self, first_day, last_day):
+        return self.load_holds(first_day, last_day) if self.load_holds is not None else []
+
+    def _windows(self, date, now):
+        return {resource.id: slots.resource_window(date, self.tz, resource, now) for resource in self.resources}
+
+    def _day_start(self, day):
+        return datetime.datetime.combine(day, datetime.time(0), tzinfo=self.tz)
+
+    def _build(self, day, events, holds=()):
+        # events — {calendar_id: события дня}
+        day_start = self._day_start(day)
+        held = {}
+        for resource_id, start_ts, end_ts, _ in holds:
+            held.setdefault(resource_id, []).append((start_ts // 60, -(-end_ts // 60)))
+        calendars = {calendar_id: slots.busy_intervals(events.get(calendar_id, []), self.tz)
+                     for calendar_id in self.calendar_ids}
+        busy = {}
+        for resource in self.resources:
+            busy[resource.id] = calendars[resource.calendar_id]
+            if resource.id in held:
+                busy[resource.id] = slots.merge_intervals(busy[resource.id] + held[resource.id])
+        expires = [expires_at for _, _, _, expires_at in holds if expires_at is not None]
+        entry = DayAvailability(slots.to_minute(day_start), self._windows(day_start, day_start), busy,
+                                min(expires) if expires else None)
+        for duration_hours in self.durations:
+            entry.bitmap(duration_hours)
+        return entry
+
+    def _store(self, day, version, entry):
+        with self.lock:
+            # Если день успели сбросить во время расчёта, результат не сохраняем
+            if version == self._version(day):
+                self.days[day] = entry
+                self._prune()
+
+    def _day(self, day):
+        with self.lock:
+            entry = self.days.get(day)
+            if entry is not None and entry.is_fresh(time.time()):
+                metrics.cache('availability', True)
+                return entry
+            version = self._version(day)
+
+        metrics.cache('availability', False)
+        day_start = self._day_start(day)
+        events = self.load_range(self.calendar_ids, day_start, day_start + datetime.timedelta(days=1))
+        entry = self._build(day, events, self._holds(day, day))
+        self._store(day, version, entry)
+        return entry
+
+    def prefetch(self, start, days):
+        # Все недостающие дни окна загружаются одним запросом диапазона на все календари
+        start_day = start.astimezone(self.tz).date()
+        now = time.time()
+        with self.lock:
+            missing = {}
+            for i in range(days):
+                day = start_day + datetime.timedelta(days=i)
+                entry = self.days.get(day)
+                if entry is None or not entry.is_fresh(now):
+                    missing[day] = self._version(day)
+        metrics.CACHE_REQUESTS.labels('availability_prefetch', 'hit').inc(days - len(missing))
+        metrics.CACHE_REQUESTS.labels('availability_prefetch', 'miss').inc(len(missing))
+        if not missing:
+            return
+
+        first, last = min(missing), max(missing)
+        events = self.load_range(self.calendar_ids, self._day_start(first),
+                                 self._day_start(last + datetime.timedelta(days=1)))
+        by_day = {calendar_id: slots.events_by_day(items, self.tz) for calendar_id, items in events.items()}
+        holds = holds_by_day(self._holds(first, last), self.tz)
+        for day, version in missing.items():
+            day_events = {calendar_id: days.get(day, []) for calendar_id, days in by_day.items()}
+            self._store(day, version, self._build(day, day_events, holds.get(day, [])))
+
+    def _prune(self):
+        today = datetime.datetime.now(self.tz).date()
+        if len(self.days) > 64:
+            for day in [day for day in self.days if day < today]:
+                del self.days[day]
+                self.versions.pop(day, None)
+
+    def _partial_windows(self, entry, date, now):
+        # None — день целиком впереди и годится маска; иначе окна постов от текущего времени
+        if now is None:
+            now = datetime.datetime.now(self.tz)
+        if slots.to_minute(now) <= min(first for first, _ in entry.windows.values()):
+            return None
+        return self._windows(date, now)
+
+    def free_starts(self, date, duration_hours, now=None):
+        date = date.astimezone(self.tz)
+        entry = self._day(date.date())
+        windows = self._partial_windows(entry, date, now)
+        if windows is None:
+            return from_bitmap(entry.bitmap(duration_hours), entry.origin)
+        return entry.sweep(windows, duration_hours)
+
+    def has_slots(self, date, duration_hours, now=None):
+        date = date.astimezone(self.tz)
+        entry = self._day(date.date())
+        windows = self._partial_windows(entry, date, now)
+        if windows is None:
+            return entry.bitmap(duration_hours) != 0
+        return bool(entry.sweep(windows, duration_hours))
+
+    def get_slots(self, date, duration_hours, now=None):
+        return [slots.from_minute(minute, self.tz) for minute in self.free_starts(date, duration_hours, now)]
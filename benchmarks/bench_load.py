@@ -0,0 +1,341 @@
+# Нагрузочный прогон сценария записи без сети.
+# N пользователей одновременно проходят весь сценарий (/start → тип услуги →
+# модель → телефон → дата → время), затем администратор одобряет каждую заявку.
+# Telegram, Google Calendar и Google Sheets заменены заглушками из fakes.py
+# с задержками и квотами. Обновления отправляются POST-запросами в вебхук бота,
+# запущенный на свободном локальном порту, и проходят его очередь и воркеры.
+# Задержка шага — от отправки обновления до ответа пользователю
+# (включая очередь исходящих сообщений). Нужен установленный telebot.
+# Запуск: python benchmarks/bench_load.py --users 50 [--json результат.json]
+# Проверка регрессий: python benchmarks/bench_load.py --baseline benchmarks/baseline.json
+# (параметры прогона берутся из baseline, код выхода 1 — результат хуже допуска)
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+STEPS = ('start', 'create_event', 'get_service_type', 'get_summary', 'get_description', 'get_date', 'get_time',
+         'approve')
+SERVICE_TYPES = ('Замена масла', 'Чистка салона', 'Ремонт двигателя')
+REPLY_TIMEOUT = 60
+# Параметры прогона, которые сохраняются в baseline и берутся из него при сравнении
+BASELINE_ARGS = ('users', 'think', 'latency_scale', 'telegram_latency', 'calendar_latency', 'sheets_latency',
+                 'calendar_qps', 'seed')
+# Допуски по умолчанию. Пропускная способность и p99 зависят от машины и повторов после 429,
+# поэтому допуск относительный и широкий, а к p99 добавляется ещё одна пауза после 429 (1 с);
+# число вызовов API почти не зависит от машины и сравнивается с абсолютным допуском на запись
+TOLERANCE = {'bookings_per_second': 0.5, 'p99_ms': 1.0, 'p99_slack_ms': 1000, 'calls_per_booking': 0.5}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def button_texts(markup):
+    texts = []
+    for row in getattr(markup, 'keyboard', None) or []:
+        for button in row:
+            if isinstance(button, str):
+                texts.append(button)
+            elif isinstance(button, dict):
+                texts.append(button.get('text'))
+            else:
+                texts.append(button.text)
+    return [text for text in texts if text != "Назад"]
+
+
+class Harness(object):
+
+    def __init__(self, main, url, telegram, think):
+        self.main = main
+        self.url = url
+        self.telegram = telegram
+        self.think = think
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.conflicts = 0
+        self.rejected = 0
+        self.failures = []
+
+    def message_update(self, chat_id, text):
+        message = {
+            'message_id': next(self.message_ids), 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user', 'username': f'user{chat_id}'},
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback_update(self, data):
+        return {'update_id': next(self.update_ids), 'callback_query': {
+            'id': str(next(self.update_ids)), 'chat_instance': 'admin', 'data': data,
+            'from': {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'admin'},
+            'message': {'message_id': next(self.message_ids), 'date': int(time.time()), 'text': 'заявка',
+                        'chat': {'id': ADMIN_ID, 'type': 'private'}},
+        }}
+
+    def post(self, update):
+        # Как Telegram: при 503 (очередь вебхука переполнена) доставка повторяется
+        request = urllib.request.Request(self.url, data=json.dumps(update).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        secret = self.main.config.WEBHOOK_SECRET
+        if secret:
+            request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+        while True:
+            try:
+                with urllib.request.urlopen(request, timeout=REPLY_TIMEOUT):
+                    return
+            except urllib.error.HTTPError as error:
+                if error.code != 503:
+                    raise
+                with self.lock:
+                    self.rejected += 1
+                time.sleep(float(error.headers.get('Retry-After', 1)))
+
+    def step(self, step, chat_id, update):
+        # Обновление уходит в вебхук, ответ ждём в чате пользователя
+        index = self.telegram.count(chat_id)
+        started = time.perf_counter()
+        self.post(update)
+        reply = self.telegram.wait(chat_id, index, REPLY_TIMEOUT)
+        if reply is None:
+            raise RuntimeError(f'нет ответа на шаге {step}')
+        with self.lock:
+            self.latencies[step].append(time.perf_counter() - started)
+        if self.think:
+            time.sleep(random.uniform(0, 2 * self.think))
+        return reply
+
+    def say(self, step, chat_id, text):
+        return self.step(step, chat_id, self.message_update(chat_id, text))
+
+    def book(self, number):
+        chat_id = FIRST_USER_ID + number
+        try:
+            self.say('start', chat_id, '/start')
+            self.say('create_event', chat_id, 'Записаться')
+            self.say('get_service_type', chat_id, SERVICE_TYPES[number % len(SERVICE_TYPES)])
+            self.say('get_summary', chat_id, f'Машина {number}')
+            _, markup = self.say('get_description', chat_id, f'+7999{number:07d}')
+            dates = button_texts(markup)
+            if not dates:
+                raise RuntimeError('нет свободных дат')
+            text, markup = self.say('get_date', chat_id, dates[number % len(dates)])
+            times = button_texts(markup)
+            if not times:
+                raise RuntimeError(f'нет свободного времени: {text}')
+            choice = times[number % len(times)]
+            for _ in range(5):
+                text, markup = self.say('get_time', chat_id, choice)
+                if "уже занято" not in text:
+                    break
+                # Слот успел занять другой пользователь — берём первый из предложенных
+                with self.lock:
+                    self.conflicts += 1
+                times = button_texts(markup)
+                if not times:
+                    raise RuntimeError('нет свободного времени после конфликта')
+                choice = times[0]
+            request_id = self.main.services.database.read_one(
+                'SELECT id FROM requests WHERE user_id = ? ORDER BY id DESC LIMIT 1', (chat_id,))[0]
+            text, _ = self.step('approve', chat_id, self.callback_update(f'approve_{request_id}'))
+            if "одобрена" not in text:
+                raise RuntimeError(f'заявка не одобрена: {text}')
+        except Exception as e:
+            with self.lock:
+                self.failures.append((chat_id, str(e)))
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run(args):
+    random.seed(args.seed)
+    calls = fakes.CallLog()
+    telegram = fakes.FakeTelegram(calls, fakes.Latency(args.telegram_latency, scale=args.latency_scale))
+    calendar_service = fakes.FakeCalendarService(calls, fakes.Latency(args.calendar_latency,
+                                                                      scale=args.latency_scale),
+                                                 rate=args.calendar_qps)
+    worksheet = fakes.FakeWorksheet(calls, fakes.Latency(args.sheets_latency, scale=args.latency_scale))
+    fakes.install(calendar_service, worksheet)
+
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp())
+    import config
+    config.DB_PATH = os.path.join(os.getcwd(), 'requests.db')
+    config.BOT_TOKEN = '123456:fake'
+    config.BOT_MODE = 'webhook'
+    config.ADMIN_ID = ADMIN_ID
+    config.METRICS_PORT = 0
+    config.CALENDAR_SYNC_INTERVAL = 1
+    config.SHEETS_FLUSH_INTERVAL = 0.5
+
+    import main
+    logging.disable(logging.INFO)
+    main.sender.bot = telegram
+    main.services.start_background()
+    services = main.services
+    calendar_ids = {resource.calendar_id for resource in services.resources}
+    if not wait_until(lambda: all(services.calendar_store.is_ready(c) for c in calendar_ids), 30):
+        print('календарь не синхронизировался', file=sys.stderr)
+    baseline = calls.snapshot()
+
+    # Порт 0 — свободный порт, выбранный системой
+    server = main.create_webhook_server('127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}{config.WEBHOOK_PATH}'
+
+    harness = Harness(main, url, telegram, args.think)
+    threads = [threading.Thread(target=harness.book, args=(number,)) for number in range(args.users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.dispatcher.stop()
+
+    # Лиды и статусы уходят в таблицу фоновым потоком — дожидаемся их
+    wait_until(lambda: not services.sheets_outbox.due(1) and not services.sheets_outbox.due_statuses(1), 60)
+    main.sender.drain(60)
+
+    bookings = args.users - len(harness.failures)
+    counts = calls.snapshot()
+    per_booking = {name: (count - baseline.get(name, 0)) / max(1, bookings) for name, count in sorted(counts.items())}
+    return {
+        'users': args.users,
+        'bookings': bookings,
+        'failures': harness.failures,
+        'conflicts': harness.conflicts,
+        'webhook_rejected': harness.rejected,
+        'seconds': elapsed,
+        'bookings_per_second': bookings / elapsed if elapsed else 0,
+        'steps': {step: {'p50_ms': percentile(harness.latencies[step], 0.5) * 1000,
+                         'p99_ms': percentile(harness.latencies[step], 0.99) * 1000,
+                         'count': len(harness.latencies[step])}
+                  for step in STEPS if harness.latencies[step]},
+        'calls_per_booking': per_booking,
+    }
+
+
+def report(result):
+    print(f"пользователей: {result['users']}, записей: {result['bookings']}, "
+          f"конфликтов времени: {result['conflicts']}, ошибок: {len(result['failures'])}, "
+          f"отказов вебхука (503): {result['webhook_rejected']}")
+    print(f"время: {result['seconds']:.2f} с, записей в секунду: {result['bookings_per_second']:.2f}")
+    print()
+    print(f'{"шаг":<18} {"p50, мс":>10} {"p99, мс":>10}')
+    for step, stats in result['steps'].items():
+        print(f'{step:<18} {stats["p50_ms"]:>10.1f} {stats["p99_ms"]:>10.1f}')
+    print()
+    print(f'{"вызовов на запись":<30}')
+    for name, count in result['calls_per_booking'].items():
+        print(f'{name:<30} {count:>8.2f}')
+    for chat_id, error in result['failures'][:10]:
+        print(f'ошибка у {chat_id}: {error}')
+
+
+def make_baseline(args, result):
+    return {
+        'args': {name: getattr(args, name) for name in BASELINE_ARGS},
+        'tolerance': TOLERANCE,
+        'bookings_per_second': round(result['bookings_per_second'], 2),
+        'steps': {step: {'p99_ms': round(stats['p99_ms'])} for step, stats in result['steps'].items()},
+        'calls_per_booking': {name: round(count, 2) for name, count in result['calls_per_booking'].items()},
+    }
+
+
+def compare(result, baseline):
+    # Список регрессий относительно baseline; пустой — прогон в допуске
+    tolerance = dict(TOLERANCE, **baseline.get('tolerance', {}))
+    regressions = []
+    minimum = baseline['bookings_per_second'] * (1 - tolerance['bookings_per_second'])
+    if result['bookings_per_second'] < minimum:
+        regressions.append(f"записей в секунду: {result['bookings_per_second']:.2f} < {minimum:.2f}")
+    for step, stats in baseline['steps'].items():
+        maximum = stats['p99_ms'] * (1 + tolerance['p99_ms']) + tolerance['p99_slack_ms']
+        current = result['steps'].get(step)
+        if current is None:
+            regressions.append(f'{step}: нет замеров')
+        elif current['p99_ms'] > maximum:
+            regressions.append(f"{step} p99: {current['p99_ms']:.0f} мс > {maximum:.0f} мс")
+    for name in sorted(set(baseline['calls_per_booking']) | set(result['calls_per_booking'])):
+        maximum = baseline['calls_per_booking'].get(name, 0) + tolerance['calls_per_booking']
+        count = result['calls_per_booking'].get(name, 0)
+        if count > maximum:
+            regressions.append(f'{name} на запись: {count:.2f} > {maximum:.2f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон сценария записи на заглушках')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--think', type=float, default=0.0, help='средняя пауза пользователя между шагами, с')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='множитель всех задержек заглушек')
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--calendar-latency', type=float, default=0.15)
+    parser.add_argument('--sheets-latency', type=float, default=0.3)
+    parser.add_argument('--calendar-qps', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='сохранить результат в файл')
+    parser.add_argument('--baseline', help='сравнить с baseline и завершиться с кодом 1 при регрессии')
+    parser.add_argument('--write-baseline', help='сохранить результат как новый baseline')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        for name, value in baseline['args'].items():
+            setattr(args, name, value)
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.write_baseline:
+        with open(args.write_baseline, 'w', encoding='utf-8') as f:
+            json.dump(make_baseline(args, result), f, ensure_ascii=False, indent=2)
+            f.write('\n')
+    failed = bool(result['failures'])
+    if baseline is not None:
+        regressions = compare(result, baseline)
+        print()
+        if regressions:
+            print('регрессии относительно baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            failed = True
+        else:
+            print('в пределах baseline')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Микробенчмарк движка слотов против прежнего цикла по 30-минутным кандидатам.
+# Запуск: python benchmarks/bench_slots.py
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import slots
+from availability import AvailabilityCache
+
+UTC_PLUS_4 = datetime.timezone(datetime.timedelta(hours=4))
+
+
+def legacy_available_slots(date, duration_hours, events, now):
+    # Копия прежней реализации get_available_slots без похода в календарь
+    start_of_day = max(date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=UTC_PLUS_4), now)
+    end_of_day = date.replace(hour=22, minute=0, second=0, microsecond=0, tzinfo=UTC_PLUS_4)
+
+    events.sort(key=lambda x: datetime.datetime.fromisoformat(x['start']['dateTime']).astimezone(UTC_PLUS_4))
+
+    def is_slot_free(start_time, end_time):
+        for event in events:
+            event_start = datetime.datetime.fromisoformat(event['start']['dateTime']).astimezone(UTC_PLUS_4)
+            event_end = datetime.datetime.fromisoformat(event['end']['dateTime']).astimezone(UTC_PLUS_4)
+            if not (end_time <= event_start or start_time >= event_end):
+                return False
+        return True
+
+    current_time = slots.round_to_nearest_5_minutes(start_of_day)
+    available_slots = []
+    while current_time < end_of_day:
+        end_time = current_time + datetime.timedelta(hours=duration_hours)
+        if end_time > end_of_day:
+            break
+        if is_slot_free(current_time, end_time):
+            available_slots.append(current_time)
+        current_time += datetime.timedelta(minutes=30)
+    return available_slots
+
+
+def make_events(date, count, rng):
+    # Короткие события, чтобы в рабочем дне оставались свободные окна
+    events = []
+    day_start = date.replace(hour=8, minute=0, second=0, microsecond=0)
+    for i in range(count):
+        start = day_start + datetime.timedelta(minutes=rng.randrange(0, 16 * 60))
+        end = start + datetime.timedelta(minutes=rng.choice([1, 2, 3, 5]))
+        events.append({'id': str(i), 'start': {'dateTime': start.isoformat()}, 'end': {'dateTime': end.isoformat()}})
+    return events
+
+
+def main():
+    rng = random.Random(42)
+    now = datetime.datetime(2024, 1, 1, 9, 0, tzinfo=UTC_PLUS_4)
+    date = now + datetime.timedelta(days=1)
+    durations = [0.5, 1.0, 1.5]
+
+    for count in (10, 100, 300, 1000):
+        events = make_events(date, count, rng)
+        for duration_hours in durations:
+            expected = legacy_available_slots(date, duration_hours, list(events), now)
+            actual = slots.free_slots(date, duration_hours, events, UTC_PLUS_4, now)
+            assert expected == actual, (count, duration_hours)
+
+        number = 20
+        legacy = timeit.timeit(lambda: [legacy_available_slots(date, d, list(events), now) for d in durations],
+                               number=number) / number
+        engine = timeit.timeit(lambda: slots.batch_free_starts(
+            slots.build_schedules([date], events, UTC_PLUS_4, now), durations, UTC_PLUS_4), number=number) / number
+        print(f"{count:5d} событий: прежний цикл {legacy * 1000:9.3f} мс, движок {engine * 1000:7.3f} мс, "
+              f"ускорение x{legacy / engine:.1f}")
+
+    # 30 дней по 300 событий, все длительности одним пакетом
+    dates = [date + datetime.timedelta(days=i) for i in range(30)]
+    events = [e for d in dates for e in make_events(d, 300, rng)]
+    number = 5
+    engine = timeit.timeit(lambda: slots.batch_free_starts(
+        slots.build_schedules(dates, events, UTC_PLUS_4, now), durations, UTC_PLUS_4), number=number) / number
+    print(f"30 дней x 300 событий x {len(durations)} длительности: движок {engine * 1000:.3f} мс")
+
+    # 36 постов с разными рабочими часами, 30 дней по 20 событий на пост
+    resources = [slots.Resource(f'bay{i}', f'calendar{i}', work_start=8 + i % 4, work_end=18 + i % 5)
+                 for i in range(36)]
+    calendars = {resource.calendar_id: [e for d in dates for e in make_events(d, 20, rng)] for resource in resources}
+
+    def load_range(calendar_ids, time_min, time_max):
+        return {calendar_id: calendars[calendar_id] for calendar_id in calendar_ids}
+
+    def build_cache():
+        cache = AvailabilityCache(resources, load_range, UTC_PLUS_4)
+        cache.prefetch(date, len(dates))
+        return cache
+
+    number = 3
+    build = timeit.timeit(build_cache, number=number) / number
+    cache = build_cache()
+    number = 1000
+    query = timeit.timeit(lambda: [cache.has_slots(d, 1.5, now) for d in dates], number=number) / number
+    print(f"{len(resources)} постов x 30 дней: построение кэша {build * 1000:.3f} мс, "
+          f"проверка 30 дней {query * 1000:.3f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# Время от запуска процесса до ответа на первое обновление (/start).
+# Google Calendar и Google Sheets заменены локальными заглушками с задержками,
+# похожими на сетевые, поэтому бенчмарк не ходит в сеть. Нужен установленный telebot.
+# Режимы:
+#   before — как раньше: все клиенты создаются до опроса, описание Calendar API запрашивается по сети
+#   eager  — все клиенты создаются до опроса, описание API из копии в библиотеке
+#   lazy   — клиенты создаются при первом обращении (текущее поведение)
+# Запуск: python benchmarks/bench_startup.py
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('before', 'eager', 'lazy')
+RUNS = 3
+
+# Задержки заглушек, секунды
+CREDENTIALS_LOAD = 0.02
+DISCOVERY_FETCH = 0.8
+STATIC_DISCOVERY_LOAD = 0.05
+SHEETS_LOGIN = 0.6
+SHEETS_OPEN = 0.4
+API_CALL = 0.15
+
+
+def install_stubs(mode):
+    # Модули Google подменяются в sys.modules до импорта бота
+    google = types.ModuleType('google')
+    oauth2 = types.ModuleType('google.oauth2')
+    service_account = types.ModuleType('google.oauth2.service_account')
+
+    class Credentials(object):
+        @classmethod
+        def from_service_account_file(cls, filename, scopes=None):
+            time.sleep(CREDENTIALS_LOAD)
+            return cls()
+
+    service_account.Credentials = Credentials
+    google.oauth2 = oauth2
+    oauth2.service_account = service_account
+
+    class HttpError(Exception):
+        def __init__(self, resp=None, content=b''):
+            super().__init__(content)
+            self.resp = resp
+
+    class Request(object):
+        def __init__(self, result):
+            self.result = result
+
+        def execute(self, **kwargs):
+            time.sleep(API_CALL)
+            return self.result
+
+    class Events(object):
+        def list(self, **params):
+            return Request({'items': [], 'nextSyncToken': 'token'})
+
+        def insert(self, calendarId, body, **kwargs):
+            return Request(dict(body, id='event'))
+
+    class Service(object):
+        def events(self):
+            return Events()
+
+    def build(name, version, credentials=None, static_discovery=None, cache_discovery=True):
+        if static_discovery and mode != 'before':
+            time.sleep(STATIC_DISCOVERY_LOAD)
+        else:
+            time.sleep(DISCOVERY_FETCH)
+        return Service()
+
+    googleapiclient = types.ModuleType('googleapiclient')
+    discovery = types.ModuleType('googleapiclient.discovery')
+    errors = types.ModuleType('googleapiclient.errors')
+    discovery.build = build
+    errors.HttpError = HttpError
+    googleapiclient.discovery = discovery
+    googleapiclient.errors = errors
+
+    class Worksheet(object):
+        def append_rows(self, rows):
+            time.sleep(API_CALL)
+            return {'updates': {'updatedRange': f'Sheet1!A2:D{1 + len(rows)}'}}
+
+        def batch_update(self, updates):
+            time.sleep(API_CALL)
+
+        def get_all_values(self):
+            time.sleep(API_CALL)
+            return []
+
+    class Spreadsheet(object):
+        sheet1 = Worksheet()
+
+    class Client(object):
+        def open_by_key(self, key):
+            time.sleep(SHEETS_OPEN)
+            return Spreadsheet()
+
+    def gspread_service_account(filename=None):
+        time.sleep(SHEETS_LOGIN)
+        return Client()
+
+    gspread = types.ModuleType('gspread')
+    gspread.service_account = gspread_service_account
+
+    sys.modules.update({
+        'google': google, 'google.oauth2': oauth2, 'google.oauth2.service_account': service_account,
+        'googleapiclient': googleapiclient, 'googleapiclient.discovery': discovery,
+        'googleapiclient.errors': errors, 'gspread': gspread,
+    })
+
+
+def first_update(mode):
+    started = time.perf_counter()
+    install_stubs(mode)
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp())
+
+    import config
+    config.DB_PATH = os.path.join(os.getcwd(), 'requests.db')
+    config.BOT_TOKEN = '123456:fake'
+    config.BOT_MODE = 'polling'
+    config.METRICS_PORT = 0
+
+    import main
+    from telebot import types as telebot_types
+
+    # Ответы уходят через очередь исходящих сообщений, у неё свой клиент Telegram
+    answered = threading.Event()
+    main.services.sender.bot.send_message = lambda *args, **kwargs: answered.set()
+    imported = time.perf_counter()
+
+    if mode != 'lazy':
+        # Прежний порядок: подключения к Google до запуска фоновых потоков и опроса
+        main.services.app.worksheet
+        main.services.app.calendar.service
+    main.services.start_background()
+
+    update = telebot_types.Update.de_json({
+        'update_id': 1,
+        'message': {
+            'message_id': 1, 'date': 0, 'text': '/start',
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'user'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    })
+    main.bot.process_new_updates([update])
+    if not answered.wait(30):
+        sys.exit(f'{mode}: нет ответа на /start')
+    finished = time.perf_counter()
+    print(f'{imported - started:.3f} {finished - started:.3f}')
+
+
+def main():
+    print(f'{"режим":<8} {"импорт, с":>10} {"первый ответ, с":>16}')
+    for mode in MODES:
+        results = []
+        for _ in range(RUNS):
+            # Каждый запуск — отдельный процесс, чтобы импорты не кэшировались
+            run = subprocess.run([sys.executable, os.path.abspath(__file__), mode], capture_output=True, text=True)
+            if run.returncode != 0:
+                sys.exit(run.stderr.strip() or f'{mode}: код выхода {run.returncode}')
+            results.append([float(value) for value in run.stdout.split()[-2:]])
+        imported, answered = min(results, key=lambda result: result[1])
+        print(f'{mode:<8} {imported:>10.3f} {answered:>16.3f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        first_update(sys.argv[1])
+    else:
+        main()
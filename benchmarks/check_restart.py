@@ -0,0 +1,60 @@
+# Проверка первой записи после перезапуска.
+# Компоненты приложения создаются лениво, и первое обращение к броням или заданиям
+# одобрения может случиться внутри транзакции потока записи. Скрипт «перезапускает»
+# приложение (новый App над той же базой) и первым действием создаёт заявку, а после
+# следующего перезапуска первым действием одобряет её. Google заменён заглушками
+# из fakes.py, нужен установленный telebot.
+# Запуск: python benchmarks/check_restart.py
+import datetime
+import os
+import sys
+import tempfile
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def restart(services, config):
+    # Новый процесс: свои соединения с базой и ни одного созданного компонента
+    services.app = services.create_app(config)
+    return services.app
+
+
+def main():
+    calls = fakes.CallLog()
+    fakes.install(fakes.FakeCalendarService(calls, fakes.Latency(0)), fakes.FakeWorksheet(calls, fakes.Latency(0)))
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp())
+    import config
+    config.DB_PATH = os.path.join(os.getcwd(), 'requests.db')
+    config.BOT_TOKEN = '123456:fake'
+    import services
+
+    restart(services, config).database  # база уже существует к следующему запуску
+    date = (datetime.datetime.now(services.UTC_PLUS_4) + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+
+    restart(services, config)
+    request_id = services.create_request(1000, 'user', 1, 'BMW', '+79990000000', 'Замена масла', date, '12:00')
+
+    app = restart(services, config)
+    job_id = services.approve_request(request_id)
+
+    status = app.database.read_one('SELECT status FROM requests WHERE id = ?', (request_id,))[0]
+    hold = app.database.read_one('SELECT expires_at FROM slot_holds WHERE request_id = ?', (request_id,))
+    job = app.approval_jobs.get(job_id)
+    errors = []
+    if status != 'approved':
+        errors.append(f'статус заявки {status}')
+    if hold is None or hold[0] is not None:
+        errors.append(f'бронь не подтверждена: {hold}')
+    if job is None or job.request_id != request_id:
+        errors.append('нет задания одобрения')
+    for error in errors:
+        print(f'ошибка: {error}', file=sys.stderr)
+    print('ok' if not errors else 'fail')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# Локальные заменители Telegram Bot API, Google Calendar и Google Sheets для бенчмарков.
+# У каждого — настраиваемая задержка и квота; все вызовы считаются в общем CallLog,
+# чтобы бенчмарк мог показать число внешних вызовов на одну запись.
+import collections
+import datetime
+import itertools
+import random
+import sys
+import threading
+import time
+import types
+
+
+class CallLog(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class Latency(object):
+    # Задержка вызова: mean ± jitter (доля от mean), умноженная на scale
+
+    def __init__(self, mean, jitter=0.5, scale=1.0):
+        self.mean = mean
+        self.jitter = jitter
+        self.scale = scale
+
+    def sleep(self):
+        delay = random.uniform(self.mean * (1 - self.jitter), self.mean * (1 + self.jitter)) * self.scale
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Quota(object):
+    # Ведро токенов: rate вызовов в секунду, не больше burst подряд
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self, cost=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < cost:
+                return False
+            self.tokens -= cost
+            return True
+
+
+class FakeTelegram(object):
+    # Замена TeleBot для MessageSender: те же методы, квоты Telegram (около 30 сообщений
+    # в секунду на бота и 1 в секунду на чат с небольшим всплеском), ответ 429 при превышении
+
+    def __init__(self, calls, latency, rate=30, chat_rate=1, chat_burst=3):
+        self.calls = calls
+        self.latency = latency
+        self.quota = Quota(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_quotas = {}
+        self.condition = threading.Condition()
+        self.messages = collections.defaultdict(list)
+        self.message_ids = itertools.count(1)
+
+    def _call(self, method, chat_id):
+        from telebot import apihelper
+
+        self.calls.add(f'telegram.{method}')
+        self.latency.sleep()
+        with self.condition:
+            chat_quota = self.chat_quotas.get(chat_id)
+            if chat_quota is None:
+                chat_quota = self.chat_quotas[chat_id] = Quota(self.chat_rate, self.chat_burst)
+        if not self.quota.allow() or not chat_quota.allow():
+            self.calls.add('telegram.429')
+            raise apihelper.ApiTelegramException(method, None, {
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}})
+
+    def _record(self, chat_id, text, reply_markup):
+        with self.condition:
+            self.messages[chat_id].append((text, reply_markup))
+            self.condition.notify_all()
+        return types.SimpleNamespace(message_id=next(self.message_ids), chat=types.SimpleNamespace(id=chat_id))
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self._call('send_message', chat_id)
+        return self._record(chat_id, text, reply_markup)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        self._call('edit_message_text', chat_id)
+        return self._record(chat_id, text, reply_markup)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self._call('delete_message', chat_id)
+        return True
+
+    def count(self, chat_id):
+        with self.condition:
+            return len(self.messages[chat_id])
+
+    def wait(self, chat_id, index, timeout):
+        # Сообщение номер index в чат; None — не дождались
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.messages[chat_id]) <= index:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.messages[chat_id][index]
+
+
+class HttpError(Exception):
+
+    def __init__(self, resp, content=b''):
+        super().__init__(content)
+        self.resp = resp
+        self.content = content
+
+
+def http_error(status, reason):
+    return HttpError(types.SimpleNamespace(status=status, reason=reason), reason.encode())
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+class FakeRequest(object):
+
+    def __init__(self, service, method, execute):
+        self.service = service
+        self.method = method
+        self.run = execute
+
+    def execute(self, **kwargs):
+        self.service.call(self.method)
+        return self.run()
+
+
+class FakeEvents(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **params):
+        return FakeRequest(self.service, 'list', lambda: self.service.list_events(params))
+
+    def insert(self, calendarId, body, **kwargs):
+        return FakeRequest(self.service, 'insert', lambda: self.service.insert_event(calendarId, body))
+
+
+class FakeBatch(object):
+    # Один HTTP-запрос; в квоту засчитывается каждый вложенный запрос
+
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests))))
+
+    def execute(self, **kwargs):
+        self.service.call('batch', len(self.requests))
+        for request, callback, request_id in self.requests:
+            self.service.calls.add(f'calendar.batch.{request.method}')
+            try:
+                response, error = request.run(), None
+            except HttpError as e:
+                response, error = None, e
+            if callback is not None:
+                callback(request_id, response, error)
+
+
+class FakeCalendarService(object):
+    # Хранит события в памяти; поддерживает окна timeMin/timeMax и syncToken.
+    # Квота — запросов в секунду (у Calendar API по умолчанию порядка 10 на пользователя)
+
+    def __init__(self, calls, latency, rate=10, burst=20):
+        self.calls = calls
+        self.latency = latency
+        self.quota = Quota(rate, burst)
+        self.lock = threading.Lock()
+        self.events_by_calendar = collections.defaultdict(dict)
+        self.seq = itertools.count(1)
+        self.version = 0
+
+    def call(self, method, cost=1):
+        self.calls.add(f'calendar.{method}')
+        self.latency.sleep()
+        # Пакет больше всплеска ждёт полного ведра, а не отклоняется навсегда
+        if not self.quota.allow(min(cost, self.quota.burst)):
+            self.calls.add('calendar.403')
+            raise http_error(403, 'rateLimitExceeded')
+
+    def events(self):
+        return FakeEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def insert_event(self, calendar_id, body):
+        # Заданный клиентом id должен быть уникален в календаре, повтор — ответ 409
+        with self.lock:
+            if body.get('id') in self.events_by_calendar[calendar_id]:
+                raise http_error(409, 'duplicate')
+            self.version = next(self.seq)
+            event = dict(body, id=body.get('id') or f'event{self.version}', status='confirmed',
+                         version=self.version)
+            self.events_by_calendar[calendar_id][event['id']] = event
+            return dict(event)
+
+    def list_events(self, params):
+        with self.lock:
+            events = list(self.events_by_calendar[params['calendarId']].values())
+            if params.get('syncToken'):
+                since = int(params['syncToken'])
+                items = [event for event in events if event['version'] > since]
+            else:
+                items = events
+                if params.get('timeMin'):
+                    time_min = parse_time(params['timeMin'])
+                    items = [event for event in items if parse_time(event['end']['dateTime']) > time_min]
+                if params.get('timeMax'):
+                    time_max = parse_time(params['timeMax'])
+                    items = [event for event in items if parse_time(event['start']['dateTime']) < time_max]
+            items.sort(key=lambda event: event['start']['dateTime'])
+            return {'items': [dict(event) for event in items], 'nextSyncToken': str(self.version)}
+
+
+class FakeWorksheet(object):
+    # Квота Google Sheets — около 60 запросов в минуту на пользователя
+
+    def __init__(self, calls, latency, per_minute=60):
+        self.calls = calls
+        self.latency = latency
+        self.quota = Quota(per_minute / 60.0, per_minute)
+        self.lock = threading.Lock()
+        self.rows = [['Модель', 'Телефон', 'Username', 'Статус']]
+
+    def call(self, method):
+        self.calls.add(f'sheets.{method}')
+        self.latency.sleep()
+        if not self.quota.allow():
+            self.calls.add('sheets.429')
+            raise Exception('Quota exceeded for quota metric Write requests per minute per user')
+
+    def append_rows(self, rows, **kwargs):
+        self.call('append_rows')
+        with self.lock:
+            start = len(self.rows) + 1
+            self.rows.extend([list(row) for row in rows])
+        return {'updates': {'updatedRange': f'Sheet1!A{start}:D{start + len(rows) - 1}'}}
+
+    def batch_update(self, updates, **kwargs):
+        self.call('batch_update')
+        with self.lock:
+            for update in updates:
+                row = int(update['range'].lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+                if row <= len(self.rows):
+                    self.rows[row - 1][3] = update['values'][0][0]
+
+    def get_all_values(self):
+        self.call('get_all_values')
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+
+def install(calendar_service, worksheet):
+    # Подменяет модули Google в sys.modules; вызывать до импорта бота
+    google = types.ModuleType('google')
+    oauth2 = types.ModuleType('google.oauth2')
+    service_account = types.ModuleType('google.oauth2.service_account')
+
+    class Credentials(object):
+        @classmethod
+        def from_service_account_file(cls, filename, scopes=None):
+            return cls()
+
+    service_account.Credentials = Credentials
+    google.oauth2 = oauth2
+    oauth2.service_account = service_account
+
+    googleapiclient = types.ModuleType('googleapiclient')
+    discovery = types.ModuleType('googleapiclient.discovery')
+    errors = types.ModuleType('googleapiclient.errors')
+    discovery.build = lambda *args, **kwargs: calendar_service
+    errors.HttpError = HttpError
+    googleapiclient.discovery = discovery
+    googleapiclient.errors = errors
+
+    spreadsheet = types.SimpleNamespace(sheet1=worksheet)
+    client = types.SimpleNamespace(open_by_key=lambda key: spreadsheet)
+    gspread = types.ModuleType('gspread')
+    gspread.service_account = lambda filename=None: client
+
+    sys.modules.update({
+        'google': google, 'google.oauth2': oauth2, 'google.oauth2.service_account': service_account,
+        'googleapiclient': googleapiclient, 'googleapiclient.discovery': discovery,
+        'googleapiclient.errors': errors, 'gspread': gspread,
+    })
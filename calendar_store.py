@@ -0,0 +1,194 @@
+import datetime
+import logging
+import threading
+import time
+
+import googleapiclient.errors
+
+import metrics
+
+# Локальное зеркало событий Google Calendar.
+# Слоты считаются только по этой таблице, а актуальность поддерживается
+# инкрементальной синхронизацией (syncToken) в фоновом потоке.
+
+logger = logging.getLogger(__name__)
+
+# События, закончившиеся раньше чем столько дней назад, не храним
+KEEP_PAST_DAYS = 1
+
+
+def parse_event_time(value, tz):
+    if 'dateTime' in value:
+        return datetime.datetime.fromisoformat(value['dateTime']).astimezone(tz)
+    # Событие на весь день
+    day = datetime.date.fromisoformat(value['date'])
+    return datetime.datetime.combine(day, datetime.time(0), tzinfo=tz)
+
+
+def local_dates(start_ts, end_ts, tz):
+    # Дни (по местному времени), которые задевает интервал [start_ts, end_ts)
+    day = datetime.datetime.fromtimestamp(start_ts, tz).date()
+    last = datetime.datetime.fromtimestamp(max(start_ts, end_ts - 1), tz).date()
+    while day <= last:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS calendar_events (
+    calendar_id TEXT,
+    event_id TEXT,
+    start_ts INTEGER,
+    end_ts INTEGER,
+    start TEXT,
+    end TEXT,
+    summary TEXT,
+    PRIMARY KEY (calendar_id, event_id)
+);
+CREATE INDEX IF NOT EXISTS calendar_events_range
+    ON calendar_events (calendar_id, start_ts, end_ts);
+CREATE TABLE IF NOT EXISTS calendar_sync (
+    calendar_id TEXT PRIMARY KEY,
+    sync_token TEXT,
+    synced_at TEXT
+);
+'''
+
+
+class CalendarStore(object):
+
+    def __init__(self, db, tz):
+        self.db = db
+        self.tz = tz
+        self.listeners = []
+        self.db.migrate(lambda conn: conn.executescript(SCHEMA))
+
+    def add_listener(self, callback):
+        # callback(dates) вызывается после изменений; dates=None — изменилось всё
+        self.listeners.append(callback)
+
+    def notify(self, dates):
+        for callback in self.listeners:
+            callback(dates)
+
+    def get_sync_token(self, calendar_id):
+        row = self.db.read_one('SELECT sync_token FROM calendar_sync WHERE calendar_id = ?', (calendar_id,))
+        return row[0] if row else None
+
+    def is_ready(self, calendar_id):
+        return self.get_sync_token(calendar_id) is not None
+
+    def apply(self, calendar_id, items, sync_token=None, full=False):
+        changed = self.db.submit(lambda conn: self._apply(conn, calendar_id, items, sync_token, full)).result()
+        self.notify(None if full else changed)
+
+    def _apply(self, conn, calendar_id, items, sync_token, full):
+        horizon = datetime.datetime.now(self.tz) - datetime.timedelta(days=KEEP_PAST_DAYS)
+        changed = set()
+        if full:
+            conn.execute('DELETE FROM calendar_events WHERE calendar_id = ?', (calendar_id,))
+        for item in items:
+            old = conn.execute('''
+            SELECT start_ts, end_ts FROM calendar_events WHERE calendar_id = ? AND event_id = ?
+            ''', (calendar_id, item['id'])).fetchone()
+            if old:
+                changed.update(local_dates(old[0], old[1], self.tz))
+            if item.get('status') == 'cancelled' or 'start' not in item:
+                conn.execute('DELETE FROM calendar_events WHERE calendar_id = ? AND event_id = ?',
+                             (calendar_id, item['id']))
+                continue
+            start = parse_event_time(item['start'], self.tz)
+            end = parse_event_time(item['end'], self.tz)
+            if end < horizon:
+                continue
+            changed.update(local_dates(int(start.timestamp()), int(end.timestamp()), self.tz))
+            conn.execute('''
+            INSERT OR REPLACE INTO calendar_events (calendar_id, event_id, start_ts, end_ts, start, end, summary)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (calendar_id, item['id'], int(start.timestamp()), int(end.timestamp()),
+                  start.isoformat(), end.isoformat(), item.get('summary', '')))
+        if full:
+            conn.execute('DELETE FROM calendar_events WHERE calendar_id = ? AND end_ts < ?',
+                         (calendar_id, int(horizon.timestamp())))
+        if sync_token:
+            conn.execute('''
+            INSERT OR REPLACE INTO calendar_sync (calendar_id, sync_token, synced_at) VALUES (?, ?, ?)
+            ''', (calendar_id, sync_token, datetime.datetime.now(self.tz).isoformat()))
+        return changed
+
+    def reset(self, calendar_id):
+        self.db.write('DELETE FROM calendar_sync WHERE calendar_id = ?', (calendar_id,))
+
+    def overlaps(self, conn, calendar_id, start_ts, end_ts):
+        # Проверка по зеркалу внутри транзакции записи, без запроса к Calendar API
+        return conn.execute('''
+        SELECT 1 FROM calendar_events WHERE calendar_id = ? AND start_ts < ? AND end_ts > ? LIMIT 1
+        ''', (calendar_id, end_ts, start_ts)).fetchone() is not None
+
+    def get_events(self, calendar_id, time_min, time_max):
+        # Возвращает события в том же виде, что и events().list
+        rows = self.db.read('''
+        SELECT event_id, start, end, summary FROM calendar_events
+        WHERE calendar_id = ? AND start_ts < ? AND end_ts > ?
+        ORDER BY start_ts
+        ''', (calendar_id, int(time_max.timestamp()), int(time_min.timestamp())))
+        return [{'id': event_id, 'summary': summary,
+                 'start': {'dateTime': start}, 'end': {'dateTime': end}}
+                for event_id, start, end, summary in rows]
+
+
+class CalendarSync(threading.Thread):
+
+    def __init__(self, calendar, store, calendar_ids, interval):
+        super().__init__(name='calendar-sync', daemon=True)
+        # Клиент API создаётся лениво, при первой синхронизации уже в этом потоке
+        self.calendar = calendar
+        self.store = store
+        self.calendar_ids = list(calendar_ids)
+        self.interval = interval
+
+    def run(self):
+        # События, созданные ботом, попадают в зеркало сразу при вставке (insert_event),
+        # поэтому внеочередная синхронизация не нужна
+        while True:
+            for calendar_id in self.calendar_ids:
+                try:
+                    self.sync(calendar_id)
+                except Exception as e:
+                    logger.error("Ошибка синхронизации календаря %s: %s", calendar_id, e)
+            time.sleep(self.interval)
+
+    def sync(self, calendar_id):
+        sync_token = self.store.get_sync_token(calendar_id)
+        try:
+            items, next_sync_token = self.fetch_changes(calendar_id, sync_token)
+        except googleapiclient.errors.HttpError as error:
+            if error.resp.status != 410:
+                raise
+            # Токен устарел — нужна полная синхронизация
+            logger.warning("Токен синхронизации календаря %s устарел, выполняется полная синхронизация", calendar_id)
+            self.store.reset(calendar_id)
+            sync_token = None
+            items, next_sync_token = self.fetch_changes(calendar_id, None)
+
+        self.store.apply(calendar_id, items, next_sync_token, full=sync_token is None)
+        if sync_token is None:
+            logger.info("Полная синхронизация календаря %s: %s событий", calendar_id, len(items))
+        elif items:
+            logger.info("Инкрементальная синхронизация календаря %s: %s изменений", calendar_id, len(items))
+
+    def fetch_changes(self, calendar_id, sync_token):
+        items = []
+        page_token = None
+        while True:
+            params = {'calendarId': calendar_id, 'singleEvents': True, 'maxResults': 2500}
+            if sync_token:
+                params['syncToken'] = sync_token
+            if page_token:
+                params['pageToken'] = page_token
+            with metrics.external('calendar', 'sync'):
+                result = self.calendar.service.events().list(**params).execute()
+            items.extend(result.get('items', []))
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return items, result.get('nextSyncToken')
@@ -5,4 +5,61 @@ SCOPES = ['https://www.googleapis.com/auth/calendar', 'https://www.googleapis.co
 CALENDAR_ID = '**'
 SERVICE_ACCOUNT_FILE = '**'
 ADMIN_ID = "**" 
-SHEET_ID = "**"
\ No newline at end of file
+SHEET_ID = "**"
+DB_PATH = 'requests.db'
+DB_GROUP_COMMIT_MAX = 100  # максимум записей в одной групповой транзакции
+STATE_TTL = 24 * 60 * 60  # секунд, после которых брошенный диалог забывается
+STATE_CACHE_SIZE = 10000  # диалогов в памяти; 0 — всегда читать из базы (несколько процессов бота)
+STATE_CLEANUP_INTERVAL = 60 * 60  # секунд между очистками устаревших диалогов
+SHEETS_FLUSH_INTERVAL = 2  # секунд между отправками накопившихся лидов в Google Sheets
+SHEETS_BATCH_SIZE = 500  # строк в одном append_rows
+SHEETS_MAX_BACKOFF = 300  # максимальная задержка повтора при ошибках Google Sheets, секунд
+CALENDAR_SYNC_INTERVAL = 60  # секунд между инкрементальными синхронизациями календаря
+SLOT_HOLD_TTL = 24 * 60 * 60  # секунд, которые слот держится за заявкой до решения администратора
+# Посты мастерской: у каждого свой календарь и рабочие часы (кратные получасу).
+# Слот доступен клиенту, если свободен хотя бы один пост; пост назначается при одобрении
+RESOURCES = [
+    {'id': 'bay1', 'name': 'Пост 1', 'calendar_id': CALENDAR_ID, 'work_start': 10, 'work_end': 22},
+]
+QUEUE_PAGE_SIZE = 8  # заявок на странице /queue
+ADMIN_NOTIFY_EACH = True  # уведомлять администратора о каждой заявке; False — разбор только через /queue
+METRICS_ENABLED = True  # замеры времени и счётчики; False — без накладных расходов
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108  # порт /metrics; 0 — не запускать HTTP-сервер метрик
+LOG_LEVEL = 'INFO'
+LOG_FILE = 'bot.log'
+LOG_FORMAT = 'json'  # формат файла: 'json' (по строке JSON на запись) или 'text'
+LOG_ROTATE = 'size'  # 'size' — по LOG_MAX_BYTES, 'time' — по LOG_ROTATE_WHEN
+LOG_MAX_BYTES = 20 * 1024 * 1024
+LOG_ROTATE_WHEN = 'midnight'
+LOG_BACKUP_COUNT = 7  # сколько старых файлов хранить
+LOG_QUEUE_SIZE = 10000  # записей в очереди логирования; при переполнении новые отбрасываются
+# Доля INFO-записей болтливых логгеров, которая попадает в лог (дочерние логгеры наследуют)
+LOG_SAMPLING = {
+    'google_calendar.events': 0.05,
+}
+APPROVAL_WORKERS = 4  # параллельных заданий одобрения (Calendar и Sheets)
+# Попыток задания, после чего оно помечается как failed и ждёт /retry. Задержка растёт
+# как 2 ** попытка до APPROVAL_MAX_BACKOFF: 20 попыток — около двух часов повторов
+APPROVAL_MAX_ATTEMPTS = 20
+APPROVAL_MAX_BACKOFF = 600  # максимальная задержка повтора задания, секунд
+APPROVAL_BATCH_SIZE = 50  # заданий, события которых создаются одним batch-запросом Calendar
+APPROVAL_POLL_INTERVAL = 5  # секунд между проверками отложенных заданий
+STATS_DEFAULT_DAYS = 30  # период /stats без аргумента, дней
+EXPORT_BATCH_SIZE = 1000  # строк за одно чтение курсора при выгрузке /export
+
+BOT_MODE = 'polling'  # 'polling', 'webhook' или 'async'
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_URL = ''  # внешний https-адрес бота; если пусто, вебхук в Telegram не регистрируется
+WEBHOOK_SECRET = ''  # проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 8  # параллельно обрабатываемых чатов
+WEBHOOK_MAX_PENDING = 1000  # при переполнении очереди отвечаем 503, Telegram повторит доставку
+ASYNC_IO_WORKERS = 16  # потоков для блокирующих вызовов Google и SQLite в асинхронном режиме
+
+SEND_RATE = 25  # исходящих сообщений в секунду на всех чатах (лимит Telegram — около 30)
+SEND_CHAT_RATE = 1  # сообщений в секунду в один чат
+SEND_CHAT_BURST = 3  # сообщений подряд в один чат без ожидания
+SEND_WORKERS = 4  # потоков отправки
+SEND_MAX_ATTEMPTS = 5  # попыток при сетевых ошибках
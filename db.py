@@ -0,0 +1,304 @@
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# Доступ к SQLite из потоков обработчиков.
+# У каждого потока своё соединение (WAL позволяет читать параллельно с записью),
+# а все записи идут через один поток, который объединяет накопившиеся записи
+# в общую транзакцию (group commit). Тексты запросов — константы модуля,
+# поэтому подготовленные выражения берутся из кэша соединения.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    username TEXT,
+    duration_hours REAL,
+    summary TEXT,
+    description TEXT,
+    service_type TEXT,
+    date TEXT,
+    time TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_date_time ON requests (date, time);
+CREATE INDEX IF NOT EXISTS requests_user_id ON requests (user_id);
+'''
+
+# Столбцы, добавленные после создания таблицы: (таблица, столбец, тип)
+COLUMNS = [
+    ('requests', 'sheet_row', 'INTEGER'),
+    ('requests', 'resource_id', 'TEXT'),
+    ('requests', 'status', 'TEXT'),
+    ('requests', 'created_at', 'REAL'),
+    ('requests', 'decided_at', 'REAL'),
+]
+
+# Индексы по добавленным столбцам — после миграции. requests_report покрывает
+# отчёты: агрегаты за период считаются по диапазону индекса без чтения таблицы
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS requests_status ON requests (status, date, time);
+CREATE INDEX IF NOT EXISTS requests_report
+    ON requests (date, status, service_type, resource_id, duration_hours, created_at, decided_at);
+'''
+
+# Статус заявок, созданных до появления столбца status. Одобренные узнаются по назначенному
+# посту; про остальные неизвестно, рассмотрены ли они, поэтому они получают отдельный статус
+# и не попадают ни в /queue, ни в одобрение — иначе по старой заявке создалось бы второе
+# событие и клиенту снова пришло бы уведомление. Прежняя версия миграции ставила таким
+# заявкам 'pending'; их выдаёт пустой created_at — новые заявки всегда его заполняют
+BACKFILL = """
+UPDATE requests SET status = CASE WHEN resource_id IS NOT NULL THEN 'approved' ELSE 'legacy' END
+WHERE status IS NULL OR (status = 'pending' AND created_at IS NULL)
+"""
+
+# Статусы заявки
+STATUS_PENDING = 'pending'
+STATUS_APPROVED = 'approved'
+STATUS_REJECTED = 'rejected'
+STATUS_NO_SHOW = 'no_show'  # одобрена, но клиент не приехал
+STATUS_LEGACY = 'legacy'  # создана до учёта статусов, решение по ней неизвестно
+
+# Текущее время в секундах Unix, как time.time()
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+INSERT_REQUEST = '''
+INSERT INTO requests
+    (user_id, username, duration_hours, summary, description, service_type, date, time, status, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending', {NOW})
+RETURNING id
+'''.format(NOW=NOW)
+SELECT_REQUEST = 'SELECT * FROM requests WHERE id = ?'
+UPDATE_REQUEST_DATETIME = 'UPDATE requests SET date = ?, time = ? WHERE id = ?'
+UPDATE_SHEET_ROW = 'UPDATE requests SET sheet_row = ? WHERE id = ?'
+SELECT_SHEET_ROW = 'SELECT sheet_row FROM requests WHERE id = ?'
+UPDATE_REQUEST_RESOURCE = f"UPDATE requests SET resource_id = ?, status = 'approved', decided_at = {NOW} WHERE id = ?"
+UPDATE_REQUEST_STATUS = f'UPDATE requests SET status = ?, decided_at = {NOW} WHERE id = ?'
+MARK_NO_SHOW = "UPDATE requests SET status = 'no_show' WHERE id = ? AND status = 'approved'"
+SELECT_PENDING_REQUEST = "SELECT * FROM requests WHERE id = ? AND status = 'pending'"
+SELECT_PENDING = "SELECT * FROM requests WHERE status = 'pending' ORDER BY date, time, id LIMIT ? OFFSET ?"
+COUNT_PENDING = "SELECT count(*) FROM requests WHERE status = 'pending'"
+
+
+def add_columns(conn, columns):
+    for table, column, column_type in columns:
+        existing = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    conn.commit()
+
+
+class RequestNotPending(Exception):
+    # Заявку уже рассмотрели: одобрение и перенос к ней не применяются
+    pass
+
+
+class Database(object):
+
+    def __init__(self, path, max_batch=100):
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.executescript(SCHEMA)
+        add_columns(conn, COLUMNS)
+        conn.executescript(INDEXES)
+        conn.execute(BACKFILL)
+        conn.commit()
+        self.writer = GroupCommitter(self, max_batch)
+        self.writer.start()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=256)
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def migrate(self, func):
+        # func(conn) меняет схему на отдельном соединении и фиксируется сразу.
+        # Не из потока записи: там открыта общая транзакция, которую DDL и commit
+        # на его соединении завершили бы вместе с точками сохранения записей
+        writer = getattr(self, 'writer', None)
+        if writer is not None and threading.current_thread() is writer:
+            raise RuntimeError('изменение схемы внутри транзакции записи')
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            func(conn)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def read(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def read_one(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def submit(self, func):
+        # func(conn) выполняется в потоке записи внутри общей транзакции
+        return self.writer.submit(func)
+
+    def write(self, sql, params=()):
+        # Ждёт фиксации транзакции и возвращает строки RETURNING, если они есть
+        return self.submit(lambda conn: conn.execute(sql, params).fetchall()).result()
+
+
+class GroupCommitter(threading.Thread):
+
+    def __init__(self, db, max_batch):
+        super().__init__(name='db-writer', daemon=True)
+        self.db = db
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+
+    def submit(self, func):
+        future = concurrent.futures.Future()
+        self.queue.put((func, future))
+        return future
+
+    def run(self):
+        conn = self.db.connection()
+        while True:
+            # Берём всё, что накопилось, пока фиксировалась предыдущая транзакция
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            results = []
+            started = time.perf_counter()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                for func, future in batch:
+                    # Ошибка одной записи откатывает только её
+                    conn.execute('SAVEPOINT item')
+                    try:
+                        results.append((future, func(conn), None))
+                        conn.execute('RELEASE item')
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO item')
+                        conn.execute('RELEASE item')
+                        results.append((future, None, e))
+                conn.commit()
+                metrics.DB_COMMIT_SECONDS.labels().observe(time.perf_counter() - started)
+                metrics.DB_WRITES.labels().inc(len(batch))
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                for func, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+class RequestRepository(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def create(self, user_id, username, duration_hours, summary, description, service_type, date, time,
+               reserve=None):
+        # reserve(conn, request_id) выполняется в той же транзакции, например бронь слота.
+        # Если он бросает исключение, заявка не создаётся
+        params = (user_id, username, duration_hours, summary, description, service_type, date, time)
+
+        def insert(conn):
+            request_id = conn.execute(INSERT_REQUEST, params).fetchone()[0]
+            if reserve is not None:
+                reserve(conn, request_id)
+            return request_id
+        return self.db.submit(insert).result()
+
+    def get(self, request_id):
+        return self.db.read_one(SELECT_REQUEST, (request_id,))
+
+    def update_datetime(self, request_id, date, time, reserve=None):
+        # Переносится только заявка на рассмотрении, иначе RequestNotPending
+        def update(conn):
+            if conn.execute(SELECT_PENDING_REQUEST, (request_id,)).fetchone() is None:
+                raise RequestNotPending(request_id)
+            conn.execute(UPDATE_REQUEST_DATETIME, (date, time, request_id))
+            if reserve is not None:
+                reserve(conn, request_id)
+        self.db.submit(update).result()
+
+    def assign_resource(self, request_id, reserve):
+        # reserve(conn, request) выбирает пост в той же транзакции и возвращает его id.
+        # Заявка перечитывается в транзакции: если её уже рассмотрели — RequestNotPending
+        def assign(conn):
+            request = conn.execute(SELECT_PENDING_REQUEST, (request_id,)).fetchone()
+            if request is None:
+                raise RequestNotPending(request_id)
+            resource_id = reserve(conn, request)
+            conn.execute(UPDATE_REQUEST_RESOURCE, (resource_id, request_id))
+            return resource_id
+        return self.db.submit(assign).result()
+
+    def approve_many(self, request_ids, reserve, skip=()):
+        # Пакетное одобрение одной транзакцией. reserve(conn, request) выбирает пост для заявки;
+        # исключение из skip откатывает только эту заявку (своя точка сохранения).
+        # Заявки, уже рассмотренные ранее, пропускаются.
+        # Возвращает ([(заявка, resource_id)], [id заявок, пропущенных из-за skip])
+        def approve(conn):
+            approved, skipped = [], []
+            for request_id in request_ids:
+                request = conn.execute(SELECT_PENDING_REQUEST, (request_id,)).fetchone()
+                if request is None:
+                    continue
+                conn.execute('SAVEPOINT approve')
+                try:
+                    resource_id = reserve(conn, request)
+                    conn.execute(UPDATE_REQUEST_RESOURCE, (resource_id, request_id))
+                    approved.append((request, resource_id))
+                except skip:
+                    conn.execute('ROLLBACK TO approve')
+                    skipped.append(request_id)
+                conn.execute('RELEASE approve')
+            return approved, skipped
+        return self.db.submit(approve).result()
+
+    def reject_many(self, request_ids, release):
+        # release(conn, request_id) снимает бронь в той же транзакции и возвращает затронутые дни.
+        # Возвращает (отклонённые заявки, дни)
+        def reject(conn):
+            rejected, changed = [], set()
+            for request_id in request_ids:
+                request = conn.execute(SELECT_PENDING_REQUEST, (request_id,)).fetchone()
+                if request is None:
+                    continue
+                conn.execute(UPDATE_REQUEST_STATUS, (STATUS_REJECTED, request_id))
+                changed.update(release(conn, request_id))
+                rejected.append(request)
+            return rejected, changed
+        return self.db.submit(reject).result()
+
+    def pending(self, offset, limit):
+        # Заявки на рассмотрении по порядку записи
+        return self.db.read(SELECT_PENDING, (limit, offset))
+
+    def count_pending(self):
+        return self.db.read_one(COUNT_PENDING)[0]
+
+    def mark_no_show(self, request_id):
+        # False — заявка не найдена или не была одобрена
+        return self.db.submit(lambda conn: conn.execute(MARK_NO_SHOW, (request_id,)).rowcount).result() > 0
+
+    def set_sheet_rows(self, rows):
+        # rows: [(request_id, номер строки в Google Sheets)]
+        self.db.submit(lambda conn: conn.executemany(UPDATE_SHEET_ROW, [(row, i) for i, row in rows])).result()
+
+    def get_sheet_row(self, request_id):
+        row = self.db.read_one(SELECT_SHEET_ROW, (request_id,))
+        return row[0] if row else None
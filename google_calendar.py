@@ -0,0 +1,207 @@
+import logging
+
+import googleapiclient
+import googleapiclient.errors
+
+import config
+import metrics
+from lazy import lazy
+
+logger = logging.getLogger(__name__)
+# Строки о каждом чтении событий — отдельный логгер, его прореживает LOG_SAMPLING
+events_logger = logging.getLogger(__name__ + '.events')
+
+SCOPES = config.SCOPES
+calendarId = config.CALENDAR_ID
+SERVICE_ACCOUNT_FILE = config.SERVICE_ACCOUNT_FILE
+
+
+def build_calendar_service():
+    # Клиент API импортируется долго, поэтому только при первом обращении к календарю
+    import googleapiclient.discovery
+    from google.oauth2 import service_account
+
+    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    # Описание API берётся из копии, поставляемой с библиотекой, без запроса к серверу
+    return googleapiclient.discovery.build('calendar', 'v3', credentials=credentials,
+                                           static_discovery=True, cache_discovery=False)
+
+
+# Максимум запросов в одном batch-запросе Calendar API
+BATCH_LIMIT = 50
+
+
+class CalendarUnavailable(Exception):
+    # Список событий получить не удалось (ошибка API, сети или учётных данных);
+    # пустой результат приняли бы за свободный день
+    pass
+
+
+def is_conflict(error):
+    # 409: событие с таким id уже существует
+    return getattr(getattr(error, 'resp', None), 'status', None) == 409
+
+
+class GoogleCalendar(object):
+
+    def __init__(self, store=None):
+        self.store = store
+
+    @lazy
+    def service(self):
+        return build_calendar_service()
+
+    def create_event_dict(self, start_time, end_time, summary, description, service_type):
+        event = {
+            'summary': f"Телефон: {summary}",
+            'description': f"{description}\nТип работ: {service_type}",
+            'start': {
+                'dateTime': start_time.isoformat(),
+            },
+            'end': {
+                'dateTime': end_time.isoformat(),
+            }
+        }
+        return event
+
+    def insert_event(self, event, calendar_id=None, event_id=None):
+        # Ошибки не глотает. С event_id вставка идемпотентна: 409 значит, что событие
+        # с этим id уже создано прежней попыткой
+        calendar_id = calendar_id or calendarId
+        if event_id is not None:
+            event = dict(event, id=event_id)
+        try:
+            with metrics.external('calendar', 'insert'):
+                e = self.service.events().insert(calendarId=calendar_id, body=event).execute()
+            logger.info("Событие создано: %s", e.get('id'))
+        except googleapiclient.errors.HttpError as error:
+            if event_id is None or not is_conflict(error):
+                raise
+            logger.info("Событие %s уже создано", event_id)
+            e = event
+        # Сразу добавляем событие в зеркало, не дожидаясь синхронизации
+        if self.store is not None:
+            self.store.apply(calendar_id, [e])
+        return e
+
+    def insert_events(self, items):
+        # items: [(calendar_id, event, event_id)]. Вставка batch-запросами по BATCH_LIMIT событий.
+        # Возвращает результаты в том же порядке: созданное событие или исключение этой вставки.
+        # Как и в insert_event, 409 для события с id значит, что событие уже создано.
+        # Ошибка всего batch-запроса пробрасывается
+        results = [None] * len(items)
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            if exception is not None and is_conflict(exception):
+                logger.info("Событие %s уже создано", items[index][2])
+                response, exception = dict(items[index][1], id=items[index][2]), None
+            if exception is not None:
+                logger.error("Ошибка при создании события: %s", exception)
+            results[index] = exception if exception is not None else response
+
+        for offset in range(0, len(items), BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for i, (calendar_id, event, event_id) in enumerate(items[offset:offset + BATCH_LIMIT], offset):
+                batch.add(self.service.events().insert(calendarId=calendar_id, body=dict(event, id=event_id)),
+                          request_id=str(i))
+            with metrics.external('calendar', 'batch_insert'):
+                batch.execute()
+        logger.info("Создано событий: %s из %s", sum(isinstance(result, dict) for result in results), len(items))
+
+        if self.store is not None:
+            by_calendar = {}
+            for (calendar_id, _, _), result in zip(items, results):
+                if isinstance(result, dict):
+                    by_calendar.setdefault(calendar_id, []).append(result)
+            for calendar_id, events in by_calendar.items():
+                self.store.apply(calendar_id, events)
+        return results
+
+    def get_events_ranges(self, calendar_ids, time_min, time_max):
+        # Синхронизированные календари читаются из зеркала, остальные — одним batch-запросом
+        result = {}
+        missing = []
+        for calendar_id in calendar_ids:
+            ready = self.store is not None and self.store.is_ready(calendar_id)
+            metrics.cache('calendar_mirror', ready)
+            if ready:
+                result[calendar_id] = self.store.get_events(calendar_id, time_min, time_max)
+            else:
+                missing.append(calendar_id)
+        if len(missing) == 1:
+            result[missing[0]] = self.fetch_events_range(time_min, time_max, missing[0])
+        elif missing:
+            result.update(self.fetch_events_ranges(missing, time_min, time_max))
+        return result
+
+    def list_params(self, calendar_id, time_min, time_max, page_token=None):
+        params = {
+            'calendarId': calendar_id,
+            'timeMin': time_min.isoformat(),
+            'timeMax': time_max.isoformat(),
+            'singleEvents': True,
+            'orderBy': 'startTime',
+            'maxResults': 2500,
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        return params
+
+    def fetch_events_range(self, time_min, time_max, calendar_id=None):
+        # Одно постраничное events().list на всё окно вместо запроса на каждый день
+        calendar_id = calendar_id or calendarId
+        items = []
+        page_token = None
+        try:
+            while True:
+                with metrics.external('calendar', 'list'):
+                    events_result = self.service.events().list(
+                        **self.list_params(calendar_id, time_min, time_max, page_token)).execute()
+                items.extend(events_result.get('items', []))
+                page_token = events_result.get('nextPageToken')
+                if not page_token:
+                    break
+            events_logger.info("Получен список событий с %s по %s", time_min, time_max)
+            return items
+        except Exception as error:
+            # Не только HttpError: таймауты сокета, ошибки транспорта и учётных данных
+            logger.error("Ошибка при получении списка событий: %s", error)
+            raise CalendarUnavailable(error) from error
+
+    def fetch_events_ranges(self, calendar_ids, time_min, time_max):
+        # Несколько календарей за один batch-запрос; следующие страницы — следующими batch-запросами
+        items = {calendar_id: [] for calendar_id in calendar_ids}
+        pending = {calendar_id: None for calendar_id in calendar_ids}
+        errors = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                logger.error("Ошибка при получении списка событий календаря %s: %s", request_id, exception)
+                errors.append(exception)
+                return
+            items[request_id].extend(response.get('items', []))
+            if response.get('nextPageToken'):
+                pending[request_id] = response['nextPageToken']
+
+        while pending:
+            requests = list(pending.items())[:BATCH_LIMIT]
+            for calendar_id, _ in requests:
+                del pending[calendar_id]
+            try:
+                batch = self.service.new_batch_http_request(callback=callback)
+                for calendar_id, page_token in requests:
+                    batch.add(self.service.events().list(**self.list_params(calendar_id, time_min, time_max,
+                                                                            page_token)),
+                              request_id=calendar_id)
+                with metrics.external('calendar', 'batch_list'):
+                    batch.execute()
+            except Exception as error:
+                # Как в fetch_events_range: любая ошибка запроса — календарь недоступен
+                logger.error("Ошибка при получении списка событий: %s", error)
+                raise CalendarUnavailable(error) from error
+            if errors:
+                # Календарь без событий нельзя считать свободным — весь результат недействителен
+                raise CalendarUnavailable(errors[0])
+        events_logger.info("Получен список событий %s календарей с %s по %s", len(items), time_min, time_max)
+        return items
@@ -0,0 +1,128 @@
+import datetime
+import sqlite3
+import time
+
+import db
+
+# Бронь слотов: заявка занимает время на одном из постов сразу при выборе,
+# а не при одобрении. Пересечения на одном посту запрещает триггер, поэтому
+# проверка и вставка идут в одной транзакции и два пользователя не могут
+# забронировать одно время даже из разных процессов. Неподтверждённая бронь истекает через TTL; одобренная
+# (expires_at IS NULL) держит слот, пока событие не попадёт в календарь.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS slot_holds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id INTEGER UNIQUE,
+    resource_id TEXT,
+    day TEXT,
+    start_ts INTEGER,
+    end_ts INTEGER,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS slot_holds_day ON slot_holds (day, start_ts);
+CREATE INDEX IF NOT EXISTS slot_holds_expires_at ON slot_holds (expires_at);
+'''
+
+COLUMNS = [
+    ('slot_holds', 'resource_id', 'TEXT'),
+]
+
+# После добавления resource_id: индекс и триггер учитывают пост
+TRIGGERS = '''
+CREATE INDEX IF NOT EXISTS slot_holds_resource_day ON slot_holds (resource_id, day, start_ts);
+DROP TRIGGER IF EXISTS slot_holds_no_overlap;
+CREATE TRIGGER IF NOT EXISTS slot_holds_no_resource_overlap
+BEFORE INSERT ON slot_holds
+WHEN EXISTS (
+    SELECT 1 FROM slot_holds
+    WHERE resource_id = NEW.resource_id AND day = NEW.day AND start_ts < NEW.end_ts AND end_ts > NEW.start_ts
+      AND (expires_at IS NULL OR expires_at > (julianday('now') - 2440587.5) * 86400.0)
+)
+BEGIN
+    SELECT RAISE(ABORT, 'slot_taken');
+END;
+'''
+
+INSERT_HOLD = '''
+INSERT INTO slot_holds (request_id, resource_id, day, start_ts, end_ts, expires_at) VALUES (?, ?, ?, ?, ?, ?)
+'''
+SELECT_HOLD_DAY = 'SELECT day FROM slot_holds WHERE request_id = ?'
+SELECT_HOLD_RESOURCE = 'SELECT resource_id FROM slot_holds WHERE request_id = ?'
+DELETE_HOLD = 'DELETE FROM slot_holds WHERE request_id = ?'
+ASSIGN_LEGACY = 'UPDATE slot_holds SET resource_id = ? WHERE resource_id IS NULL'
+SELECT_ACTIVE = '''
+SELECT resource_id, start_ts, end_ts, expires_at FROM slot_holds
+WHERE day >= ? AND day <= ? AND (expires_at IS NULL OR expires_at > ?)
+ORDER BY start_ts
+'''
+DELETE_EXPIRED = 'DELETE FROM slot_holds WHERE expires_at <= ?'
+DELETE_PAST = 'DELETE FROM slot_holds WHERE expires_at IS NULL AND end_ts < ?'
+
+
+class SlotTaken(Exception):
+    pass
+
+
+class SlotHolds(object):
+
+    def __init__(self, database, tz, ttl, default_resource=None):
+        self.db = database
+        self.tz = tz
+        self.ttl = ttl
+        self.listeners = []
+
+        def migrate(conn):
+            conn.executescript(SCHEMA)
+            db.add_columns(conn, COLUMNS)
+            if default_resource is not None:
+                # Брони, созданные до появления постов, относятся к первому посту
+                conn.execute(ASSIGN_LEGACY, (default_resource,))
+            conn.executescript(TRIGGERS)
+        self.db.migrate(migrate)
+
+    def add_listener(self, callback):
+        # callback(dates) вызывается после изменения броней на эти дни
+        self.listeners.append(callback)
+
+    def notify(self, dates):
+        if dates:
+            for callback in self.listeners:
+                callback(dates)
+
+    def held_resource(self, conn, request_id):
+        row = conn.execute(SELECT_HOLD_RESOURCE, (request_id,)).fetchone()
+        return row[0] if row else None
+
+    def hold(self, conn, request_id, resource_id, start_time, end_time, confirmed=False):
+        # Выполняется внутри транзакции записи. Прежняя бронь заявки заменяется,
+        # поэтому так же переносится и подтверждается. Возвращает затронутые дни
+        start_time = start_time.astimezone(self.tz)
+        changed = {start_time.date()}
+        old = conn.execute(SELECT_HOLD_DAY, (request_id,)).fetchone()
+        if old:
+            changed.add(datetime.date.fromisoformat(old[0]))
+            conn.execute(DELETE_HOLD, (request_id,))
+        now = time.time()
+        # Заодно убираем истёкшие брони и подтверждённые брони прошедших дней
+        conn.execute(DELETE_EXPIRED, (now,))
+        conn.execute(DELETE_PAST, (now - 24 * 60 * 60,))
+        expires_at = None if confirmed else now + self.ttl
+        try:
+            conn.execute(INSERT_HOLD, (request_id, resource_id, start_time.date().isoformat(),
+                                       int(start_time.timestamp()), int(end_time.timestamp()), expires_at))
+        except sqlite3.IntegrityError as e:
+            if 'slot_taken' in str(e):
+                raise SlotTaken() from e
+            raise
+        return changed
+
+    def drop(self, conn, request_id):
+        # Снимает бронь внутри транзакции записи и возвращает затронутые дни
+        old = conn.execute(SELECT_HOLD_DAY, (request_id,)).fetchone()
+        conn.execute(DELETE_HOLD, (request_id,))
+        return {datetime.date.fromisoformat(old[0])} if old else set()
+
+    def active(self, first_day, last_day):
+        # Действующие брони за дни [first_day, last_day]: [(resource_id, start_ts, end_ts, expires_at)]
+        return self.db.read(SELECT_ACTIVE, (first_day.isoformat(), last_day.isoformat(), time.time()))
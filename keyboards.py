@@ -0,0 +1,250 @@
+from telebot import types
+
+import approvals
+import reports
+
+# Клавиатуры и тексты, общие для синхронного и асинхронного режимов
+
+BACK = "Назад"
+CALENDAR_UNAVAILABLE = "Не удалось получить расписание. Пожалуйста, повторите через минуту."
+
+# Тип услуги -> длительность в часах
+SERVICE_TYPES = {
+    'Замена масла': 0.5,
+    'Чистка салона': 1.0,
+    'Ремонт двигателя': 1.5,
+}
+
+WEEKDAYS_RU = {
+    "Mon": "Пн",
+    "Tue": "Вт",
+    "Wed": "Ср",
+    "Thu": "Чт",
+    "Fri": "Пт",
+    "Sat": "Сб",
+    "Sun": "Вс"
+}
+
+
+def start_markup():
+    btn1 = 'Записаться'
+    btn2 = 'Контакты'
+    return types.ReplyKeyboardMarkup().row(btn1).row(btn2)
+
+
+def service_type_markup():
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+    for service_type in SERVICE_TYPES:
+        markup.row(service_type)
+    markup.add(types.KeyboardButton(BACK))
+    return markup
+
+
+def back_markup():
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
+    markup.add(types.KeyboardButton(BACK))
+    return markup
+
+
+def phone_markup():
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+    markup.add(types.KeyboardButton("Отправить номер телефона", request_contact=True))
+    markup.add(types.KeyboardButton(BACK))
+    return markup
+
+
+def format_date(date):
+    weekday = WEEKDAYS_RU[date.strftime('%a')]  # Получаем день недели на русском
+    return f"{weekday} {date.strftime('%d.%m.%y')}"  # Форматируем строку
+
+
+def date_markup(dates):
+    markup = back_markup()
+    for date in dates:
+        markup.add(types.KeyboardButton(format_date(date)))
+    return markup
+
+
+def time_markup(slots):
+    markup = back_markup()
+    for slot in slots:
+        markup.add(types.KeyboardButton(slot.strftime('%H:%M')))
+    return markup
+
+
+def admin_request_markup(request_id):
+    markup = types.InlineKeyboardMarkup()
+    approve_button = types.InlineKeyboardButton("Одобрить", callback_data=f"approve_{request_id}")
+    reject_button = types.InlineKeyboardButton("Отклонить", callback_data=f"reject_{request_id}")
+    change_button = types.InlineKeyboardButton("Изменить", callback_data=f"change_{request_id}")
+    markup.add(approve_button, reject_button, change_button)
+    return markup
+
+
+def admin_request_text(request, is_new):
+    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:9]
+    title = "Новая заявка" if is_new else "Измененная заявка"
+    return (f"{title}:\n\n"
+            f"Услуга: {service_type}\n"
+            f"Модель машины: {summary}\n"
+            f"Номер телефона: {description}\n"
+            f"Имя пользователя: @{username}\n"
+            f"Дата: {date}\n"
+            f"Время: {time}\n"
+            f"Длительность: {duration_hours} часов")
+
+
+def approved_text(service_type, summary, description, username, start_time):
+    formatted_start_time = start_time.strftime('%H:%M %d.%m.%y')
+    return (f"Ваша заявка одобрена!\n\n"
+            f"Услуга: {service_type}\n"
+            f"Модель машины: {summary}\n"
+            f"Номер телефона: {description}\n"
+            f"Имя пользователя: @{username}\n"
+            f"Время записи: {formatted_start_time}")
+
+
+def queue_text(requests, page, pages, total, selected):
+    if not total:
+        return "Нет заявок на рассмотрении."
+    lines = [f"Заявки на рассмотрении: {total}, страница {page + 1} из {pages}, выбрано: {len(selected)}", ""]
+    for request in requests:
+        user_id, username, duration_hours, summary, description, service_type, date, time = request[1:9]
+        lines.append(f"#{request[0]} {date} {time} — {service_type}, {summary}, {description}, @{username}")
+    return "\n".join(lines)
+
+
+def queue_markup(requests, page, pages, selected):
+    # Кнопка заявки переключает её выбор; действия применяются ко всем выбранным заявкам
+    markup = types.InlineKeyboardMarkup()
+    for request in requests:
+        mark = "✅" if request[0] in selected else "⬜"
+        markup.row(types.InlineKeyboardButton(f"{mark} #{request[0]} {request[7]} {request[8]} {request[6]}",
+                                              callback_data=f"queue_toggle_{request[0]}_{page}"))
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton("◀", callback_data=f"queue_page_{page - 1}"))
+    if page + 1 < pages:
+        navigation.append(types.InlineKeyboardButton("▶", callback_data=f"queue_page_{page + 1}"))
+    if navigation:
+        markup.row(*navigation)
+    if selected:
+        markup.row(types.InlineKeyboardButton(f"Одобрить выбранные ({len(selected)})",
+                                              callback_data=f"queue_approve_{page}"),
+                   types.InlineKeyboardButton("Отклонить выбранные", callback_data=f"queue_reject_{page}"))
+    return markup
+
+
+def approval_status_text(job):
+    if job.status == approvals.DONE:
+        return f"Заявка {job.request_id} одобрена: событие в календаре, клиент уведомлён."
+    if job.status == approvals.FAILED:
+        return (f"Заявка {job.request_id} одобрена, но событие создать не удалось: {job.error}\n"
+                f"Задание {job.id}, попыток: {job.attempts}. Список заданий: /jobs")
+    if job.error:
+        return (f"Заявка {job.request_id} одобрена, событие пока не создано: {job.error}\n"
+                f"Повтор автоматически, попыток: {job.attempts}.")
+    return f"Заявка {job.request_id} одобрена, создаём событие в календаре…"
+
+
+JOB_STATUSES = {
+    approvals.QUEUED: "в очереди",
+    approvals.RUNNING: "выполняется",
+    approvals.DONE: "выполнено",
+    approvals.FAILED: "ошибка",
+}
+
+
+def jobs_text(jobs):
+    if not jobs:
+        return "Заданий одобрения нет."
+    lines = ["Задания одобрения:", ""]
+    for job in jobs:
+        line = f"#{job.id} заявка {job.request_id}: {JOB_STATUSES.get(job.status, job.status)}, попыток: {job.attempts}"
+        if job.error and job.status != approvals.DONE:
+            line += f" — {job.error}"
+        lines.append(line)
+    if any(job.status == approvals.FAILED for job in jobs):
+        lines += ["", "Повторить: /retry <номер задания> или /retry для всех неудавшихся"]
+    return "\n".join(lines)
+
+
+def retry_text(job_ids, job_id):
+    if job_ids:
+        return f"Задания возвращены в очередь: {', '.join(f'#{i}' for i in job_ids)}"
+    if job_id is not None:
+        return f"Задание #{job_id} не найдено среди неудавшихся."
+    return "Неудавшихся заданий нет."
+
+
+REQUEST_STATUSES = {
+    'pending': "на рассмотрении",
+    'approved': "одобрено",
+    'rejected': "отклонено",
+    'no_show': "не приехали",
+    'legacy': "без статуса (до учёта статусов)",
+}
+
+
+def percent(value):
+    return "—" if value is None else f"{value:.0%}"
+
+
+def stats_text(stats, resources, today):
+    period = "вся история" if stats.date_to == reports.MAX_DATE else f"{stats.date_from} — {stats.date_to}"
+    if not stats.total:
+        return f"Статистика ({period}): заявок нет."
+    lines = [f"Статистика ({period})", "", f"Заявок: {stats.total}"]
+    for status, count in sorted(stats.by_status.items(), key=lambda item: -item[1]):
+        lines.append(f"  {REQUEST_STATUSES.get(status, status)}: {count}")
+    lines += ["", "По услугам (заявок / одобрено):"]
+    for service_type, (count, approved) in sorted(stats.by_service.items(), key=lambda item: -item[1][0]):
+        lines.append(f"  {service_type}: {count} / {approved}")
+    lines += ["", "Загрузка постов за прошедшие дни:"]
+    for resource in resources:
+        lines.append(f"  {resource.name}: {percent(stats.utilisation(resource, today))}")
+    lines += ["", f"Не приехали: {percent(stats.no_show_rate())} прошедших одобренных записей"]
+    average = stats.average_decision()
+    if average is not None:
+        lines.append(f"Среднее время рассмотрения: {average / 60:.0f} мин")
+    return "\n".join(lines)
+
+
+def period_days(text, default):
+    # "/stats 7" -> 7, "/stats все" -> None (вся история), без аргумента — default.
+    # ValueError — аргумент не число дней
+    parts = text.split()
+    if len(parts) < 2:
+        return default
+    if parts[1].lower() in ("all", "все"):
+        return None
+    days = int(parts[1])
+    if days < 1:
+        raise ValueError(parts[1])
+    return days
+
+
+def period_help(command):
+    return f"Укажите число дней или «все», например: /{command} 7"
+
+
+def batch_status_text(jobs):
+    counts = {}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    summary = ", ".join(f"{JOB_STATUSES.get(status, status)}: {count}" for status, count in counts.items())
+    lines = [f"Одобрено заявок: {len(jobs)} ({summary})", ""]
+    for job in jobs:
+        line = f"#{job.request_id}: {JOB_STATUSES.get(job.status, job.status)}"
+        if job.error and job.status != approvals.DONE:
+            line += f" — {job.error}"
+        lines.append(line)
+    if any(job.status == approvals.FAILED for job in jobs):
+        lines += ["", "Повторить: /retry <номер задания> или /retry для всех неудавшихся"]
+    return "\n".join(lines)
+
+
+def batch_status_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.row(types.InlineKeyboardButton("К очереди", callback_data="queue_page_0"))
+    return markup
@@ -0,0 +1,22 @@
+import threading
+
+# Ленивая инициализация клиентов и компонентов: значение вычисляется при
+# первом обращении и запоминается в экземпляре. В отличие от
+# functools.cached_property, два потока не создадут один клиент дважды.
+
+
+class lazy(object):
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.lock = threading.RLock()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # После первого вычисления значение лежит в __dict__ и дескриптор не вызывается
+        with self.lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.func(instance)
+        return instance.__dict__[self.name]
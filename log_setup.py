@@ -0,0 +1,169 @@
+import atexit
+import contextlib
+import contextvars
+import datetime
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+# Логирование без блокировок в обработчиках.
+# Обработчик только кладёт запись в очередь (QueueHandler), сообщение
+# форматируется и пишется в файл и на консоль в отдельном потоке QueueListener.
+# В файл пишутся JSON-записи с полями chat_id, request_id и step из контекста
+# текущего шага; файл ротируется по размеру или по времени. Для болтливых
+# логгеров (например, google_calendar.events) пишется только доля INFO-записей.
+
+CONTEXT_FIELDS = ('chat_id', 'request_id', 'step')
+log_context = contextvars.ContextVar('log_context', default={})
+
+
+def bind(**fields):
+    # Добавляет поля к контексту до конца текущего шага
+    log_context.set(dict(log_context.get(), **fields))
+
+
+@contextlib.contextmanager
+def context(**fields):
+    token = log_context.set(dict(log_context.get(), **fields))
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+
+def chat_of(update):
+    # Сообщение или нажатие кнопки -> id чата
+    chat = getattr(update, 'chat', None) or getattr(getattr(update, 'message', None), 'chat', None)
+    return getattr(chat, 'id', None)
+
+
+def step(func):
+    # Обработчик шага: записи внутри него получают chat_id и имя шага
+    name = func.__name__
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(update, *args, **kwargs):
+            with context(chat_id=chat_of(update), step=name):
+                return await func(update, *args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(update, *args, **kwargs):
+        with context(chat_id=chat_of(update), step=name):
+            return func(update, *args, **kwargs)
+    return wrapper
+
+
+class ContextFilter(logging.Filter):
+    # Выполняется в потоке, который пишет в лог, пока контекст шага ещё действует
+
+    def filter(self, record):
+        fields = log_context.get()
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, fields.get(field))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # rates: {имя логгера: доля INFO и DEBUG записей}; предупреждения и ошибки пишутся всегда
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition('.')[0]
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # Сообщение не форматируется в потоке обработчика; при переполненной очереди запись отбрасывается
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Очередь внутри процесса: запись передаётся как есть, форматирует поток QueueListener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'ts': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ContextTextFormatter(logging.Formatter):
+    # Консольный формат, как раньше, с полями контекста в конце строки
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [f'{field}={getattr(record, field)}' for field in CONTEXT_FIELDS
+                  if getattr(record, field, None) is not None]
+        return f"{line} [{' '.join(fields)}]" if fields else line
+
+
+def file_handler(cfg):
+    if cfg.LOG_ROTATE == 'time':
+        return logging.handlers.TimedRotatingFileHandler(cfg.LOG_FILE, when=cfg.LOG_ROTATE_WHEN,
+                                                         backupCount=cfg.LOG_BACKUP_COUNT, encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(cfg.LOG_FILE, maxBytes=cfg.LOG_MAX_BYTES,
+                                                backupCount=cfg.LOG_BACKUP_COUNT, encoding='utf-8')
+
+
+def configure(cfg):
+    # Заменяет обработчики корневого логгера очередью; возвращает запущенный QueueListener
+    log_file = file_handler(cfg)
+    log_file.setFormatter(JsonFormatter() if cfg.LOG_FORMAT == 'json' else ContextTextFormatter(
+        '%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+    console = logging.StreamHandler()
+    console.setFormatter(ContextTextFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.Queue(cfg.LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(cfg.LOG_SAMPLING))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(cfg.LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, log_file, console, respect_handler_level=True)
+    listener.start()
+    # Перед выходом дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
@@ -1,204 +1,91 @@
 from __future__ import print_function
 import telebot
 from telebot import types
-from threading import Thread
 import datetime
-import googleapiclient
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import sqlite3
 import re
 import config
-import gspread
 import logging
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
-
-logging.info("Bot started")
-
-bot = telebot.TeleBot(config.BOT_TOKEN)
-SCOPES = config.SCOPES
-calendarId = config.CALENDAR_ID
-SERVICE_ACCOUNT_FILE = config.SERVICE_ACCOUNT_FILE
+import keyboards
+import log_setup
+import metrics
+import services
+import webhook
+from db import STATUS_PENDING, RequestNotPending
+from google_calendar import CalendarUnavailable
+from holds import SlotTaken
+from slots import UTC_PLUS_4
+
+# Настройка логирования: запись уходит в очередь, в файл её пишет отдельный поток
+log_setup.configure(config)
+logger = logging.getLogger(__name__)
+
+logger.info("Bot started")
+
+# В режиме вебхука обновления обрабатывает собственный пул воркеров (webhook.py)
+bot = telebot.TeleBot(config.BOT_TOKEN, threaded=config.BOT_MODE != 'webhook')
 admin_id = config.ADMIN_ID
 
-# Подключение к Google Sheets
-gc = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
-sheet = gc.open_by_key(config.SHEET_ID).sheet1  # Открываем таблицу по ID
-
-# Определяем часовой пояс UTC+4
-UTC_PLUS_4 = datetime.timezone(datetime.timedelta(hours=4))
-
-# Инициализация базы данных
-conn = sqlite3.connect('requests.db', check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS requests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    username TEXT,
-    duration_hours REAL,
-    summary TEXT,
-    description TEXT,
-    service_type TEXT,
-    date TEXT,
-    time TEXT
-)
-''')
-conn.commit()
-
-class GoogleCalendar(object):
-
-    def __init__(self):
-        credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        self.service = googleapiclient.discovery.build('calendar', 'v3', credentials=credentials)
-
-    def create_event_dict(self, start_time, end_time, summary, description, service_type):
-        event = {
-            'summary': f"Телефон: {summary}",
-            'description': f"{description}\nТип работ: {service_type}",
-            'start': {
-                'dateTime': start_time.isoformat(),
-            },
-            'end': {
-                'dateTime': end_time.isoformat(),
-            }
-        }
-        return event
-
-    def create_event(self, event):
-        try:
-            e = self.service.events().insert(calendarId=calendarId, body=event).execute()
-            logging.info(f"Событие создано: {e.get('id')}")
-        except googleapiclient.errors.HttpError as error:
-            logging.error(f"Ошибка при создании события: {error}")
+calendar = services.calendar
+requests_repo = services.requests_repo
+leads = services.leads
+# Исходящие сообщения ставятся в очередь с ограничением скорости (sender.py)
+sender = services.sender
 
-    def get_events_list(self, date):
-        now = date.isoformat()
-        try:
-            events_result = self.service.events().list(
-                calendarId=calendarId,
-                timeMin=now,
-                timeMax=(date + datetime.timedelta(days=1)).isoformat(),
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-            logging.info(f"Получен список событий на дату {date}")
-            return events_result.get('items', [])
-        except googleapiclient.errors.HttpError as error:
-            logging.error(f"Ошибка при получении списка событий: {error}")
-            return []
-
-    def find_free_slot(self, date, duration_hours):
-        events = self.get_events_list(date)
-        start_of_day = max(date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=UTC_PLUS_4), datetime.datetime.now(UTC_PLUS_4))
-        end_of_day = date.replace(hour=22, minute=0, second=0, microsecond=0, tzinfo=UTC_PLUS_4)
-
-        # Сортируем события по времени начала
-        events.sort(key=lambda x: datetime.datetime.fromisoformat(x['start']['dateTime']).astimezone(UTC_PLUS_4))
-
-        def is_slot_free(start_time, end_time):
-            for event in events:
-                event_start = datetime.datetime.fromisoformat(event['start']['dateTime']).astimezone(UTC_PLUS_4)
-                event_end = datetime.datetime.fromisoformat(event['end']['dateTime']).astimezone(UTC_PLUS_4)
-                if not (end_time <= event_start or start_time >= event_end):
-                    return False
-            return True
-
-        def round_to_nearest_5_minutes(dt):
-            minutes = dt.minute
-            rounded_minutes = (minutes // 5) * 5
-            if minutes % 5 != 0:
-                rounded_minutes += 5
-            if rounded_minutes >= 60:
-                rounded_minutes = 0
-                dt += datetime.timedelta(hours=1)
-            return dt.replace(minute=rounded_minutes, second=0, microsecond=0)
-
-        current_time = round_to_nearest_5_minutes(start_of_day)
-        while current_time < end_of_day:
-            end_time = current_time + datetime.timedelta(hours=duration_hours)
-            if end_time > end_of_day:
-                break
-
-            if is_slot_free(current_time, end_time):
-                logging.info(f"Свободный слот найден: {current_time} - {end_time}")
-                return current_time, end_time
-
-            # Проверяем каждые 30 минут
-            current_time += datetime.timedelta(minutes=30)
-
-        logging.warning("Свободный слот не найден")
-        return None, None
-
-    def create_event_in_free_slot(self, date, duration_hours, summary, description, service_type):
-        while True:
-            start_time, end_time = self.find_free_slot(date, duration_hours)
-            if start_time and end_time:
-                event = self.create_event_dict(start_time, end_time, summary, description, service_type)
-                self.create_event(event)
-                return start_time, end_time
-            else:
-                date += datetime.timedelta(days=1)
-
-calendar = GoogleCalendar()
-
-# Словарь для хранения состояния пользователя
-user_states = {}
+# Состояние диалогов (поля заявки и текущий шаг) хранится в базе
+states = services.states
 
+def register_next_step_handler(message, handler, *args):
+    states.set_step(message.chat.id, handler.__name__, *args)
+
+@bot.message_handler(func=lambda message: states.has_step(message.chat.id), content_types=['text', 'contact'])
+def next_step(message):
+    step, args = states.pop_step(message.chat.id)
+    if step in STEPS:
+        try:
+            STEPS[step](message, *args)
+        except CalendarUnavailable:
+            # Шаг не меняется: тот же ответ можно отправить ещё раз
+            sender.send_message(message.chat.id, keyboards.CALENDAR_UNAVAILABLE)
+            states.set_step(message.chat.id, step, *args)
+
+@metrics.step
+@log_setup.step
 def create_event(message):
-    btn1 = 'Замена масла'
-    btn2 = 'Чистка салона'
-    btn3 = 'Ремонт двигателя'
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True).row(btn1).row(btn2).row(btn3)
-    markup.add(types.KeyboardButton("Назад"))
-    bot.send_message(message.chat.id, "Выберите тип услуги:", reply_markup=markup)
-    bot.register_next_step_handler(message, get_service_type)
+    sender.send_message(message.chat.id, "Выберите тип услуги:", reply_markup=keyboards.service_type_markup())
+    register_next_step_handler(message, get_service_type)
 
+@metrics.step
+@log_setup.step
 def get_service_type(message):
     if message.text == "Назад":
         start(message)
         return
 
     service_type = message.text
-    if service_type == 'Замена масла':
-        duration_hours = 0.5
-    elif service_type == 'Чистка салона':
-        duration_hours = 1.0
-    elif service_type == 'Ремонт двигателя':
-        duration_hours = 1.5
-    else:
-        bot.send_message(message.chat.id, "Пожалуйста, выберите один из предложенных вариантов.")
-        bot.register_next_step_handler(message, get_service_type)
+    duration_hours = keyboards.SERVICE_TYPES.get(service_type)
+    if duration_hours is None:
+        sender.send_message(message.chat.id, "Пожалуйста, выберите один из предложенных вариантов.")
+        register_next_step_handler(message, get_service_type)
         return
 
-    user_states[message.chat.id] = {'service_type': service_type, 'duration_hours': duration_hours}
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-    markup.add(types.KeyboardButton("Назад"))
-    bot.send_message(message.chat.id, "Введите модель машины:", reply_markup=markup)
-    bot.register_next_step_handler(message, get_summary)
+    states.create(message.chat.id, service_type=service_type, duration_hours=duration_hours)
+    sender.send_message(message.chat.id, "Введите модель машины:", reply_markup=keyboards.back_markup())
+    register_next_step_handler(message, get_summary)
 
+@metrics.step
+@log_setup.step
 def get_summary(message):
     if message.text == "Назад":
         create_event(message)
         return
 
     summary = message.text
-    user_states[message.chat.id]['summary'] = summary
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    markup.add(types.KeyboardButton("Отправить номер телефона", request_contact=True))
-    markup.add(types.KeyboardButton("Назад"))
-    bot.send_message(message.chat.id, "Введите номер телефона или отправьте его через контакт:", reply_markup=markup)
-    bot.register_next_step_handler(message, get_description)
+    states.update(message.chat.id, summary=summary)
+    sender.send_message(message.chat.id, "Введите номер телефона или отправьте его через контакт:", reply_markup=keyboards.phone_markup())
+    register_next_step_handler(message, get_description)
 
+@metrics.step
+@log_setup.step
 def get_description(message):
     if message.text == "Назад":
         get_service_type(message)
@@ -210,47 +97,20 @@ def get_description(message):
         description = message.text
 
     if not re.match(r'^(\+7|8)\d{10}$', description) and not re.match(r'^\+?\d{11,15}$', description):
-        bot.send_message(message.chat.id, "Неверный формат номера телефона. Пожалуйста, введите номер в формате +7XXXXXXXXXX, 8XXXXXXXXXX или международном формате.")
-        bot.register_next_step_handler(message, get_description)
+        sender.send_message(message.chat.id, "Неверный формат номера телефона. Пожалуйста, введите номер в формате +7XXXXXXXXXX, 8XXXXXXXXXX или международном формате.")
+        register_next_step_handler(message, get_description)
         return
 
-    user_states[message.chat.id]['description'] = description
-    user_states[message.chat.id]['username'] = message.from_user.username  # Сохраняем username
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-    markup.add(types.KeyboardButton("Назад"))
-    bot.send_message(message.chat.id, "Выберите дату:", reply_markup=create_date_markup(user_states[message.chat.id]['duration_hours']))
-    bot.register_next_step_handler(message, get_date)
+    state = states.update(message.chat.id, description=description,
+                          username=message.from_user.username)  # Сохраняем username
+    sender.send_message(message.chat.id, "Выберите дату:", reply_markup=create_date_markup(state.duration_hours))
+    register_next_step_handler(message, get_date)
 
 def create_date_markup(duration_hours):
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-    markup.add(types.KeyboardButton("Назад"))
-    today = datetime.datetime.now(UTC_PLUS_4)
-    available_dates = []
-
-    weekdays_ru = {
-        "Mon": "Пн",
-        "Tue": "Вт",
-        "Wed": "Ср",
-        "Thu": "Чт",
-        "Fri": "Пт",
-        "Sat": "Сб",
-        "Sun": "Вс"
-    }
-
-    for i in range(30):  # Проверяем следующие 30 дней
-        date = today + datetime.timedelta(days=i)
-        if get_available_slots(date, duration_hours):  # Добавляем только даты с доступными слотами
-            available_dates.append(date)
-        if len(available_dates) >= 7:  # Ограничиваем количество кнопок до 7
-            break
-
-    for date in available_dates:
-        weekday = weekdays_ru[date.strftime('%a')]  # Получаем день недели на русском
-        day_with_weekday = f"{weekday} {date.strftime('%d.%m.%y')}"  # Форматируем строку
-        markup.add(types.KeyboardButton(day_with_weekday))
-
-    return markup
+    return keyboards.date_markup(services.get_available_dates(duration_hours))
 
+@metrics.step
+@log_setup.step
 def get_date(message):
     if message.text == "Назад":
         get_summary(message)
@@ -261,217 +121,203 @@ def get_date(message):
         date_str = re.sub(r'^[А-Яа-я]+\s', '', message.text)
         date = datetime.datetime.strptime(date_str, "%d.%m.%y").replace(tzinfo=UTC_PLUS_4)
     except ValueError:
-        bot.send_message(message.chat.id, "Неверный формат даты. Пожалуйста, выберите дату из предложенных вариантов.")
-        bot.register_next_step_handler(message, get_date)
+        sender.send_message(message.chat.id, "Неверный формат даты. Пожалуйста, выберите дату из предложенных вариантов.")
+        register_next_step_handler(message, get_date)
         return
 
-    user_states[message.chat.id]['date'] = date
-    available_slots = get_available_slots(date, user_states[message.chat.id]['duration_hours'])
+    state = states.update(message.chat.id, date=date)
+    available_slots = get_available_slots(date, state.duration_hours)
     if available_slots:
-        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-        markup.add(types.KeyboardButton("Назад"))
-        for slot in available_slots:
-            markup.add(types.KeyboardButton(slot.strftime('%H:%M')))
-        bot.send_message(message.chat.id, "Выберите время:", reply_markup=markup)
-        bot.register_next_step_handler(message, get_time)
+        sender.send_message(message.chat.id, "Выберите время:", reply_markup=keyboards.time_markup(available_slots))
+        register_next_step_handler(message, get_time)
     else:
-        bot.send_message(message.chat.id, "На выбранную дату нет свободных слотов. Пожалуйста, выберите другую дату.")
-        bot.register_next_step_handler(message, get_date)
+        sender.send_message(message.chat.id, "На выбранную дату нет свободных слотов. Пожалуйста, выберите другую дату.")
+        register_next_step_handler(message, get_date)
 
 def get_available_slots(date, duration_hours):
-    events = calendar.get_events_list(date)
-    start_of_day = max(date.replace(hour=10, minute=0, second=0, microsecond=0, tzinfo=UTC_PLUS_4), datetime.datetime.now(UTC_PLUS_4))
-    end_of_day = date.replace(hour=22, minute=0, second=0, microsecond=0, tzinfo=UTC_PLUS_4)
-
-    events.sort(key=lambda x: datetime.datetime.fromisoformat(x['start']['dateTime']).astimezone(UTC_PLUS_4))
-
-    def is_slot_free(start_time, end_time):
-        for event in events:
-            event_start = datetime.datetime.fromisoformat(event['start']['dateTime']).astimezone(UTC_PLUS_4)
-            event_end = datetime.datetime.fromisoformat(event['end']['dateTime']).astimezone(UTC_PLUS_4)
-            if not (end_time <= event_start or start_time >= event_end):
-                return False
-        return True
-
-    def round_to_nearest_5_minutes(dt):
-        minutes = dt.minute
-        rounded_minutes = (minutes // 5) * 5
-        if minutes % 5 != 0:
-            rounded_minutes += 5
-        if rounded_minutes >= 60:
-            rounded_minutes = 0
-            dt += datetime.timedelta(hours=1)
-        return dt.replace(minute=rounded_minutes, second=0, microsecond=0)
-
-    current_time = round_to_nearest_5_minutes(start_of_day)
-    available_slots = []
-    while current_time < end_of_day:
-        end_time = current_time + datetime.timedelta(hours=duration_hours)
-        if end_time > end_of_day:
-            break
-
-        if is_slot_free(current_time, end_time):
-            available_slots.append(current_time)
-
-        current_time += datetime.timedelta(minutes=30)
-
-    return available_slots
+    return services.get_available_slots(date, duration_hours)
 
+@metrics.step
+@log_setup.step
 def get_time(message):
     if message.text == "Назад":
         get_date(message)
         return
 
+    state = states.get(message.chat.id)
     time_str = message.text
     try:
         time = datetime.datetime.strptime(time_str, "%H:%M").time()
-        start_time = datetime.datetime.combine(user_states[message.chat.id]['date'].date(), time).replace(tzinfo=UTC_PLUS_4)
-        end_time = start_time + datetime.timedelta(hours=user_states[message.chat.id]['duration_hours'])
+        start_time = datetime.datetime.combine(state.date.date(), time).replace(tzinfo=UTC_PLUS_4)
+        end_time = start_time + datetime.timedelta(hours=state.duration_hours)
     except ValueError:
-        bot.send_message(message.chat.id, "Неверный формат времени. Пожалуйста, выберите время из предложенных вариантов.")
-        bot.register_next_step_handler(message, get_time)
+        sender.send_message(message.chat.id, "Неверный формат времени. Пожалуйста, выберите время из предложенных вариантов.")
+        register_next_step_handler(message, get_time)
         return
 
-    user_states[message.chat.id]['time'] = time_str
-    cursor.execute('''
-    INSERT INTO requests (user_id, username, duration_hours, summary, description, service_type, date, time)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (message.chat.id, user_states[message.chat.id]['username'], user_states[message.chat.id]['duration_hours'], 
-          user_states[message.chat.id]['summary'], user_states[message.chat.id]['description'], 
-          user_states[message.chat.id]['service_type'], user_states[message.chat.id]['date'].strftime('%Y-%m-%d'), time_str))
-    conn.commit()
-    request_id = cursor.lastrowid
-    
-    # Сохраняем лид в Google Sheets
-    save_to_google_sheets(user_states[message.chat.id]['summary'], user_states[message.chat.id]['description'], user_states[message.chat.id]['username'])
-
-    send_admin_notification(request_id, is_new=True)
-    bot.send_message(message.chat.id, "Ваша заявка отправлена на рассмотрение администратору.")
-
-def save_to_google_sheets(summary, description, username):
+    state = states.update(message.chat.id, time=time_str)
     try:
-        sheet.append_row([summary, description, username, "Новый"])  
-        logging.info("Лид успешно сохранен в Google Sheets")
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении лида в Google Sheets: {e}")
+        # Слот бронируется вместе с заявкой, пока администратор её не рассмотрит
+        request_id = services.create_request(message.chat.id, state.username, state.duration_hours, state.summary,
+                                             state.description, state.service_type,
+                                             state.date.strftime('%Y-%m-%d'), time_str)
+    except SlotTaken:
+        sender.send_message(message.chat.id, "Это время уже занято. Пожалуйста, выберите другое время.",
+                            reply_markup=keyboards.time_markup(get_available_slots(state.date, state.duration_hours)))
+        register_next_step_handler(message, get_time)
+        return
+    log_setup.bind(request_id=request_id)
 
-def update_google_sheet_status(summary, description, status):
-    try:
-    
-        cell = sheet.find(summary)
-        row = cell.row
-        # Проверяем что номер телефона совпадает
-        if sheet.cell(row, 2).value == description:
-            sheet.update_cell(row, 4, status)  
-            logging.info(f"Статус обновлен в Google Sheets: {status}")
-        else:
-            logging.error("Не удалось найти соответствующую запись в Google Sheets.")
-    except Exception as e:
-        logging.error(f"Ошибка при обновлении статуса в Google Sheets: {e}")
+    # Сохраняем лид в Google Sheets
+    leads.save_lead(state.summary, state.description, state.username, request_id)
+
+    if config.ADMIN_NOTIFY_EACH:
+        send_admin_notification(request_id, is_new=True)
+    sender.send_message(message.chat.id, "Ваша заявка отправлена на рассмотрение администратору.")
+    # Заявка сохранена — состояние диалога больше не нужно
+    states.delete(message.chat.id)
 
 def send_admin_notification(request_id, is_new=False):
-    cursor.execute('SELECT * FROM requests WHERE id = ?', (request_id,))
-    request = cursor.fetchone()
-    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:]  # Include username
-
-    markup = types.InlineKeyboardMarkup()
-    approve_button = types.InlineKeyboardButton("Одобрить", callback_data=f"approve_{request_id}")
-    reject_button = types.InlineKeyboardButton("Отклонить", callback_data=f"reject_{request_id}")
-    change_button = types.InlineKeyboardButton("Изменить", callback_data=f"change_{request_id}")
-    markup.add(approve_button, reject_button, change_button)
-
-    if is_new:
-        bot.send_message(admin_id, f"Новая заявка:\n\n"
-                                   f"Услуга: {service_type}\n"
-                                   f"Модель машины: {summary}\n"
-                                   f"Номер телефона: {description}\n"
-                                   f"Имя пользователя: @{username}\n"
-                                   f"Дата: {date}\n"
-                                   f"Время: {time}\n"
-                                   f"Длительность: {duration_hours} часов", reply_markup=markup)
-    else:
-        bot.send_message(admin_id, f"Измененная заявка:\n\n"
-                                   f"Услуга: {service_type}\n"
-                                   f"Модель машины: {summary}\n"
-                                   f"Номер телефона: {description}\n"
-                                   f"Имя пользователя: @{username}\n"
-                                   f"Дата: {date}\n"
-                                   f"Время: {time}\n"
-                                   f"Длительность: {duration_hours} часов", reply_markup=markup)
+    request = requests_repo.get(request_id)
+    # Неотправленное уведомление по той же заявке заменяется новым
+    sender.send_message(admin_id, keyboards.admin_request_text(request, is_new),
+                        reply_markup=keyboards.admin_request_markup(request_id), key=('request', request_id))
+
+def is_admin(chat_id):
+    return str(chat_id) == str(admin_id)
+
+def queue_view(page, selected):
+    requests, page, pages, total = services.pending_page(page)
+    return (keyboards.queue_text(requests, page, pages, total, selected),
+            keyboards.queue_markup(requests, page, pages, selected))
+
+# Регистрируется раньше общего обработчика кнопок заявок
+@bot.callback_query_handler(func=lambda call: call.data.startswith('queue_') and is_admin(call.message.chat.id))
+@metrics.step
+@log_setup.step
+def handle_queue_callback(call):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    data = call.data.split('_')
+    action, page = data[1], int(data[-1])
+    state = states.get(chat_id)
+    selected = set(state.selected or []) if state else set()
+
+    if action == "toggle":
+        selected ^= {int(data[2])}
+    elif action == "page":
+        # Возврат к очереди из статусов пакета
+        services.approval_jobs.detach(chat_id, message_id)
+    elif action == "approve":
+        # Выбранные заявки одобряются одним пакетом; события, уведомления клиентов и
+        # статусы в таблице — в заданиях одобрения, их ход показывается в этом сообщении
+        approved, taken = services.approve_requests(sorted(selected), chat_id, message_id)
+        for request, _ in approved:
+            sender.discard(('request', request[0]))
+        if taken:
+            sender.send_message(admin_id, f"Время уже занято по заявкам: {', '.join(f'#{i}' for i in taken)}. Измените дату или время заявок.")
+        logger.info("Заявки одобрены: %s", [request[0] for request, _ in approved])
+        states.update(chat_id, selected=[])
+        if approved:
+            return
+        selected = set()
+    elif action == "reject":
+        rejected = services.reject_requests(sorted(selected))
+        for request in rejected:
+            sender.discard(('request', request[0]))
+            sender.send_message(request[1], "Ваша заявка отклонена.")
+        leads.update_statuses([(request[4], request[5], "Отклонено", request[0]) for request in rejected])
+        logger.info("Заявки отклонены: %s", [request[0] for request in rejected])
+        selected = set()
+
+    states.update(chat_id, selected=sorted(selected))
+    text, markup = queue_view(page, selected)
+    # Быстрые нажатия подряд сливаются в одно редактирование сообщения
+    sender.edit_message_text(chat_id, message_id, text, reply_markup=markup, key=('queue', message_id))
 
 @bot.callback_query_handler(func=lambda call: True)
+@metrics.step
+@log_setup.step
 def handle_callback_query(call):
     data = call.data.split('_')
     action = data[0]
     request_id = int(data[1])
+    log_setup.bind(request_id=request_id)
+
+    request = requests_repo.get(request_id)
+    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:9]
+    # Уведомления по заявке, которые ещё ждут отправки, устарели
+    sender.discard(('request', request_id))
 
-    cursor.execute('SELECT * FROM requests WHERE id = ?', (request_id,))
-    request = cursor.fetchone()
-    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:]
+    if action in ("approve", "reject", "change") and request[11] != STATUS_PENDING:
+        # Заявку уже рассмотрели, например пакетом из /queue
+        sender.delete_message(chat_id=admin_id, message_id=call.message.message_id)
+        sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена.")
+        return
 
     if action == "approve":
-        date = datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=UTC_PLUS_4)
-        time = datetime.datetime.strptime(time, "%H:%M").time()
-        start_time = datetime.datetime.combine(date.date(), time).replace(tzinfo=UTC_PLUS_4)
-        end_time = start_time + datetime.timedelta(hours=duration_hours)
-        event = calendar.create_event_dict(start_time, end_time, summary, description, service_type)
-        calendar.create_event(event)
-        formatted_start_time = start_time.strftime('%H:%M %d.%m.%y')
-        bot.send_message(user_id, f"Ваша заявка одобрена!\n\n"
-                                  f"Услуга: {service_type}\n"
-                                  f"Модель машины: {summary}\n"
-                                  f"Номер телефона: {description}\n"
-                                  f"Имя пользователя: @{username}\n"
-                                  f"Время записи: {formatted_start_time}")
-        bot.delete_message(chat_id=admin_id, message_id=call.message.message_id)
-        logging.info(f"Заявка {request_id} одобрена")
-
-
-        update_google_sheet_status(summary, description, "Одобрено")
+        # Событие, уведомление клиента и статус в таблице — в задании одобрения;
+        # ход задания показывается в этом же сообщении администратора
+        try:
+            services.approve_request(request_id, admin_id, call.message.message_id)
+        except RequestNotPending:
+            sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена.")
+            return
+        except SlotTaken:
+            sender.send_message(admin_id, f"Время по заявке {request_id} уже занято. Измените дату или время заявки.")
+            return
+        logger.info("Заявка %s одобрена", request_id)
     elif action == "reject":
-        bot.delete_message(chat_id=admin_id, message_id=call.message.message_id)
-        bot.send_message(user_id, "Ваша заявка отклонена.")
-        logging.info(f"Заявка {request_id} отклонена")
+        rejected = services.reject_request(request_id)
+        sender.delete_message(chat_id=admin_id, message_id=call.message.message_id)
+        if not rejected:
+            sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена.")
+            return
+        sender.send_message(user_id, "Ваша заявка отклонена.")
+        logger.info("Заявка %s отклонена", request_id)
 
 
-        update_google_sheet_status(summary, description, "Отклонено")
+        leads.update_status(summary, description, "Отклонено", request_id)
     elif action == "change":
-        bot.delete_message(chat_id=admin_id, message_id=call.message.message_id)
-        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-        markup.add(types.KeyboardButton("Назад"))
-        bot.send_message(admin_id, "Выберите новую дату:", reply_markup=create_date_markup(duration_hours))
-        bot.register_next_step_handler(call.message, get_admin_date, request_id, duration_hours, summary, description, service_type)
-        logging.info(f"Заявка {request_id} изменена")
-
-def get_admin_date(message, request_id, duration_hours, summary, description, service_type):
+        try:
+            markup = create_date_markup(duration_hours)
+        except CalendarUnavailable:
+            sender.send_message(admin_id, keyboards.CALENDAR_UNAVAILABLE)
+            return
+        sender.delete_message(chat_id=admin_id, message_id=call.message.message_id)
+        sender.send_message(admin_id, "Выберите новую дату:", reply_markup=markup)
+        register_next_step_handler(call.message, get_admin_date, request_id, duration_hours)
+        logger.info("Заявка %s изменена", request_id)
+
+@metrics.step
+@log_setup.step
+def get_admin_date(message, request_id, duration_hours):
     if message.text == "Назад":
         send_admin_notification(request_id, is_new=False)
         return
 
     try:
-    
+
         date_str = re.sub(r'^[А-Яа-я]+\s+', '', message.text.strip())
         date = datetime.datetime.strptime(date_str, "%d.%m.%y").replace(tzinfo=UTC_PLUS_4)
     except ValueError:
-        bot.send_message(admin_id, "Неверный формат даты. Пожалуйста, выберите дату из предложенных вариантов.")
-        bot.register_next_step_handler(message, get_admin_date, request_id, duration_hours, summary, description, service_type)
+        sender.send_message(admin_id, "Неверный формат даты. Пожалуйста, выберите дату из предложенных вариантов.")
+        register_next_step_handler(message, get_admin_date, request_id, duration_hours)
         return
 
     available_slots = get_available_slots(date, duration_hours)
     if available_slots:
-        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True)
-        markup.add(types.KeyboardButton("Назад"))
-        for slot in available_slots:
-            markup.add(types.KeyboardButton(slot.strftime('%H:%M')))
-        bot.send_message(admin_id, "Выберите новое время:", reply_markup=markup)
-        bot.register_next_step_handler(message, get_admin_time, request_id, duration_hours, summary, description, service_type, date)
+        sender.send_message(admin_id, "Выберите новое время:", reply_markup=keyboards.time_markup(available_slots))
+        register_next_step_handler(message, get_admin_time, request_id, duration_hours, date)
     else:
-        bot.send_message(admin_id, "На выбранную дату нет свободных слотов. Пожалуйста, выберите другую дату.")
-        bot.register_next_step_handler(message, get_admin_date, request_id, duration_hours, summary, description, service_type)
+        sender.send_message(admin_id, "На выбранную дату нет свободных слотов. Пожалуйста, выберите другую дату.")
+        register_next_step_handler(message, get_admin_date, request_id, duration_hours)
 
-def get_admin_time(message, request_id, duration_hours, summary, description, service_type, date):
+@metrics.step
+@log_setup.step
+def get_admin_time(message, request_id, duration_hours, date):
     if message.text == "Назад":
-        get_admin_date(message)
+        sender.send_message(admin_id, "Выберите новую дату:", reply_markup=create_date_markup(duration_hours))
+        register_next_step_handler(message, get_admin_date, request_id, duration_hours)
         return
 
     time_str = message.text
@@ -480,33 +326,125 @@ def get_admin_time(message, request_id, duration_hours, summary, description, se
         start_time = datetime.datetime.combine(date.date(), time).replace(tzinfo=UTC_PLUS_4)
         end_time = start_time + datetime.timedelta(hours=duration_hours)
     except ValueError:
-        bot.send_message(admin_id, "Неверный формат времени. Пожалуйста, выберите время из предложенных вариантов.")
-        bot.register_next_step_handler(message, get_admin_time, request_id, duration_hours, summary, description, service_type, date)
+        sender.send_message(admin_id, "Неверный формат времени. Пожалуйста, выберите время из предложенных вариантов.")
+        register_next_step_handler(message, get_admin_time, request_id, duration_hours, date)
         return
 
-    cursor.execute('''
-    UPDATE requests SET date = ?, time = ? WHERE id = ?
-    ''', (date.strftime('%Y-%m-%d'), time_str, request_id))
-    conn.commit()
+    try:
+        services.move_request(request_id, duration_hours, date.strftime('%Y-%m-%d'), time_str)
+    except RequestNotPending:
+        sender.send_message(admin_id, f"Заявка {request_id} уже рассмотрена, перенос отменён.")
+        return
+    except SlotTaken:
+        sender.send_message(admin_id, "Это время уже занято. Пожалуйста, выберите другое время.",
+                            reply_markup=keyboards.time_markup(get_available_slots(date, duration_hours)))
+        register_next_step_handler(message, get_admin_time, request_id, duration_hours, date)
+        return
 
-    formatted_start_time = start_time.strftime('%H:%M %d.%м.%y')
-    bot.delete_message(chat_id=admin_id, message_id=message.message_id)
+    sender.delete_message(chat_id=admin_id, message_id=message.message_id)
 
     # Отправляем заявку на повторное рассмотрение администратору
     send_admin_notification(request_id, is_new=False)
 
 @bot.message_handler(commands=['start'])
 def start(message):
-    btn1 = 'Записаться'
-    btn2 = 'Контакты'
-    markup = types.ReplyKeyboardMarkup().row(btn1).row(btn2)
-    bot.send_message(message.chat.id, "Приветственное сообщение", reply_markup=markup)
+    sender.send_message(message.chat.id, "Приветственное сообщение", reply_markup=keyboards.start_markup())
+
+@bot.message_handler(commands=['queue'], func=lambda message: is_admin(message.chat.id))
+def show_queue(message):
+    # Очередь заявок на рассмотрении с выбором нескольких заявок
+    states.update(message.chat.id, selected=[])
+    text, markup = queue_view(0, set())
+    sender.send_message(message.chat.id, text, reply_markup=markup)
+
+@bot.message_handler(commands=['jobs'], func=lambda message: is_admin(message.chat.id))
+def show_jobs(message):
+    sender.send_message(message.chat.id, keyboards.jobs_text(services.approval_jobs.recent()))
+
+@bot.message_handler(commands=['retry'], func=lambda message: is_admin(message.chat.id))
+def retry_jobs(message):
+    # /retry 12 — вернуть в очередь неудавшееся задание одобрения, /retry — все неудавшиеся
+    parts = message.text.split()
+    if len(parts) > 1 and not parts[1].isdigit():
+        sender.send_message(message.chat.id, "Укажите номер задания, например: /retry 12")
+        return
+    job_id = int(parts[1]) if len(parts) > 1 else None
+    sender.send_message(message.chat.id, keyboards.retry_text(services.retry_approvals(job_id), job_id))
+
+@bot.message_handler(commands=['stats'], func=lambda message: is_admin(message.chat.id))
+@metrics.step
+@log_setup.step
+def show_stats(message):
+    try:
+        days = keyboards.period_days(message.text, config.STATS_DEFAULT_DAYS)
+    except ValueError:
+        sender.send_message(message.chat.id, keyboards.period_help("stats"))
+        return
+    sender.send_message(message.chat.id, services.stats(days))
+
+@bot.message_handler(commands=['export'], func=lambda message: is_admin(message.chat.id))
+@metrics.step
+@log_setup.step
+def export_requests(message):
+    try:
+        days = keyboards.period_days(message.text, None)
+    except ValueError:
+        sender.send_message(message.chat.id, keyboards.period_help("export"))
+        return
+    document, name, count = services.export(days)
+    sender.send_document(message.chat.id, document, visible_file_name=name, caption=f"Заявок: {count}")
+    logger.info("Выгружено заявок: %s", count)
+
+@bot.message_handler(commands=['noshow'], func=lambda message: is_admin(message.chat.id))
+def mark_no_show(message):
+    # /noshow 123 — клиент по одобренной заявке не приехал
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        sender.send_message(message.chat.id, "Укажите номер заявки, например: /noshow 123")
+        return
+    if services.mark_no_show(int(parts[1])):
+        sender.send_message(message.chat.id, f"Заявка {parts[1]} отмечена: клиент не приехал.")
+    else:
+        sender.send_message(message.chat.id, f"Заявка {parts[1]} не найдена среди одобренных.")
 
 @bot.message_handler(content_types=['text'])
 def func(message):
     if message.text == "Записаться":
         create_event(message)
     elif message.text == "Контакты":
-        bot.send_message(message.chat.id, "123")
+        sender.send_message(message.chat.id, "123")
+
+# Шаги сценария, на которые может указывать сохранённое состояние. Таблица состояний
+# общая с async_bot.py, поэтому имена и аргументы шагов в обоих режимах одинаковые
+STEPS = {handler.__name__: handler for handler in (
+    get_service_type, get_summary, get_description, get_date, get_time, get_admin_date, get_admin_time)}
+
+def create_webhook_server(host, port):
+    dispatcher = webhook.ChatDispatcher(lambda update: bot.process_new_updates([types.Update.de_json(update)]),
+                                        config.WEBHOOK_WORKERS, config.WEBHOOK_MAX_PENDING)
+    return webhook.WebhookServer((host, port), config.WEBHOOK_PATH, config.WEBHOOK_SECRET, dispatcher)
+
+
+def run_webhook():
+    server = create_webhook_server(config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    if config.WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=config.WEBHOOK_URL + config.WEBHOOK_PATH, secret_token=config.WEBHOOK_SECRET or None,
+                        max_connections=config.WEBHOOK_WORKERS)
+    logger.info("Вебхук слушает %s:%s%s", config.WEBHOOK_HOST, config.WEBHOOK_PORT, config.WEBHOOK_PATH)
+    server.serve_forever()
+
+def main():
+    services.start_background()
+
+    if config.BOT_MODE == 'webhook':
+        run_webhook()
+    elif config.BOT_MODE == 'async':
+        # aiohttp нужен только асинхронному режиму, поэтому импортируем здесь
+        import async_bot
+        async_bot.run()
+    else:
+        bot.polling()
 
-bot.polling()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import bisect
+import functools
+import http.server
+import inspect
+import logging
+import threading
+import time
+
+import config
+
+# Метрики в текстовом формате Prometheus.
+# Гистограммы времени шагов сценария, внешних вызовов (Calendar, Sheets,
+# Telegram) и фиксаций SQLite, счётчики попаданий в кэши. Отдаются по HTTP
+# на /metrics. При METRICS_ENABLED = False декоратор timed возвращает функцию
+# без обёртки, а замеры и счётчики ничего не делают.
+
+logger = logging.getLogger(__name__)
+
+ENABLED = config.METRICS_ENABLED
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        # Дочерние метрики кэшируются: вызывающий код может сохранить результат и не искать его каждый раз
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.children.items()):
+            lines.extend(child.render(self.name, format_labels(self.labelnames, values), self.labelnames, values))
+        return lines
+
+
+class CounterChild(object):
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if ENABLED:
+            with self.lock:
+                self.value += amount
+
+    def render(self, name, labels, labelnames, values):
+        return [f'{name}{labels} {self.value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+    child = CounterChild
+
+
+class HistogramChild(object):
+    __slots__ = ('counts', 'sum', 'lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        if ENABLED:
+            i = bisect.bisect_left(BUCKETS, value)
+            with self.lock:
+                self.counts[i] += 1
+                self.sum += value
+
+    def time(self):
+        return Timer(self) if ENABLED else NULL_TIMER
+
+    def render(self, name, labels, labelnames, values):
+        lines = []
+        total = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            total += count
+            le = 'le="%s"' % ('+Inf' if bound == float('inf') else repr(bound))
+            lines.append(f'{name}_bucket{format_labels(labelnames, values, [le])} {total}')
+        lines.append(f'{name}_sum{labels} {self.sum}')
+        lines.append(f'{name}_count{labels} {total}')
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    child = HistogramChild
+
+
+class Timer(object):
+    __slots__ = ('histogram', 'errors', 'started')
+
+    def __init__(self, histogram, errors=None):
+        self.histogram = histogram
+        self.errors = errors
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc()
+        return False
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_TIMER = NullTimer()
+REGISTRY = []
+COLLECTORS = []
+
+STEP_SECONDS = Histogram('stobot_step_seconds', 'Время шага сценария записи', ('step',))
+FUNCTION_SECONDS = Histogram('stobot_function_seconds', 'Время внутренних операций (расчёт слотов, заявки)',
+                             ('function',))
+EXTERNAL_SECONDS = Histogram('stobot_external_seconds', 'Время вызовов Google Calendar, Google Sheets и Telegram',
+                             ('service', 'method'))
+EXTERNAL_ERRORS = Counter('stobot_external_errors_total', 'Ошибки вызовов внешних API', ('service', 'method'))
+DB_COMMIT_SECONDS = Histogram('stobot_db_commit_seconds', 'Время групповой транзакции SQLite')
+DB_WRITES = Counter('stobot_db_writes_total', 'Записи SQLite, прошедшие через групповые транзакции')
+CACHE_REQUESTS = Counter('stobot_cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+
+
+def external(service, method):
+    # with metrics.external('calendar', 'list'): ... — время вызова и ошибки
+    if not ENABLED:
+        return NULL_TIMER
+    return Timer(EXTERNAL_SECONDS.labels(service, method), EXTERNAL_ERRORS.labels(service, method))
+
+
+def cache(name, hit):
+    CACHE_REQUESTS.labels(name, 'hit' if hit else 'miss').inc()
+
+
+def timed(histogram, *labels):
+    # Декоратор для функций и корутин. Без меток — метка по имени функции
+    def decorate(func):
+        if not ENABLED:
+            return func
+        child = histogram.labels(*(labels or (func.__name__,)))
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+step = timed(STEP_SECONDS)
+function = timed(FUNCTION_SECONDS)
+
+
+def add_collector(collect):
+    # collect() -> [(имя, тип, описание, {метки: значение})] вычисляется при каждом запросе /metrics
+    COLLECTORS.append(collect)
+
+
+def cache_ratios():
+    hits, totals = {}, {}
+    for (name, result), child in list(CACHE_REQUESTS.children.items()):
+        totals[name] = totals.get(name, 0) + child.value
+        if result == 'hit':
+            hits[name] = child.value
+    ratios = {(('cache', name),): hits.get(name, 0) / total for name, total in totals.items() if total}
+    return [('stobot_cache_hit_ratio', 'gauge', 'Доля попаданий в кэш', ratios)]
+
+
+add_collector(cache_ratios)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collect in COLLECTORS:
+        try:
+            samples = collect()
+        except Exception as e:
+            logger.error("Ошибка при сборе метрик: %s", e)
+            continue
+        for name, kind, documentation, values in samples:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(values.items()):
+                lines.append(f'{name}{format_labels([k for k, _ in labels], [v for _, v in labels])} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,144 @@
+import codecs
+import csv
+import datetime
+import io
+import tempfile
+
+from db import STATUS_APPROVED, STATUS_NO_SHOW
+
+# Отчёты и выгрузка по таблице requests.
+# Агрегаты за период считает SQLite одним запросом с группировкой по покрывающему
+# индексу requests_report — в Python приходят десятки строк, а не вся история.
+# Выгрузка читает курсор порциями (fetchmany) и пишет CSV во временный файл,
+# поэтому память не растёт с числом заявок.
+
+# Весь период: даты заявок хранятся как 'YYYY-MM-DD'
+MIN_DATE = '0000-01-01'
+MAX_DATE = '9999-12-31'
+
+SELECT_STATS = '''
+SELECT status, service_type, resource_id, date < ? AS past,
+       min(date), count(*), total(duration_hours), total(decided_at - created_at), count(decided_at - created_at)
+FROM requests
+WHERE date BETWEEN ? AND ?
+GROUP BY status, service_type, resource_id, past
+'''
+# Время Unix переводится в местное в SQLite, сдвиг часового пояса — параметр ?1
+SELECT_EXPORT = '''
+SELECT id, strftime('%Y-%m-%d %H:%M:%S', created_at, 'unixepoch', ?1),
+       strftime('%Y-%m-%d %H:%M:%S', decided_at, 'unixepoch', ?1), date, time, service_type, duration_hours, status, resource_id,
+       username, summary, description
+FROM requests
+WHERE date BETWEEN ?2 AND ?3
+ORDER BY date, time, id
+'''
+EXPORT_HEADER = ('id', 'created_at', 'decided_at', 'date', 'time', 'service_type', 'duration_hours', 'status',
+                 'resource', 'username', 'model', 'phone')
+
+
+class Stats(object):
+
+    def __init__(self, date_from, date_to):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.total = 0
+        self.first_date = None
+        self.by_status = {}
+        # тип услуги -> [заявок, одобрено]
+        self.by_service = {}
+        # id поста -> часов, занятых записями в прошедшие дни
+        self.booked_hours = {}
+        self.no_show = 0
+        self.past_approved = 0
+        self.decision_seconds = 0.0
+        self.decisions = 0
+
+    def add(self, status, service_type, resource_id, past, first_date, count, hours, decision_seconds, decisions):
+        self.total += count
+        self.first_date = min(self.first_date or first_date, first_date)
+        self.by_status[status] = self.by_status.get(status, 0) + count
+        service = self.by_service.setdefault(service_type, [0, 0])
+        service[0] += count
+        if status in (STATUS_APPROVED, STATUS_NO_SHOW):
+            service[1] += count
+            if past:
+                self.booked_hours[resource_id] = self.booked_hours.get(resource_id, 0) + hours
+                self.past_approved += count
+        if status == STATUS_NO_SHOW:
+            self.no_show += count
+        self.decision_seconds += decision_seconds
+        self.decisions += decisions
+
+    def no_show_rate(self):
+        # Среди прошедших одобренных заявок
+        return self.no_show / self.past_approved if self.past_approved else None
+
+    def average_decision(self):
+        return self.decision_seconds / self.decisions if self.decisions else None
+
+    def utilisation(self, resource, today):
+        # Доля рабочих часов поста, занятых записями, за прошедшие дни периода.
+        # Без заявок в периоде или без прошедших дней — None
+        if self.first_date is None:
+            return None
+        date_from = datetime.date.fromisoformat(max(self.date_from, self.first_date))
+        date_to = min(datetime.date.fromisoformat(self.date_to), today - datetime.timedelta(days=1))
+        capacity = ((date_to - date_from).days + 1) * (resource.work_end - resource.work_start)
+        return self.booked_hours.get(resource.id, 0) / capacity if capacity > 0 else None
+
+
+class Reports(object):
+
+    def __init__(self, db, tz, batch_size=1000):
+        self.db = db
+        self.tz = tz
+        self.batch_size = batch_size
+
+    def today(self):
+        return datetime.datetime.now(self.tz).date()
+
+    def period(self, days=None):
+        # Последние days дней по сегодня включительно; None — вся история
+        if days is None:
+            return MIN_DATE, MAX_DATE
+        today = self.today()
+        return (today - datetime.timedelta(days=days - 1)).isoformat(), today.isoformat()
+
+    def stats(self, date_from, date_to):
+        stats = Stats(date_from, date_to)
+        for row in self.db.connection().execute(SELECT_STATS, (self.today().isoformat(), date_from, date_to)):
+            stats.add(*row)
+        return stats
+
+    def rows(self, date_from, date_to):
+        # Курсор читается порциями, пока вызывающий код перебирает строки
+        offset = f'{int(self.tz.utcoffset(None).total_seconds()):+d} seconds'
+        cursor = self.db.connection().execute(SELECT_EXPORT, (offset, date_from, date_to))
+        try:
+            while True:
+                batch = cursor.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            cursor.close()
+
+    def export_csv(self, date_from, date_to, resource_names=None):
+        # Возвращает (открытый временный файл с CSV, число строк). Кодировка с BOM — для Excel
+        resource_names = resource_names or {}
+        file = tempfile.TemporaryFile()
+        file.write(codecs.BOM_UTF8)
+        text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_HEADER)
+        count = 0
+        for row in self.rows(date_from, date_to):
+            (request_id, created_at, decided_at, date, time, service_type, duration_hours, status, resource_id,
+             username, summary, description) = row
+            writer.writerow((request_id, created_at, decided_at, date, time, service_type, duration_hours, status,
+                             resource_names.get(resource_id, resource_id), username, summary, description))
+            count += 1
+        text.flush()
+        text.detach()
+        file.seek(0)
+        return file, count
@@ -0,0 +1,231 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from telebot import apihelper
+
+import log_setup
+import metrics
+
+# Исходящие сообщения Telegram.
+# Обработчики только ставят сообщение в очередь, отправляют его фоновые потоки
+# с ограничением скорости: общее ведро токенов (Telegram допускает около 30
+# сообщений в секунду) и ведро на каждый чат (около одного в секунду).
+# Порядок сообщений внутри чата сохраняется. Ответ 429 откладывает чат на
+# retry_after секунд, сетевые ошибки повторяются с нарастающей задержкой.
+# Сообщение с ключом заменяет ещё не отправленное сообщение с тем же ключом,
+# а discard(key) убирает его из очереди, например когда заявка уже рассмотрена.
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def wait_time(self, now):
+        # Сколько ждать до свободного токена; 0 — можно отправлять
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+
+class OutgoingMessage(object):
+    __slots__ = ('chat_id', 'method', 'kwargs', 'key', 'attempts')
+
+    def __init__(self, chat_id, method, kwargs, key=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.key = key
+        self.attempts = 0
+
+
+def retry_after(error):
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
+class MessageSender(object):
+
+    def __init__(self, bot, rate, chat_rate, chat_burst, workers, max_attempts, max_backoff=60):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.cond = threading.Condition()
+        # Небольшой запас на всплеск: за любую секунду уходит не больше rate * 1.2 сообщений
+        self.bucket = TokenBucket(rate, max(1, rate // 5), time.monotonic())
+        self.chats = {}  # chat_id -> очередь сообщений
+        self.buckets = {}
+        self.busy = set()  # чаты, сообщение которых сейчас отправляется
+        self.ready = []  # куча (когда можно отправлять, порядковый номер, chat_id)
+        self.seq = itertools.count()
+        self.depth = 0
+        self.counters = collections.Counter()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'sender-{i}', daemon=True).start()
+
+    def send_message(self, chat_id, text, key=None, **kwargs):
+        self._enqueue(OutgoingMessage(chat_id, 'send_message', dict(kwargs, chat_id=chat_id, text=text), key))
+
+    def delete_message(self, chat_id, message_id):
+        self._enqueue(OutgoingMessage(chat_id, 'delete_message', {'chat_id': chat_id, 'message_id': message_id}))
+
+    def edit_message_text(self, chat_id, message_id, text, key=None, **kwargs):
+        self._enqueue(OutgoingMessage(chat_id, 'edit_message_text',
+                                      dict(kwargs, chat_id=chat_id, message_id=message_id, text=text), key))
+
+    def send_document(self, chat_id, document, key=None, **kwargs):
+        # document — открытый файл, при каждой попытке он читается с начала
+        self._enqueue(OutgoingMessage(chat_id, 'send_document', dict(kwargs, chat_id=chat_id, document=document),
+                                      key))
+
+    def discard(self, key):
+        # Убирает из очереди ещё не отправленные сообщения с этим ключом
+        with self.cond:
+            for queue in self.chats.values():
+                stale = [message for message in queue if message.key == key]
+                for message in stale:
+                    queue.remove(message)
+                self.depth -= len(stale)
+                self.counters['discarded'] += len(stale)
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, queued=self.depth, chats=len(self.chats), in_flight=len(self.busy))
+
+    def drain(self, timeout=None):
+        # Ждёт, пока очередь опустеет (например, перед остановкой)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.depth or self.busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _enqueue(self, message):
+        with self.cond:
+            queue = self.chats.get(message.chat_id)
+            if queue is None:
+                queue = self.chats[message.chat_id] = collections.deque()
+            if message.key is not None:
+                for i, queued in enumerate(queue):
+                    if queued.key == message.key:
+                        # Более новое уведомление заменяет неотправленное старое на его месте
+                        queue[i] = message
+                        self.counters['coalesced'] += 1
+                        return
+            idle = not queue and message.chat_id not in self.busy
+            queue.append(message)
+            self.depth += 1
+            if idle:
+                self._schedule(message.chat_id, time.monotonic())
+
+    def _schedule(self, chat_id, ready_at):
+        heapq.heappush(self.ready, (ready_at, next(self.seq), chat_id))
+        self.cond.notify()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                # Ведра давно молчащих чатов полны, их можно создать заново
+                for idle in [idle for idle, b in self.buckets.items() if b.is_full(now) and idle not in self.chats]:
+                    del self.buckets[idle]
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _next(self):
+        # Вызывается под self.cond; возвращает сообщение, которое можно отправлять
+        while True:
+            now = time.monotonic()
+            if not self.ready:
+                self.cond.wait()
+                continue
+            ready_at, _, chat_id = self.ready[0]
+            if ready_at > now:
+                self.cond.wait(ready_at - now)
+                continue
+            heapq.heappop(self.ready)
+            queue = self.chats.get(chat_id)
+            if chat_id in self.busy:
+                continue  # Чат запланируют заново после текущей отправки
+            if not queue:
+                self.chats.pop(chat_id, None)
+                continue
+            bucket = self._chat_bucket(chat_id, now)
+            wait = max(bucket.wait_time(now), self.bucket.wait_time(now))
+            if wait > 0:
+                self._schedule(chat_id, now + wait)
+                continue
+            bucket.take()
+            self.bucket.take()
+            self.busy.add(chat_id)
+            self.depth -= 1
+            return queue.popleft()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                message = self._next()
+            with log_setup.context(chat_id=message.chat_id, step=message.method):
+                delay, outcome = self._deliver(message)
+            with self.cond:
+                self.counters[outcome] += 1
+                self.busy.discard(message.chat_id)
+                queue = self.chats.setdefault(message.chat_id, collections.deque())
+                if delay is not None:
+                    queue.appendleft(message)
+                    self.depth += 1
+                if queue:
+                    self._schedule(message.chat_id, time.monotonic() + (delay or 0))
+                else:
+                    del self.chats[message.chat_id]
+                self.cond.notify_all()
+
+    def _deliver(self, message):
+        # Возвращает (задержка перед повтором или None, исход для счётчиков)
+        document = message.kwargs.get('document')
+        if hasattr(document, 'seek'):
+            document.seek(0)
+        try:
+            with metrics.external('telegram', message.method):
+                getattr(self.bot, message.method)(**message.kwargs)
+            return None, 'sent'
+        except apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                delay = retry_after(e)
+                logger.warning("Telegram ограничил отправку в чат %s, повтор через %s с", message.chat_id, delay)
+                return delay, 'rate_limited'
+            # Остальные ответы API (бот заблокирован, сообщение уже удалено) повтором не исправить
+            logger.error("Ошибка %s в чат %s: %s", message.method, message.chat_id, e)
+            return None, 'failed'
+        except Exception as e:
+            message.attempts += 1
+            if message.attempts >= self.max_attempts:
+                logger.error("Не удалось выполнить %s в чат %s: %s", message.method, message.chat_id, e)
+                return None, 'failed'
+            delay = min(2 ** message.attempts, self.max_backoff)
+            logger.warning("Ошибка %s в чат %s, повтор через %s с: %s", message.method, message.chat_id, delay, e)
+            return delay, 'retried'
@@ -0,0 +1,407 @@
+import datetime
+import logging
+import math
+
+import approvals
+import config
+import keyboards
+import log_setup
+import metrics
+import sheets
+import slots
+from availability import AvailabilityCache
+from calendar_store import CalendarStore, CalendarSync
+from db import Database, RequestRepository
+from google_calendar import GoogleCalendar
+from holds import SlotHolds, SlotTaken
+from lazy import lazy
+from reports import Reports
+from sender import MessageSender
+from slots import UTC_PLUS_4, load_resources
+from state_store import StateJanitor, StateStore
+
+# Клиенты Google, база и кэши — общие для синхронного и асинхронного режимов.
+# Всё создаётся при первом обращении: запуск бота не ждёт ни Google, ни базы,
+# а подключения к Google происходят в фоновых потоках или в первом запросе.
+
+logger = logging.getLogger(__name__)
+
+
+class App(object):
+
+    def __init__(self, cfg=config):
+        self.config = cfg
+
+    @lazy
+    def resources(self):
+        # Посты мастерской в порядке, в котором им назначаются заявки
+        return load_resources(self.config.RESOURCES)
+
+    @lazy
+    def resources_by_id(self):
+        return {resource.id: resource for resource in self.resources}
+
+    @lazy
+    def sender(self):
+        # Исходящие сообщения отправляет отдельный синхронный клиент, общий для всех режимов
+        import telebot
+        return MessageSender(telebot.TeleBot(self.config.BOT_TOKEN, threaded=False), self.config.SEND_RATE,
+                             self.config.SEND_CHAT_RATE, self.config.SEND_CHAT_BURST, self.config.SEND_WORKERS,
+                             self.config.SEND_MAX_ATTEMPTS)
+
+    @lazy
+    def database(self):
+        return Database(self.config.DB_PATH, max_batch=self.config.DB_GROUP_COMMIT_MAX)
+
+    @lazy
+    def requests_repo(self):
+        return RequestRepository(self.database)
+
+    @lazy
+    def states(self):
+        # Состояние диалогов: поля заявки и текущий шаг
+        return StateStore(self.database, self.config.STATE_TTL, self.config.STATE_CACHE_SIZE)
+
+    @lazy
+    def worksheet(self):
+        return sheets.open_worksheet()
+
+    @lazy
+    def sheets_outbox(self):
+        return sheets.SheetsOutbox(self.database)
+
+    @lazy
+    def leads(self):
+        # Лиды пишутся в таблицу через исходящую очередь
+        return sheets.LeadSheet(self.sheets_outbox)
+
+    @lazy
+    def calendar_store(self):
+        # Локальное зеркало календаря
+        return CalendarStore(self.database, UTC_PLUS_4)
+
+    @lazy
+    def calendar(self):
+        return GoogleCalendar(self.calendar_store)
+
+    @lazy
+    def holds(self):
+        # Брони слотов под заявками, ещё не попавшими в календарь
+        return SlotHolds(self.database, UTC_PLUS_4, self.config.SLOT_HOLD_TTL, self.resources[0].id)
+
+    @lazy
+    def availability(self):
+        # Кэш доступности сбрасывается по дням при изменениях в зеркале календаря и в бронях
+        availability = AvailabilityCache(self.resources, self.calendar.get_events_ranges, UTC_PLUS_4,
+                                         load_holds=self.holds.active)
+        self.calendar_store.add_listener(availability.invalidate)
+        self.holds.add_listener(availability.invalidate)
+        return availability
+
+    @lazy
+    def approval_jobs(self):
+        # Задания одобрения: событие в календаре, уведомление клиента, статус в Sheets
+        return approvals.ApprovalJobs(self.database)
+
+    @lazy
+    def reports(self):
+        return Reports(self.database, UTC_PLUS_4, self.config.EXPORT_BATCH_SIZE)
+
+    @lazy
+    def calendar_sync(self):
+        calendar_ids = dict.fromkeys(resource.calendar_id for resource in self.resources)
+        return CalendarSync(self.calendar, self.calendar_store, calendar_ids, self.config.CALENDAR_SYNC_INTERVAL)
+
+    def sender_metrics(self):
+        stats = self.sender.stats()
+        counters = {(('outcome', outcome),): stats.get(outcome, 0)
+                    for outcome in ('sent', 'rate_limited', 'failed', 'retried', 'coalesced', 'discarded')}
+        return [('stobot_sender_messages_total', 'counter', 'Исходящие сообщения Telegram по исходу', counters),
+                ('stobot_sender_queued', 'gauge', 'Сообщения в очереди отправки', {(): stats['queued']}),
+                ('stobot_sender_in_flight', 'gauge', 'Сообщения, отправляемые сейчас', {(): stats['in_flight']})]
+
+    def prepare(self):
+        # Компоненты со своими таблицами создаются до первой записи: их схему
+        # нельзя создавать из потока записи
+        return self.states, self.sheets_outbox, self.calendar_store, self.holds, self.approval_jobs
+
+    def start_background(self):
+        self.prepare()
+        self.sender.start()
+        if self.config.METRICS_ENABLED and self.config.METRICS_PORT:
+            metrics.add_collector(self.sender_metrics)
+            metrics.start_server(self.config.METRICS_HOST, self.config.METRICS_PORT)
+        self.calendar_sync.start()
+        StateJanitor(self.states, self.config.STATE_CLEANUP_INTERVAL).start()
+        sheets.SheetsFlusher(self.sheets_outbox, lambda: self.worksheet, self.requests_repo,
+                             self.config.SHEETS_FLUSH_INTERVAL, self.config.SHEETS_BATCH_SIZE,
+                             self.config.SHEETS_MAX_BACKOFF).start()
+        for i in range(self.config.APPROVAL_WORKERS):
+            approvals.ApprovalWorker(self.approval_jobs, run_approval, self.config.APPROVAL_MAX_ATTEMPTS,
+                                     self.config.APPROVAL_MAX_BACKOFF, self.config.APPROVAL_POLL_INTERVAL,
+                                     on_change=report_approval, name=f'approvals-{i}',
+                                     prepare=create_approval_events,
+                                     batch_size=self.config.APPROVAL_BATCH_SIZE).start()
+
+
+def create_app(cfg=config):
+    return App(cfg)
+
+
+app = create_app()
+
+
+def __getattr__(name):
+    # services.states, services.calendar и т.д. — компоненты приложения по умолчанию
+    return getattr(app, name)
+
+
+def start_background():
+    app.start_background()
+
+
+@metrics.function
+def get_available_slots(date, duration_hours):
+    return app.availability.get_slots(date, duration_hours)
+
+
+@metrics.function
+def get_available_dates(duration_hours, days=30, limit=7):
+    availability = app.availability
+    today = datetime.datetime.now(UTC_PLUS_4)
+    available_dates = []
+    availability.prefetch(today, days)  # Недостающие дни загружаются одним запросом
+    for i in range(days):  # Проверяем следующие 30 дней
+        date = today + datetime.timedelta(days=i)
+        if availability.has_slots(date, duration_hours):  # Добавляем только даты с доступными слотами
+            available_dates.append(date)
+        if len(available_dates) >= limit:  # Ограничиваем количество кнопок до 7
+            break
+    return available_dates
+
+
+def request_interval(date, time, duration_hours):
+    # date и time — строки в том виде, в каком они хранятся в заявке
+    date = datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=UTC_PLUS_4)
+    time = datetime.datetime.strptime(time, "%H:%M").time()
+    start_time = datetime.datetime.combine(date.date(), time).replace(tzinfo=UTC_PLUS_4)
+    return start_time, start_time + datetime.timedelta(hours=duration_hours)
+
+
+def slot_reserver(changed, confirmed=False):
+    # Бронь слота для выполнения в транзакции записи заявки: первый пост, свободный
+    # по броням (триггер) и по зеркалу его календаря. Пост, за которым заявка уже
+    # держит слот, проверяется первым. changed собирает дни для сброса кэша
+    # Компоненты создаются здесь, а не в потоке записи: их конструкторы меняют схему
+    holds, resources, calendar_store = app.holds, app.resources, app.calendar_store
+
+    def reserve(conn, request_id, start_time, end_time):
+        start_ts, end_ts = int(start_time.timestamp()), int(end_time.timestamp())
+        held = holds.held_resource(conn, request_id)
+        # Новая запись и перенос — только на будущее время (устаревшая клавиатура, прошлая
+        # дата). Одобрение подтверждает уже выбранный слот, его время не перепроверяется
+        now = start_time if confirmed else datetime.datetime.now(UTC_PLUS_4)
+        for resource in sorted(resources, key=lambda resource: resource.id != held):
+            first, close = slots.resource_window(start_time, UTC_PLUS_4, resource, now=now)
+            if slots.to_minute(start_time) < first or slots.to_minute_ceil(end_time) > close:
+                continue
+            if calendar_store.overlaps(conn, resource.calendar_id, start_ts, end_ts):
+                continue
+            try:
+                changed.update(holds.hold(conn, request_id, resource.id, start_time, end_time, confirmed))
+            except SlotTaken:
+                continue
+            return resource.id
+        raise SlotTaken()
+    return reserve
+
+
+def slot_reservation(start_time, end_time, changed, confirmed=False):
+    # Бронь одного интервала: reserve(conn, request_id)
+    reserve = slot_reserver(changed, confirmed)
+    return lambda conn, request_id: reserve(conn, request_id, start_time, end_time)
+
+
+@metrics.function
+def create_request(user_id, username, duration_hours, summary, description, service_type, date, time):
+    # Заявка создаётся вместе с бронью слота; SlotTaken — время уже занято
+    start_time, end_time = request_interval(date, time, duration_hours)
+    changed = set()
+    request_id = app.requests_repo.create(user_id, username, duration_hours, summary, description, service_type,
+                                          date, time, reserve=slot_reservation(start_time, end_time, changed))
+    app.holds.notify(changed)
+    return request_id
+
+
+@metrics.function
+def move_request(request_id, duration_hours, date, time):
+    # Перенос заявки вместе с бронью; SlotTaken — новое время уже занято
+    start_time, end_time = request_interval(date, time, duration_hours)
+    changed = set()
+    app.requests_repo.update_datetime(request_id, date, time,
+                                      reserve=slot_reservation(start_time, end_time, changed))
+    app.holds.notify(changed)
+
+
+def reject_request(request_id):
+    # False — заявку уже рассмотрели
+    return bool(reject_requests([request_id]))
+
+
+@metrics.function
+def reject_requests(request_ids):
+    # Статусы и снятие броней — одной транзакцией. Возвращает отклонённые заявки
+    rejected, changed = app.requests_repo.reject_many(request_ids, app.holds.drop)
+    app.holds.notify(changed)
+    return rejected
+
+
+@metrics.function
+def approve_request(request_id, admin_chat_id=None, admin_message_id=None):
+    # Подтверждает бронь, закрепляет заявку за постом и в той же транзакции ставит
+    # задание одобрения; событие и уведомления выполнит фоновый воркер.
+    # Возвращает id задания. SlotTaken — бронь истекла и время успели занять,
+    # RequestNotPending — заявку уже рассмотрели
+    changed = set()
+    reserve = slot_reserver(changed, confirmed=True)
+    approval_jobs = app.approval_jobs
+    jobs = []
+
+    def reserve_and_enqueue(conn, request):
+        # Дата и время — из строки, перечитанной в транзакции
+        start_time, end_time = request_interval(request[7], request[8], request[3])
+        resource_id = reserve(conn, request_id, start_time, end_time)
+        jobs.append(approval_jobs.enqueue(conn, request_id, resource_id, admin_chat_id, admin_message_id))
+        return resource_id
+
+    resource_id = app.requests_repo.assign_resource(request_id, reserve_and_enqueue)
+    app.holds.notify(changed)
+    app.approval_jobs.wake()
+    logger.info("Заявка %s назначена на %s", request_id, app.resources_by_id[resource_id].name)
+    report_approval(app.approval_jobs.get(jobs[0]))
+    return jobs[0]
+
+
+def approval_event(job):
+    # (календарь, событие, id события) для задания одобрения
+    request = app.requests_repo.get(job.request_id)
+    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:9]
+    start_time, end_time = request_interval(date, time, duration_hours)
+    event = app.calendar.create_event_dict(start_time, end_time, summary, description, service_type)
+    return app.resources_by_id[job.resource_id].calendar_id, event, approvals.event_id(job.idempotency_key)
+
+
+@metrics.function
+def create_approval_events(jobs):
+    # События заданий, взятых воркером вместе, — одним batch-запросом.
+    # Возвращает {id задания: ошибка}; такие задания повторятся по отдельности.
+    # Одно событие создаст run_approval обычным запросом, без обёртки batch
+    jobs = [job for job in jobs if job.event_id is None]
+    if len(jobs) < 2:
+        return {}
+    items = [approval_event(job) for job in jobs]
+    errors = {}
+    for job, (_, _, event_id), result in zip(jobs, items, app.calendar.insert_events(items)):
+        with log_setup.context(request_id=job.request_id):
+            if isinstance(result, Exception):
+                logger.warning("Событие по заданию %s не создано в пакете: %s", job.id, result)
+                errors[job.id] = result
+                continue
+            app.approval_jobs.update(job.id, event_id=event_id)
+            job.event_id = event_id
+            logger.info("Событие %s по заданию %s создано в пакете", event_id, job.id)
+    return errors
+
+
+@metrics.function
+def run_approval(job):
+    # Шаги задания одобрения; выполненные шаги отмечаются и при повторе пропускаются
+    request = app.requests_repo.get(job.request_id)
+    user_id, username, duration_hours, summary, description, service_type, date, time = request[1:9]
+    start_time, end_time = request_interval(date, time, duration_hours)
+    if job.event_id is None:
+        calendar_id, event, event_id = approval_event(job)
+        app.calendar.insert_event(event, calendar_id, event_id)
+        app.approval_jobs.update(job.id, event_id=event_id)
+    if not job.notified:
+        app.sender.send_message(user_id, keyboards.approved_text(service_type, summary, description, username,
+                                                                 start_time))
+        app.leads.update_status(summary, description, "Одобрено", job.request_id)
+        app.approval_jobs.update(job.id, notified=1)
+
+
+def retry_approvals(job_id=None):
+    return app.approval_jobs.retry(job_id)
+
+
+def report_approval(job):
+    # Статус задания — в сообщении администратора о заявке; у пакета из /queue —
+    # статусы всех заданий пакета
+    if job is None or job.admin_chat_id is None or job.admin_message_id is None:
+        return
+    key = ('approval', job.admin_chat_id, job.admin_message_id)
+    if job.batch:
+        jobs = app.approval_jobs.for_message(job.admin_chat_id, job.admin_message_id)
+        app.sender.edit_message_text(job.admin_chat_id, job.admin_message_id, keyboards.batch_status_text(jobs),
+                                     reply_markup=keyboards.batch_status_markup(), key=key)
+    else:
+        app.sender.edit_message_text(job.admin_chat_id, job.admin_message_id, keyboards.approval_status_text(job),
+                                     key=key)
+
+
+@metrics.function
+def approve_requests(request_ids, admin_chat_id=None, admin_message_id=None):
+    # Пакетное одобрение из /queue: брони, статусы и задания одобрения всех заявок —
+    # одной транзакцией; события и уведомления выполнят воркеры, их статусы
+    # показываются в сообщении /queue. Возвращает ([(заявка, id задания)],
+    # [id заявок, время которых уже занято])
+    changed = set()
+    reserve = slot_reserver(changed, confirmed=True)
+    approval_jobs = app.approval_jobs
+    jobs = {}
+
+    def reserve_and_enqueue(conn, request):
+        start_time, end_time = request_interval(request[7], request[8], request[3])
+        resource_id = reserve(conn, request[0], start_time, end_time)
+        jobs[request[0]] = approval_jobs.enqueue(conn, request[0], resource_id, admin_chat_id, admin_message_id,
+                                                 batch=True)
+        return resource_id
+
+    approved, taken = app.requests_repo.approve_many(request_ids, reserve_and_enqueue, skip=SlotTaken)
+    app.holds.notify(changed)
+    result = [(request, jobs[request[0]]) for request, _ in approved]
+    if result:
+        app.approval_jobs.wake()
+        report_approval(app.approval_jobs.get(result[0][1]))
+    logger.info("Пакетно одобрено заявок: %s, время занято: %s", len(result), len(taken))
+    return result, taken
+
+
+def pending_page(page, page_size=None):
+    # Страница очереди заявок на рассмотрении: (заявки, номер страницы, страниц, всего)
+    page_size = page_size or app.config.QUEUE_PAGE_SIZE
+    total = app.requests_repo.count_pending()
+    pages = max(1, math.ceil(total / page_size))
+    page = min(max(page, 0), pages - 1)
+    return app.requests_repo.pending(page * page_size, page_size), page, pages, total
+
+
+@metrics.function
+def stats(days=None):
+    # Сводка за последние days дней (None — вся история) и текст для администратора
+    date_from, date_to = app.reports.period(days)
+    return keyboards.stats_text(app.reports.stats(date_from, date_to), app.resources, app.reports.today())
+
+
+@metrics.function
+def export(days=None):
+    # CSV за последние days дней: (открытый файл, имя файла, число строк)
+    date_from, date_to = app.reports.period(days)
+    file, count = app.reports.export_csv(date_from, date_to,
+                                         {resource.id: resource.name for resource in app.resources})
+    name = f'requests_{days}d.csv' if days else 'requests_all.csv'
+    return file, name, count
+
+
+def mark_no_show(request_id):
+    return app.requests_repo.mark_no_show(request_id)
@@ -0,0 +1,270 @@
+import json
+import logging
+import re
+import threading
+import time
+
+import config
+import log_setup
+import metrics
+
+# Лиды пишутся в Google Sheets через исходящую очередь в SQLite: обработчик
+# только добавляет строку в очередь, а фоновый поток отправляет накопившиеся
+# строки одним append_rows и при ошибках повторяет с нарастающей задержкой.
+# Номер строки из ответа append_rows сохраняется в заявке, поэтому смена
+# статуса — это одна запись batch_update без поиска по таблице.
+
+logger = logging.getLogger(__name__)
+
+STATUS_COLUMN = 'D'
+
+OUTBOX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sheets_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id INTEGER,
+    row TEXT,
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at REAL DEFAULT 0,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS sheets_outbox_next_attempt ON sheets_outbox (next_attempt_at);
+CREATE INDEX IF NOT EXISTS sheets_outbox_request_id ON sheets_outbox (request_id);
+CREATE TABLE IF NOT EXISTS sheets_status_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id INTEGER,
+    summary TEXT,
+    description TEXT,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at REAL DEFAULT 0,
+    created_at REAL
+);
+'''
+
+INSERT_OUTBOX = 'INSERT INTO sheets_outbox (request_id, row, created_at) VALUES (?, ?, ?)'
+SELECT_DUE = '''
+SELECT id, request_id, row FROM sheets_outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?
+'''
+DELETE_OUTBOX = 'DELETE FROM sheets_outbox WHERE id = ?'
+RETRY_OUTBOX = 'UPDATE sheets_outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?'
+SELECT_PENDING_LEAD = 'SELECT 1 FROM sheets_outbox WHERE request_id = ? LIMIT 1'
+
+INSERT_STATUS = '''
+INSERT INTO sheets_status_outbox (request_id, summary, description, status, created_at) VALUES (?, ?, ?, ?, ?)
+'''
+SELECT_DUE_STATUSES = '''
+SELECT id, request_id, summary, description, status FROM sheets_status_outbox
+WHERE next_attempt_at <= ? ORDER BY id LIMIT ?
+'''
+DELETE_STATUS = 'DELETE FROM sheets_status_outbox WHERE id = ?'
+RETRY_STATUS = 'UPDATE sheets_status_outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?'
+
+
+def first_row(updated_range):
+    # 'Sheet1!A5:D7' -> 5
+    return int(re.search(r'![A-Z]+(\d+)', updated_range).group(1))
+
+
+class SheetsOutbox(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.db.migrate(lambda conn: conn.executescript(OUTBOX_SCHEMA))
+
+    def enqueue(self, row, request_id=None):
+        self.db.write(INSERT_OUTBOX, (request_id, json.dumps(row, ensure_ascii=False), time.time()))
+
+    def due(self, limit):
+        return [(outbox_id, request_id, json.loads(row))
+                for outbox_id, request_id, row in self.db.read(SELECT_DUE, (time.time(), limit))]
+
+    def done(self, outbox_ids):
+        self.db.submit(lambda conn: conn.executemany(DELETE_OUTBOX, [(i,) for i in outbox_ids])).result()
+
+    def retry(self, outbox_ids, delay, sql=RETRY_OUTBOX):
+        next_attempt_at = time.time() + delay
+        self.db.submit(lambda conn: conn.executemany(sql, [(next_attempt_at, i) for i in outbox_ids])).result()
+
+    def has_pending_lead(self, request_id):
+        return self.db.read_one(SELECT_PENDING_LEAD, (request_id,)) is not None
+
+    def enqueue_status(self, request_id, summary, description, status):
+        self.db.write(INSERT_STATUS, (request_id, summary, description, status, time.time()))
+
+    def enqueue_statuses(self, items):
+        # items: [(request_id, summary, description, status)] — одной записью
+        created_at = time.time()
+        self.db.submit(lambda conn: conn.executemany(
+            INSERT_STATUS, [item + (created_at,) for item in items])).result()
+
+    def due_statuses(self, limit):
+        return self.db.read(SELECT_DUE_STATUSES, (time.time(), limit))
+
+    def done_statuses(self, status_ids):
+        self.db.submit(lambda conn: conn.executemany(DELETE_STATUS, [(i,) for i in status_ids])).result()
+
+
+class SheetRowIndex(object):
+    # Номера строк для заявок, у которых номер не сохранён (записанных до
+    # появления индекса). Строится одним чтением таблицы при первом обращении.
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.rows = None
+
+    def find(self, summary, description):
+        if self.rows is None:
+            self.rows = {}
+            with metrics.external('sheets', 'find'):
+                values_list = self.sheet.get_all_values()
+            for number, values in enumerate(values_list, start=1):
+                if len(values) >= 2:
+                    self.rows[(values[0], values[1])] = number
+        return self.rows.get((summary, description))
+
+    def add(self, summary, description, row):
+        if self.rows is not None:
+            self.rows[(summary, description)] = row
+
+
+class SheetsFlusher(threading.Thread):
+
+    def __init__(self, outbox, open_sheet, requests_repo, interval, batch_size, max_backoff):
+        super().__init__(name='sheets-flusher', daemon=True)
+        self.outbox = outbox
+        # Таблица открывается при первой отправке, уже в потоке отправителя
+        self.open_sheet = open_sheet
+        self.sheet = None
+        self.index = None
+        self.requests_repo = requests_repo
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.failures = 0
+
+    def run(self):
+        while True:
+            # За интервал строки успевают накопиться в один пакет
+            time.sleep(self.interval)
+            try:
+                if self.sheet is None:
+                    self.sheet = self.open_sheet()
+                    self.index = SheetRowIndex(self.sheet)
+                while self.flush():
+                    pass
+            except Exception as e:
+                logger.error("Ошибка очереди Google Sheets: %s", e)
+
+    def backoff(self):
+        self.failures += 1
+        return min(self.interval * 2 ** self.failures, self.max_backoff)
+
+    def flush(self):
+        # Сначала строки, затем статусы: статус не может обогнать свою строку.
+        # True — отправлен полный пакет и, возможно, есть ещё работа
+        more = self.flush_leads()
+        if more is None:
+            return False
+        return self.flush_statuses() or more
+
+    def flush_leads(self):
+        # None — отправка не удалась
+        pending = self.outbox.due(self.batch_size)
+        if not pending:
+            return False
+        outbox_ids = [outbox_id for outbox_id, _, _ in pending]
+        try:
+            with metrics.external('sheets', 'append'):
+                response = self.sheet.append_rows([row for _, _, row in pending])
+        except Exception as e:
+            delay = self.backoff()
+            logger.error("Ошибка при сохранении %s лидов в Google Sheets, повтор через %s с: %s", len(pending), delay, e)
+            for _, request_id, _ in pending:
+                with log_setup.context(request_id=request_id):
+                    logger.info("Лид не сохранён в Google Sheets, повтор через %s с", delay)
+            self.outbox.retry(outbox_ids, delay)
+            return None
+        self.failures = 0
+
+        start = first_row(response['updates']['updatedRange'])
+        rows = []
+        for offset, (_, request_id, row) in enumerate(pending):
+            self.index.add(row[0], row[1], start + offset)
+            if request_id is not None:
+                rows.append((request_id, start + offset))
+            with log_setup.context(request_id=request_id):
+                logger.info("Лид сохранён в Google Sheets, строка %s", start + offset)
+        self.requests_repo.set_sheet_rows(rows)
+        self.outbox.done(outbox_ids)
+        logger.info("Лиды успешно сохранены в Google Sheets: %s", len(pending))
+        return len(pending) == self.batch_size
+
+    def flush_statuses(self):
+        pending = self.outbox.due_statuses(self.batch_size)
+        if not pending:
+            return False
+        updates = []
+        updated = []  # (request_id, строка, статус) для записей в лог
+        done = []
+        for status_id, request_id, summary, description, status in pending:
+            row = self.requests_repo.get_sheet_row(request_id) if request_id is not None else None
+            if row is None:
+                if request_id is not None and self.outbox.has_pending_lead(request_id):
+                    # Строка ещё в очереди — статус отправим следующим пакетом
+                    continue
+                row = self.index.find(summary, description)
+            if row is None:
+                with log_setup.context(request_id=request_id):
+                    logger.error("Не удалось найти соответствующую запись в Google Sheets.")
+            else:
+                updates.append({'range': f"{STATUS_COLUMN}{row}", 'values': [[status]]})
+                updated.append((request_id, row, status))
+            done.append(status_id)
+        if updates:
+            try:
+                with metrics.external('sheets', 'update'):
+                    self.sheet.batch_update(updates)
+            except Exception as e:
+                delay = self.backoff()
+                logger.error("Ошибка при обновлении статусов в Google Sheets, повтор через %s с: %s", delay, e)
+                for request_id, row, status in updated:
+                    with log_setup.context(request_id=request_id):
+                        logger.info("Статус «%s» не записан в строку %s, повтор через %s с", status, row, delay)
+                self.outbox.retry(done, delay, RETRY_STATUS)
+                return False
+            self.failures = 0
+            for request_id, row, status in updated:
+                with log_setup.context(request_id=request_id):
+                    logger.info("Статус «%s» записан в строку %s", status, row)
+            logger.info("Статусы обновлены в Google Sheets: %s", len(updates))
+        self.outbox.done_statuses(done)
+        return bool(done) and len(pending) == self.batch_size
+
+
+class LeadSheet(object):
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def save_lead(self, summary, description, username, request_id=None):
+        # Строка уйдёт в таблицу фоновым SheetsFlusher
+        self.outbox.enqueue([summary, description, username, "Новый"], request_id)
+
+    def update_status(self, summary, description, status, request_id=None):
+        # Статус уйдёт в таблицу фоновым SheetsFlusher одним batch_update
+        self.outbox.enqueue_status(request_id, summary, description, status)
+
+    def update_statuses(self, items):
+        # items: [(summary, description, status, request_id)]; все статусы уйдут одним batch_update
+        if items:
+            self.outbox.enqueue_statuses([(request_id, summary, description, status)
+                                          for summary, description, status, request_id in items])
+
+
+def open_worksheet():
+    # Подключение к Google Sheets. gspread импортируется здесь: таблица нужна
+    # только фоновому SheetsFlusher, и запуск бота не ждёт её открытия
+    import gspread
+
+    gc = gspread.service_account(filename=config.SERVICE_ACCOUNT_FILE)
+    return gc.open_by_key(config.SHEET_ID).sheet1  # Открываем таблицу по ID
@@ -0,0 +1,184 @@
+import bisect
+import datetime
+import heapq
+import math
+
+# Движок поиска свободных слотов.
+# События разбираются один раз в отсортированные интервалы в минутах от эпохи,
+# пересекающиеся интервалы сливаются, а свободные начала находятся одним
+# линейным проходом по промежуткам между ними. Для нескольких постов
+# свободные начала каждого поста сливаются k-путевым слиянием: слот доступен,
+# если свободен хотя бы один пост.
+
+# Определяем часовой пояс UTC+4
+UTC_PLUS_4 = datetime.timezone(datetime.timedelta(hours=4))
+
+WORK_START_HOUR = 10
+WORK_END_HOUR = 22
+SLOT_STEP_MINUTES = 30
+
+
+class Resource(object):
+    # Пост мастерской: свой календарь и свои рабочие часы
+    __slots__ = ('id', 'name', 'calendar_id', 'work_start', 'work_end')
+
+    def __init__(self, id, calendar_id, name=None, work_start=WORK_START_HOUR, work_end=WORK_END_HOUR):
+        self.id = id
+        self.name = name or id
+        self.calendar_id = calendar_id
+        self.work_start = work_start
+        self.work_end = work_end
+
+
+def load_resources(items):
+    return [Resource(**item) for item in items]
+
+
+def to_minute(dt):
+    return math.floor(dt.timestamp() / 60)
+
+
+def to_minute_ceil(dt):
+    return math.ceil(dt.timestamp() / 60)
+
+
+def from_minute(minute, tz):
+    return datetime.datetime.fromtimestamp(minute * 60, tz)
+
+
+def round_to_nearest_5_minutes(dt):
+    minutes = dt.minute
+    rounded_minutes = (minutes // 5) * 5
+    if minutes % 5 != 0:
+        rounded_minutes += 5
+    if rounded_minutes >= 60:
+        rounded_minutes = 0
+        dt += datetime.timedelta(hours=1)
+    return dt.replace(minute=rounded_minutes, second=0, microsecond=0)
+
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def busy_intervals(events, tz):
+    # Начало округляем вниз, конец вверх: для слотов, выровненных по минутам,
+    # это даёт тот же результат, что и сравнение точных datetime
+    intervals = []
+    for event in events:
+        start = datetime.datetime.fromisoformat(event['start']['dateTime']).astimezone(tz)
+        end = datetime.datetime.fromisoformat(event['end']['dateTime']).astimezone(tz)
+        intervals.append((to_minute(start), to_minute_ceil(end)))
+    return merge_intervals(intervals)
+
+
+def events_by_day(events, tz):
+    # Раскладывает события окна по дням (событие через полночь попадает в оба дня)
+    by_day = {}
+    for event in events:
+        start = datetime.datetime.fromisoformat(event['start']['dateTime']).astimezone(tz)
+        end = datetime.datetime.fromisoformat(event['end']['dateTime']).astimezone(tz)
+        day = start.date()
+        last = (end - datetime.timedelta(microseconds=1)).date() if end > start else day
+        while day <= last:
+            by_day.setdefault(day, []).append(event)
+            day += datetime.timedelta(days=1)
+    return by_day
+
+
+def day_window(date, tz, now=None, work_start=WORK_START_HOUR, work_end=WORK_END_HOUR):
+    # Первое возможное начало и конец рабочего дня в минутах
+    if now is None:
+        now = datetime.datetime.now(tz)
+    midnight = date.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=tz)
+    start_of_day = max(midnight + datetime.timedelta(hours=work_start), now)
+    end_of_day = midnight + datetime.timedelta(hours=work_end)
+    return to_minute(round_to_nearest_5_minutes(start_of_day)), to_minute(end_of_day)
+
+
+def resource_window(date, tz, resource, now=None):
+    return day_window(date, tz, now, resource.work_start, resource.work_end)
+
+
+def union_starts(lists):
+    # k-путевое слияние отсортированных списков начал без повторов
+    starts = []
+    for minute in heapq.merge(*lists):
+        if not starts or minute != starts[-1]:
+            starts.append(minute)
+    return starts
+
+
+def free_starts(busy, first, close, duration, step=SLOT_STEP_MINUTES):
+    # busy — слитые отсортированные интервалы; кандидаты: first + k * step
+    starts = []
+
+    def collect(gap_start, gap_end):
+        if gap_start > first:
+            candidate = first + -(-(gap_start - first) // step) * step
+        else:
+            candidate = first
+        starts.extend(range(candidate, gap_end - duration + 1, step))
+
+    cursor = first
+    for busy_start, busy_end in busy:
+        if busy_end <= cursor:
+            continue
+        if busy_start >= close:
+            break
+        collect(cursor, min(busy_start, close))
+        cursor = busy_end
+        if cursor >= close:
+            return starts
+    collect(cursor, close)
+    return starts
+
+
+class DaySchedule(object):
+    __slots__ = ('date', 'first', 'close', 'busy')
+
+    def __init__(self, date, first, close, busy):
+        self.date = date
+        self.first = first
+        self.close = close
+        self.busy = busy
+
+    def free_starts(self, duration_hours, step=SLOT_STEP_MINUTES):
+        return free_starts(self.busy, self.first, self.close, round(duration_hours * 60), step)
+
+
+def build_schedules(dates, events, tz, now=None):
+    # События разбираются один раз на весь диапазон дат, затем делятся по дням
+    busy = busy_intervals(events, tz)
+    ends = [end for _, end in busy]
+    schedules = []
+    for date in dates:
+        first, close = day_window(date, tz, now)
+        lo = bisect.bisect_right(ends, first)
+        hi = lo
+        while hi < len(busy) and busy[hi][0] < close:
+            hi += 1
+        schedules.append(DaySchedule(date, first, close, busy[lo:hi]))
+    return schedules
+
+
+def batch_free_starts(schedules, durations, tz):
+    # Все свободные начала для набора дней и длительностей за один проход
+    result = {}
+    for schedule in schedules:
+        for duration_hours in durations:
+            result[(schedule.date, duration_hours)] = [
+                from_minute(minute, tz) for minute in schedule.free_starts(duration_hours)]
+    return result
+
+
+def free_slots(date, duration_hours, events, tz, now=None):
+    schedule, = build_schedules([date], events, tz, now)
+    return [from_minute(minute, tz) for minute in schedule.free_starts(duration_hours)]
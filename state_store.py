@@ -0,0 +1,194 @@
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+
+import metrics
+
+# Состояние диалогов: поля заявки и текущий шаг сценария.
+# Хранится в SQLite (переживает перезапуск, доступно нескольким процессам),
+# перед базой — LRU-кэш в памяти. Записи старше TTL удаляются.
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chat_states (
+    chat_id INTEGER PRIMARY KEY,
+    step TEXT,
+    step_args TEXT,
+    data TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS chat_states_updated_at ON chat_states (updated_at);
+'''
+
+SELECT_STATE = 'SELECT step, step_args, data, updated_at FROM chat_states WHERE chat_id = ?'
+UPSERT_STATE = '''
+INSERT OR REPLACE INTO chat_states (chat_id, step, step_args, data, updated_at) VALUES (?, ?, ?, ?, ?)
+'''
+DELETE_STATE = 'DELETE FROM chat_states WHERE chat_id = ?'
+DELETE_EXPIRED = 'DELETE FROM chat_states WHERE updated_at < ?'
+
+
+def encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'$dt': value.isoformat()}
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict) and '$dt' in value:
+        return datetime.datetime.fromisoformat(value['$dt'])
+    return value
+
+
+class ChatState(object):
+    # selected — заявки, отмеченные администратором в /queue
+    FIELDS = ('service_type', 'duration_hours', 'summary', 'description', 'username', 'date', 'time', 'selected')
+    __slots__ = ('chat_id', 'step', 'step_args', 'updated_at') + FIELDS
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.step = None
+        self.step_args = ()
+        self.updated_at = time.time()
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def dump(self):
+        data = {field: encode(getattr(self, field)) for field in self.FIELDS}
+        return (self.chat_id, self.step, json.dumps([encode(arg) for arg in self.step_args]),
+                json.dumps(data), self.updated_at)
+
+    @classmethod
+    def load(cls, chat_id, step, step_args, data, updated_at):
+        state = cls(chat_id)
+        state.step = step
+        state.step_args = tuple(decode(arg) for arg in json.loads(step_args or '[]'))
+        state.updated_at = updated_at
+        for field, value in json.loads(data or '{}').items():
+            if field in cls.FIELDS:
+                setattr(state, field, decode(value))
+        return state
+
+
+class StateStore(object):
+
+    def __init__(self, db, ttl, max_cached):
+        self.db = db
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.db.migrate(lambda conn: conn.executescript(SCHEMA))
+
+    def get(self, chat_id):
+        now = time.time()
+        with self.lock:
+            state = self.cache.get(chat_id)
+            if state is not None:
+                if now - state.updated_at <= self.ttl:
+                    self.cache.move_to_end(chat_id)
+                    metrics.cache('chat_states', True)
+                    return state
+                del self.cache[chat_id]
+        metrics.cache('chat_states', False)
+
+        row = self.db.read_one(SELECT_STATE, (chat_id,))
+        if row is None or now - row[3] > self.ttl:
+            return None
+        state = ChatState.load(chat_id, *row)
+        self._cache(state)
+        return state
+
+    def create(self, chat_id, **fields):
+        # Новый диалог — прежние поля отбрасываются
+        state = ChatState(chat_id)
+        for field, value in fields.items():
+            setattr(state, field, value)
+        self.save(state)
+        return state
+
+    def save(self, state):
+        state.updated_at = time.time()
+        self._cache(state)
+        row = state.dump()
+        self._write(lambda conn: conn.execute(UPSERT_STATE, row))
+
+    def update(self, chat_id, **fields):
+        state = self.get(chat_id) or ChatState(chat_id)
+        for field, value in fields.items():
+            setattr(state, field, value)
+        self.save(state)
+        return state
+
+    def set_step(self, chat_id, step, *args):
+        state = self.get(chat_id) or ChatState(chat_id)
+        state.step = step
+        state.step_args = args
+        self.save(state)
+
+    def pop_step(self, chat_id):
+        state = self.get(chat_id)
+        if state is None or state.step is None:
+            return None, ()
+        step, args = state.step, state.step_args
+        state.step = None
+        state.step_args = ()
+        self.save(state)
+        return step, args
+
+    def has_step(self, chat_id):
+        state = self.get(chat_id)
+        return state is not None and state.step is not None
+
+    def delete(self, chat_id):
+        with self.lock:
+            self.cache.pop(chat_id, None)
+        self._write(lambda conn: conn.execute(DELETE_STATE, (chat_id,)))
+
+    def evict_expired(self):
+        deadline = time.time() - self.ttl
+        with self.lock:
+            for chat_id in [chat_id for chat_id, state in self.cache.items() if state.updated_at < deadline]:
+                del self.cache[chat_id]
+        self.db.write(DELETE_EXPIRED, (deadline,))
+
+    def _cache(self, state):
+        with self.lock:
+            self.cache[state.chat_id] = state
+            self.cache.move_to_end(state.chat_id)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+
+    def _write(self, func):
+        future = self.db.submit(func)
+        if self.max_cached:
+            # Запись в базу не ждём: чтения этого процесса обслуживает кэш
+            future.add_done_callback(self._check)
+        else:
+            # Без кэша следующее чтение идёт в базу, поэтому дожидаемся записи
+            future.result()
+
+    def _check(self, future):
+        if future.exception() is not None:
+            logger.error("Ошибка при сохранении состояния диалога: %s", future.exception())
+
+
+class StateJanitor(threading.Thread):
+    # Периодически удаляет состояния брошенных диалогов
+
+    def __init__(self, store, interval):
+        super().__init__(name='state-janitor', daemon=True)
+        self.store = store
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.evict_expired()
+            except Exception as e:
+                logger.error("Ошибка при очистке состояний диалогов: %s", e)
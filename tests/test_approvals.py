@@ -0,0 +1,40 @@
+import approvals
+
+
+def enqueue(jobs, database, request_ids):
+    return database.submit(lambda conn: [jobs.enqueue(conn, request_id, 'post1')
+                                         for request_id in request_ids]).result()
+
+
+def test_enqueue_is_idempotent(database):
+    jobs = approvals.ApprovalJobs(database)
+    first = enqueue(jobs, database, [1])
+    assert enqueue(jobs, database, [1]) == first
+    assert jobs.get(first[0]).event_id is None
+
+
+def test_claim_batches_jobs_that_need_events(database):
+    jobs = approvals.ApprovalJobs(database)
+    job_ids = enqueue(jobs, database, [1, 2, 3])
+    jobs.update(job_ids[1], event_id=approvals.event_id('approve-2'))
+
+    claimed = jobs.claim(limit=10)
+    # Задание с готовым событием в пакет не попадает
+    assert [job.id for job in claimed] == [job_ids[0], job_ids[2]]
+    assert all(job.status == approvals.RUNNING and job.attempts == 1 for job in claimed)
+    assert [job.id for job in jobs.claim(limit=10)] == [job_ids[1]]
+    assert jobs.claim(limit=10) == []
+
+
+def test_retry_requeues_failed_jobs(database):
+    jobs = approvals.ApprovalJobs(database)
+    job_ids = enqueue(jobs, database, [1, 2])
+    for job in jobs.claim(limit=10):
+        jobs.update(job.id, status=approvals.FAILED)
+
+    assert jobs.retry(job_ids[1]) == [job_ids[1]]
+    job = jobs.get(job_ids[1])
+    assert job.status == approvals.QUEUED and job.attempts == 0
+    assert jobs.get(job_ids[0]).status == approvals.FAILED
+    assert jobs.retry() == [job_ids[0]]
+    assert jobs.retry() == []
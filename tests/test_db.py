@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+
+import db
+from db import RequestNotPending, RequestRepository
+
+LEGACY_SCHEMA = '''
+CREATE TABLE requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, username TEXT, duration_hours INTEGER,
+    summary TEXT, description TEXT, service_type TEXT, date TEXT, time TEXT
+)
+'''
+
+
+def create(repo, user_id=1, date='2030-01-07', time='12:00'):
+    return repo.create(user_id, 'user', 1, 'BMW', '+79990000000', 'Замена масла', date, time)
+
+
+def statuses(database):
+    return dict(database.read('SELECT id, status FROM requests ORDER BY id'))
+
+
+def test_backfill_marks_pre_status_rows_legacy(tmp_path):
+    path = str(tmp_path / 'requests.db')
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_SCHEMA)
+    conn.execute("INSERT INTO requests (user_id, date, time) VALUES (1, '2023-05-01', '12:00')")
+    conn.execute("INSERT INTO requests (user_id, date, time) VALUES (2, '2030-01-07', '12:00')")
+    conn.commit()
+    conn.close()
+
+    database = db.Database(path)
+    assert statuses(database) == {1: db.STATUS_LEGACY, 2: db.STATUS_LEGACY}
+    # Новые заявки по-прежнему на рассмотрении, а legacy не попадают в очередь
+    request_id = create(RequestRepository(database))
+    assert statuses(database)[request_id] == db.STATUS_PENDING
+    assert [row[0] for row in database.read(db.SELECT_PENDING, (10, 0))] == [request_id]
+
+
+def test_backfill_repairs_rows_marked_pending_earlier(tmp_path):
+    path = str(tmp_path / 'requests.db')
+    database = db.Database(path)
+    request_id = create(RequestRepository(database))
+    database.write("INSERT INTO requests (user_id, date, time, status) VALUES (2, '2023-05-01', '12:00', 'pending')")
+    database.write("INSERT INTO requests (user_id, date, time, resource_id) VALUES (3, '2023-05-01', '12:00', 'b1')")
+
+    reopened = db.Database(path)
+    assert statuses(reopened) == {request_id: db.STATUS_PENDING, 2: db.STATUS_LEGACY, 3: db.STATUS_APPROVED}
+
+
+def test_assign_and_move_refuse_decided_requests(database):
+    repo = RequestRepository(database)
+    request_id = create(repo)
+    rejected, _ = repo.reject_many([request_id], lambda conn, request_id: set())
+    assert [request[0] for request in rejected] == [request_id]
+
+    with pytest.raises(RequestNotPending):
+        repo.assign_resource(request_id, lambda conn, request: 'b1')
+    with pytest.raises(RequestNotPending):
+        repo.update_datetime(request_id, '2030-01-08', '13:00')
+    request = repo.get(request_id)
+    assert (request[7], request[8], request[11]) == ('2030-01-07', '12:00', db.STATUS_REJECTED)
+
+
+def test_approve_many_skips_decided_and_taken(database):
+    repo = RequestRepository(database)
+    first, second, third = create(repo), create(repo, 2), create(repo, 3)
+    repo.reject_many([first], lambda conn, request_id: set())
+
+    class Taken(Exception):
+        pass
+
+    def reserve(conn, request):
+        if request[0] == third:
+            raise Taken()
+        return 'b1'
+
+    approved, skipped = repo.approve_many([first, second, third], reserve, skip=Taken)
+    assert [(request[0], resource_id) for request, resource_id in approved] == [(second, 'b1')]
+    assert skipped == [third]
+    assert statuses(database) == {first: db.STATUS_REJECTED, second: db.STATUS_APPROVED, third: db.STATUS_PENDING}
@@ -0,0 +1,60 @@
+import datetime
+
+import pytest
+
+from holds import SlotHolds, SlotTaken
+from slots import UTC_PLUS_4
+
+DAY = datetime.datetime(2030, 1, 7, tzinfo=UTC_PLUS_4)
+
+
+def at(hour, minute=0):
+    return DAY.replace(hour=hour, minute=minute)
+
+
+def hold(database, holds, request_id, resource_id, start, end, confirmed=False):
+    return database.submit(lambda conn: holds.hold(conn, request_id, resource_id, start, end, confirmed)).result()
+
+
+@pytest.fixture
+def holds(database):
+    return SlotHolds(database, UTC_PLUS_4, ttl=600)
+
+
+def test_overlap_on_same_resource_is_rejected(database, holds):
+    hold(database, holds, 1, 'b1', at(12), at(13))
+    with pytest.raises(SlotTaken):
+        hold(database, holds, 2, 'b1', at(12, 30), at(13, 30))
+
+
+def test_adjacent_and_other_resource_are_allowed(database, holds):
+    hold(database, holds, 1, 'b1', at(12), at(13))
+    hold(database, holds, 2, 'b1', at(13), at(14))
+    hold(database, holds, 3, 'b2', at(12), at(13))
+    assert len(holds.active(DAY.date(), DAY.date())) == 3
+
+
+def test_expired_hold_does_not_block(database):
+    expired = SlotHolds(database, UTC_PLUS_4, ttl=-1)
+    hold(database, expired, 1, 'b1', at(12), at(13))
+    hold(database, expired, 2, 'b1', at(12), at(13), confirmed=True)
+    assert [row[0] for row in database.read('SELECT request_id FROM slot_holds')] == [2]
+
+
+def test_confirmed_hold_blocks_and_rehold_moves(database, holds):
+    hold(database, holds, 1, 'b1', at(12), at(13), confirmed=True)
+    with pytest.raises(SlotTaken):
+        hold(database, holds, 2, 'b1', at(12), at(13))
+    # Та же заявка переносит свою бронь, не конфликтуя сама с собой
+    changed = hold(database, holds, 1, 'b1', at(12, 30), at(13, 30), confirmed=True)
+    assert changed == {DAY.date()}
+    assert database.read_one('SELECT start_ts FROM slot_holds WHERE request_id = 1')[0] == \
+        int(at(12, 30).timestamp())
+
+
+def test_failed_hold_keeps_previous(database, holds):
+    hold(database, holds, 1, 'b1', at(12), at(13))
+    hold(database, holds, 2, 'b1', at(14), at(15))
+    with pytest.raises(SlotTaken):
+        hold(database, holds, 2, 'b1', at(12), at(13))
+    assert database.read_one('SELECT start_ts FROM slot_holds WHERE request_id = 2')[0] == int(at(14).timestamp())
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip('telebot')
+
+from sender import TokenBucket  # noqa: E402
+
+
+def test_bucket_allows_burst_up_to_capacity():
+    bucket = TokenBucket(rate=1, capacity=3, now=0)
+    for _ in range(3):
+        assert bucket.wait_time(0) == 0
+        bucket.take()
+    assert bucket.wait_time(0) == pytest.approx(1)
+
+
+def test_bucket_refills_at_rate_and_is_capped():
+    bucket = TokenBucket(rate=2, capacity=2, now=0)
+    bucket.take()
+    bucket.take()
+    assert bucket.wait_time(0.25) == pytest.approx(0.25)
+    assert bucket.wait_time(0.5) == 0
+    assert not bucket.is_full(0.5)
+    assert bucket.is_full(100)
+    bucket.wait_time(100)
+    assert bucket.tokens == 2
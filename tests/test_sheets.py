@@ -0,0 +1,90 @@
+import pytest
+
+import sheets
+from db import RequestRepository
+
+
+class FakeSheet(object):
+    # Первая строка — заголовок, строки добавляются в конец
+
+    def __init__(self):
+        self.rows = [['Модель', 'Телефон', 'Username', 'Статус']]
+        self.calls = []
+        self.fail = False
+
+    def append_rows(self, rows):
+        self.calls.append('append_rows')
+        if self.fail:
+            raise IOError('sheets unavailable')
+        start = len(self.rows) + 1
+        self.rows.extend(list(row) for row in rows)
+        return {'updates': {'updatedRange': f'Sheet1!A{start}:D{len(self.rows)}'}}
+
+    def batch_update(self, updates):
+        self.calls.append('batch_update')
+        if self.fail:
+            raise IOError('sheets unavailable')
+        for update in updates:
+            self.rows[int(update['range'][1:]) - 1][3] = update['values'][0][0]
+
+    def get_all_values(self):
+        self.calls.append('get_all_values')
+        return [list(row) for row in self.rows]
+
+
+@pytest.fixture
+def sheet():
+    return FakeSheet()
+
+
+@pytest.fixture
+def flusher(database, sheet):
+    outbox = sheets.SheetsOutbox(database)
+    # interval 0: повтор после ошибки сразу доступен
+    flusher = sheets.SheetsFlusher(outbox, lambda: sheet, RequestRepository(database), 0, 10, 0)
+    flusher.sheet = sheet
+    flusher.index = sheets.SheetRowIndex(sheet)
+    return flusher
+
+
+def flush_all(flusher):
+    while flusher.flush():
+        pass
+
+
+def test_leads_keep_order_and_rows_are_remembered(database, flusher, sheet):
+    lead_sheet = sheets.LeadSheet(flusher.outbox)
+    for number in range(3):
+        lead_sheet.save_lead(f'Машина {number}', f'+7999000000{number}', 'user', request_id=number + 1)
+    flush_all(flusher)
+    assert [row[0] for row in sheet.rows[1:]] == ['Машина 0', 'Машина 1', 'Машина 2']
+    assert sheet.calls == ['append_rows']
+
+
+def test_status_waits_for_its_lead(database, flusher, sheet):
+    repo = RequestRepository(database)
+    request_id = repo.create(1, 'user', 1, 'BMW', '+79990000000', 'Замена масла', '2030-01-07', '12:00')
+    lead_sheet = sheets.LeadSheet(flusher.outbox)
+    lead_sheet.save_lead('BMW', '+79990000000', 'user', request_id)
+    lead_sheet.update_status('BMW', '+79990000000', 'Одобрено', request_id)
+
+    sheet.fail = True
+    assert flusher.flush() is False
+    # Строка не записана — статус не отправляется и не ищется по таблице
+    assert sheet.calls == ['append_rows']
+    assert flusher.outbox.due_statuses(10)
+
+    sheet.fail = False
+    flush_all(flusher)
+    assert sheet.rows[1] == ['BMW', '+79990000000', 'user', 'Одобрено']
+    assert repo.get_sheet_row(request_id) == 2
+    assert sheet.calls == ['append_rows', 'append_rows', 'batch_update']
+    assert not flusher.outbox.due(10) and not flusher.outbox.due_statuses(10)
+
+
+def test_status_without_saved_row_uses_sheet_index(database, flusher, sheet):
+    sheet.rows.append(['Audi', '+79990000001', 'user', 'Новый'])
+    sheets.LeadSheet(flusher.outbox).update_status('Audi', '+79990000001', 'Отклонено')
+    flush_all(flusher)
+    assert sheet.rows[1][3] == 'Отклонено'
+    assert sheet.calls == ['get_all_values', 'batch_update']
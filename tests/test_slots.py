@@ -0,0 +1,56 @@
+import datetime
+
+import slots
+from slots import UTC_PLUS_4
+
+FIRST = 10 * 60
+CLOSE = 22 * 60
+
+
+def naive_free_starts(busy, first, close, duration, step):
+    # Перебор всех кандидатов — эталон для проверки прохода по промежуткам
+    return [start for start in range(first, close - duration + 1, step)
+            if all(start + duration <= busy_start or start >= busy_end for busy_start, busy_end in busy)]
+
+
+def test_free_starts_empty_day():
+    assert slots.free_starts([], FIRST, CLOSE, 60, 30) == list(range(FIRST, CLOSE - 60 + 1, 30))
+
+
+def test_free_starts_skips_busy_and_aligns_to_step():
+    busy = [(FIRST + 20, FIRST + 70)]
+    starts = slots.free_starts(busy, FIRST, CLOSE, 60, 30)
+    # Первое начало после занятого интервала — ближайшее кратное шагу
+    assert starts[0] == FIRST + 90
+    assert starts == naive_free_starts(busy, FIRST, CLOSE, 60, 30)
+
+
+def test_free_starts_gap_shorter_than_duration():
+    busy = [(FIRST, FIRST + 60), (FIRST + 90, FIRST + 180)]
+    assert FIRST + 60 not in slots.free_starts(busy, FIRST, CLOSE, 60, 30)
+
+
+def test_free_starts_matches_naive_sweep():
+    busy = slots.merge_intervals([(640, 700), (690, 760), (900, 905), (1200, 1400)])
+    for duration in (30, 60, 90, 180):
+        for step in (15, 30):
+            assert slots.free_starts(busy, FIRST, CLOSE, duration, step) == \
+                naive_free_starts(busy, FIRST, CLOSE, duration, step)
+
+
+def test_free_starts_busy_until_close():
+    assert slots.free_starts([(FIRST + 60, CLOSE + 60)], FIRST, CLOSE, 60, 30) == [FIRST]
+
+
+def test_union_starts_removes_duplicates():
+    assert slots.union_starts([[600, 630, 700], [630, 660]]) == [600, 630, 660, 700]
+
+
+def test_free_slots_respects_events():
+    date = datetime.datetime(2030, 1, 7, tzinfo=UTC_PLUS_4)
+    events = [{'start': {'dateTime': '2030-01-07T10:00:00+04:00'}, 'end': {'dateTime': '2030-01-07T12:00:00+04:00'}}]
+    now = date.replace(hour=0)
+    free = slots.free_slots(date, 1, events, UTC_PLUS_4, now)
+    assert free[0] == date.replace(hour=12)
+    assert all(start.hour >= 12 for start in free)
+    assert free[-1] == date.replace(hour=21)
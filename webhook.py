@@ -0,0 +1,127 @@
+import collections
+import http.server
+import json
+import logging
+import threading
+
+# Приём обновлений Telegram через вебхук.
+# HTTP-сервер только кладёт обновление в очередь и сразу отвечает, а обработка
+# идёт в ограниченном пуле воркеров. Обновления одного чата обрабатываются
+# строго по порядку, разные чаты — параллельно.
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for key in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'my_chat_member'):
+        if key in update and 'from' in update[key]:
+            return update[key]['from']['id']
+    # Обновления без чата ни с чем не упорядочиваем
+    return ('update', update.get('update_id'))
+
+
+class ChatDispatcher(object):
+
+    def __init__(self, process, workers, max_pending):
+        self.process = process
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.ready = collections.deque()
+        self.pending = 0
+        self.stopped = False
+        self.threads = [threading.Thread(target=self._worker, name=f'webhook-worker-{i}', daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id, update):
+        # False — очередь переполнена, Telegram повторит доставку позже
+        with self.condition:
+            if self.pending >= self.max_pending:
+                return False
+            queue = self.queues.get(chat_id)
+            if queue is None:
+                # Чат не обрабатывается и не ждёт воркера — ставим его в очередь готовых
+                queue = self.queues[chat_id] = collections.deque()
+                self.ready.append(chat_id)
+                self.condition.notify()
+            queue.append(update)
+            self.pending += 1
+            return True
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.ready and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                chat_id = self.ready.popleft()
+                update = self.queues[chat_id].popleft()
+            try:
+                self.process(update)
+            except Exception as e:
+                logger.error("Ошибка при обработке обновления %s: %s", update.get('update_id'), e)
+            with self.condition:
+                self.pending -= 1
+                if self.queues[chat_id]:
+                    self.ready.append(chat_id)
+                    self.condition.notify()
+                else:
+                    del self.queues[chat_id]
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.webhook_path:
+            self.send_error(404)
+            return
+        if server.secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != server.secret:
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        if server.dispatcher.submit(update_chat_id(update), update):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            logger.warning("Очередь обновлений переполнена, обновление %s отклонено", update.get('update_id'))
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, path, secret, dispatcher):
+        super().__init__(address, WebhookHandler)
+        self.webhook_path = path
+        self.secret = secret
+        self.dispatcher = dispatcher